@@ -0,0 +1,228 @@
+from typing import Callable
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+try:
+    from grid_env import Gridworld  # Works with normal code
+    from dyna_agent import DynaAgent
+    from grid_generator import generate_grid
+except ModuleNotFoundError:
+    from src.grid_env import Gridworld  # Works when called from unittest
+    from src.dyna_agent import DynaAgent
+    from src.grid_generator import generate_grid
+
+
+_RULES = """[ACTIONS]
+L
+R
+U
+D
+
+[REWARDS]
+DEFAULT = -1
+"""
+
+
+def _latency_stats(latencies_ns: np.ndarray) -> dict:
+    total_seconds = latencies_ns.sum() / 1e9
+    p50, p90, p99 = np.percentile(latencies_ns, [50, 90, 99]) / 1e3
+    return {
+        "calls": len(latencies_ns),
+        "calls_per_sec": len(latencies_ns) / total_seconds if total_seconds > 0 else None,
+        "p50_us": p50,
+        "p90_us": p90,
+        "p99_us": p99,
+    }
+
+
+def _time_call(function: Callable, repeat: int = 3) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"best_sec": min(times), "mean_sec": sum(times) / repeat}
+
+
+def _peak_memory_mb(function: Callable) -> float:
+    tracemalloc.start()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak / 2**20
+
+
+def bench_construction(grid_path: str, rules_path: str, dynamics: str) -> dict:
+    env = Gridworld(grid_path, rules_path, dynamics=dynamics)
+    record = {
+        "construction": _time_call(lambda: Gridworld(grid_path, rules_path, dynamics=dynamics)),
+        "load_grid": _time_call(lambda: env._load_grid(grid_path)),
+        "load_rules": _time_call(lambda: env._load_rules(rules_path)),
+        "peak_memory_mb": _peak_memory_mb(lambda: Gridworld(grid_path, rules_path, dynamics)),
+    }
+    if dynamics == "dict":
+        record["define_dynamics"] = _time_call(env._define_dynamics)
+    elif dynamics == "compiled":
+
+        def compile_again():
+            env.next_state_table = None
+            env.compile_dynamics()
+
+        record["define_dynamics"] = _time_call(compile_again)
+    return record
+
+
+def bench_take_action(grid_path: str, rules_path: str, dynamics: str, n_steps: int) -> dict:
+    env = Gridworld(grid_path, rules_path, dynamics=dynamics)
+    actions = [random.choice(env.action_list) for _ in range(n_steps)]
+    latencies = np.empty(n_steps, dtype=np.int64)
+
+    env.initialize(method="random")
+    for i, action in enumerate(actions):
+        start = time.perf_counter_ns()
+        env.take_action(action)
+        latencies[i] = time.perf_counter_ns() - start
+        if env.current_cell == "G":
+            env.initialize(method="random")
+    return _latency_stats(latencies)
+
+
+def bench_play_step(
+    env: Gridworld, storage: str, planning: str, n_updates: int, n_steps: int
+) -> dict:
+    agent = DynaAgent(env, storage=storage, planning=planning)
+    latencies = np.empty(n_steps, dtype=np.int64)
+
+    agent.init_round(method="random")
+    for i in range(n_steps):
+        start = time.perf_counter_ns()
+        agent.play_step(n_updates=n_updates)
+        latencies[i] = time.perf_counter_ns() - start
+        if agent.finished():
+            agent.init_round(method="random")
+    return _latency_stats(latencies)
+
+
+def bench_episodes(
+    env: Gridworld, storage: str, n_updates: int, n_episodes: int, max_steps: int
+) -> dict:
+    agent = DynaAgent(env, storage=storage)
+    results = agent.run_episodes(n_episodes, n_updates=n_updates, max_steps=max_steps)
+    steps = int(results["steps"].sum())
+    elapsed = results["wall_time"].sum()
+    return {
+        "episodes": n_episodes,
+        "steps": steps,
+        "episodes_per_sec": n_episodes / elapsed,
+        "steps_per_sec": steps / elapsed,
+    }
+
+
+def run_benchmarks(
+    sizes: list,
+    n_steps: int = 10000,
+    n_updates_list: list = [0, 10, 50],
+    n_episodes: int = 10,
+    max_episode_steps: int = 10000,
+    wall_density: float = 0.2,
+    seed: int = 0,
+) -> dict:
+    """
+    Benchmark Gridworld and DynaAgent on size x size grids made by grid_generator. Returns a
+    dict with the machine description and one record per benchmark, ready to be saved as JSON.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rules_path = os.path.join(tmp_dir, "rules.config")
+        with open(rules_path, "w") as rules_file:
+            rules_file.write(_RULES)
+
+        for size in sizes:
+            grid_path = os.path.join(tmp_dir, f"grid_{size}.txt")
+            generate_grid(grid_path, size, size, style="open", wall_density=wall_density, seed=seed)
+
+            for dynamics in ["dict", "compiled", "lazy"]:
+                record = {"size": size, "dynamics": dynamics}
+                results.append(
+                    {"benchmark": "construction", **record}
+                    | bench_construction(grid_path, rules_path, dynamics)
+                )
+                results.append(
+                    {"benchmark": "take_action", **record}
+                    | bench_take_action(grid_path, rules_path, dynamics, n_steps)
+                )
+
+            env = Gridworld(grid_path, rules_path, dynamics="compiled")
+            for storage in ["dict", "array"]:
+                for planning in ["uniform", "batched"]:
+                    if (planning == "batched") and (storage != "array"):
+                        continue
+                    for n_updates in n_updates_list:
+                        record = {
+                            "benchmark": "play_step",
+                            "size": size,
+                            "storage": storage,
+                            "planning": planning,
+                            "n_updates": n_updates,
+                        }
+                        results.append(
+                            record | bench_play_step(env, storage, planning, n_updates, n_steps)
+                        )
+
+                record = {"benchmark": "episodes", "size": size, "storage": storage}
+                results.append(
+                    record
+                    | bench_episodes(
+                        env, storage, n_updates_list[-1], n_episodes, max_episode_steps
+                    )
+                )
+
+    return {
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Gridworld and DynaAgent hot paths")
+    parser.add_argument("--sizes", default="10,100,500", help="Comma separated grid sizes")
+    parser.add_argument("--steps", type=int, default=10000, help="Steps per throughput benchmark")
+    parser.add_argument("--updates", default="0,10,50", help="Comma separated n_updates values")
+    parser.add_argument("--episodes", type=int, default=10)
+    parser.add_argument("--max-episode-steps", type=int, default=10000)
+    parser.add_argument("--wall-density", type=float, default=0.2)
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmarks(
+        [int(size) for size in args.sizes.split(",")],
+        n_steps=args.steps,
+        n_updates_list=[int(n) for n in args.updates.split(",")],
+        n_episodes=args.episodes,
+        max_episode_steps=args.max_episode_steps,
+        wall_density=args.wall_density,
+    )
+    with open(args.output, "w") as output_file:
+        json.dump(benchmark_results, output_file, indent=2)
+
+    for result in benchmark_results["results"]:
+        print(result)
@@ -1,7 +1,73 @@
-from base_env import Environment
+try:
+    from base_env import Environment  # Works with normal code
+    from profiling import Profiler
+    from replay_buffer import ReplayBuffer
+except ModuleNotFoundError:
+    from src.base_env import Environment  # Works when called from unittest
+    from src.profiling import Profiler
+    from src.replay_buffer import ReplayBuffer
 import numpy as np
-import random
+from collections import namedtuple
+import heapq
+import itertools
+import json
 import math
+import os
+import shutil
+import time
+
+# Bump when the files written by DynaAgent.save_checkpoint change
+_CHECKPOINT_FORMAT_VERSION = 1
+
+# Constructor arguments stored in a checkpoint, when the agent has them
+_CHECKPOINT_ARGS = [
+    "exploration",
+    "epsilon",
+    "decay_eps_episodes",
+    "alfa",
+    "end_alfa",
+    "decay_alfa_episodes",
+    "gamma",
+    "ucb_c",
+    "storage",
+    "planning",
+    "priority_threshold",
+    "model",
+    "max_outcomes",
+    "model_backup",
+    "seed",
+    "replay_capacity",
+    "replay_fraction",
+    "replay_recency",
+]
+
+
+# Records yielded by DynaAgent.iter_steps
+StepRecord = namedtuple(
+    "StepRecord",
+    ["episode", "step", "state", "action", "reward", "next_state", "td_error", "done"],
+)
+EpisodeRecord = namedtuple(
+    "EpisodeRecord", ["episode", "steps", "episode_return", "planning_updates", "finished"]
+)
+
+
+class _StateIds(dict):
+    """
+    Id of each (row, column) state of a compiled Gridworld, looked up in its state_ids table on
+    first use. Only the visited states get a dict entry.
+    """
+
+    def __init__(self, state_ids: np.ndarray):
+        super().__init__()
+        self._flat_state_ids = memoryview(state_ids.ravel())
+        self._column_num = state_ids.shape[1]
+
+    def __missing__(self, state: tuple) -> int:
+        row, column = state
+        state_id = self._flat_state_ids[row * self._column_num + column]
+        self[state] = state_id
+        return state_id
 
 
 class InvalidEnvInit(Exception):
@@ -33,6 +99,49 @@ class InvalidAlfaValues(Exception):
     pass
 
 
+class InvalidStorageMode(Exception):
+    """
+    Raised when the passed storage mode is not:
+     - "dict"
+     - "array"
+    """
+
+    pass
+
+
+class InvalidPlanningMode(Exception):
+    """
+    Raised when the passed planning mode is not:
+     - "uniform"
+     - "prioritized"
+     - "batched" (only with array storage)
+    """
+
+    pass
+
+
+class InvalidModelMode(Exception):
+    """
+    Raised when the passed model mode is not:
+     - "deterministic"
+     - "stochastic" (only with array storage)
+    or when the passed model backup is not:
+     - "sample"
+     - "expectation"
+    """
+
+    pass
+
+
+class InvalidCheckpoint(Exception):
+    """
+    Raised when a checkpoint directory is incomplete, was written by an incompatible version,
+    or doesn't match the states and actions of the environment it's loaded with.
+    """
+
+    pass
+
+
 class DynaAgent:
     def __init__(
         self,
@@ -45,8 +154,72 @@ class DynaAgent:
         decay_alfa_episodes: int = 100,
         gamma: float = 1,
         ucb_c: float = 1,
+        storage: str = "dict",
+        planning: str = "uniform",
+        priority_threshold: float = 1e-4,
+        model: str = "deterministic",
+        max_outcomes: int = 4,
+        model_backup: str = "sample",
+        seed: int = None,
+        random_block_size: int = 4096,
+        replay_capacity: int = 0,
+        replay_fraction: float = 0.5,
+        replay_recency: float = None,
     ):
         self.env = env
+        self.profiler = None
+        self.trajectory_writer = None
+
+        # Uniform numbers are drawn in blocks, which is much cheaper than one call per draw
+        self.seed = seed
+        self._rng = np.random.default_rng(seed)
+        self._random_block_size = random_block_size
+        self._uniforms = []
+        self._next_uniform = 0
+
+        if storage not in ["dict", "array"]:
+            raise InvalidStorageMode("Invalid storage mode!")
+        self.storage = storage
+
+        if planning not in ["uniform", "prioritized", "batched"]:
+            raise InvalidPlanningMode("Invalid planning mode!")
+        if (planning == "batched") and (storage != "array"):
+            raise InvalidPlanningMode("Batched planning requires array storage!")
+        self.planning = planning
+
+        if model not in ["deterministic", "stochastic"]:
+            raise InvalidModelMode("Invalid model mode!")
+        if (model == "stochastic") and (storage != "array"):
+            raise InvalidModelMode("Stochastic model requires array storage!")
+        if model_backup not in ["sample", "expectation"]:
+            raise InvalidModelMode("Invalid model backup!")
+        self.model = model
+        # Planning either samples one observed outcome or backs up the expected target
+        self.model_backup = model_backup
+        self.max_outcomes = max_outcomes
+
+        # Optional buffer of the last replay_capacity real transitions (0 disables it).
+        # replay_fraction of the planning updates replay them instead of using the model,
+        # sampled uniformly or, with replay_recency, favoring the recent ones.
+        if (replay_capacity > 0) and (storage != "array"):
+            raise InvalidPlanningMode("Experience replay requires array storage!")
+        if not (0 <= replay_fraction <= 1):
+            raise InvalidPlanningMode("replay_fraction must be between 0 and 1!")
+        self.replay_capacity = replay_capacity
+        self.replay_fraction = replay_fraction
+        self.replay_recency = replay_recency
+        self.replay_buffer = ReplayBuffer(replay_capacity) if replay_capacity > 0 else None
+
+        if self.planning == "prioritized":
+            # Pairs are only queued when their TD error is above this value
+            self.priority_threshold = priority_threshold
+            self._priority_queue = []
+            self._queued_priorities = {}
+            self._queue_counter = itertools.count()
+            # Pairs (state, action) that the model predicts lead to each state, as the keys of
+            # a dict so that they're iterated in insertion order. A set of pairs holding action
+            # strings would be iterated in an order that depends on the hash seed.
+            self._predecessors = {}
 
         if exploration not in ["epsilon", "decaying-epsilon", "ucb"]:
             raise InvalidExplorationMethod("Invalid exploration method!")
@@ -58,7 +231,9 @@ class DynaAgent:
             self.decay_eps_episodes = decay_eps_episodes
         if self.exploration == "ucb":
             self.ucb_c = ucb_c
-            self._counts_actions = {}
+            # sqrt(2 * log(episodes)) only changes between episodes, so it's cached
+            self._ucb_episode = None
+            self._ucb_scale = 0
 
         if alfa >= end_alfa >= 0:
             self.alfa = alfa
@@ -70,13 +245,88 @@ class DynaAgent:
         self.gamma = gamma
         self.episodes = 0
         self.steps = 0
+        self.episode_return = 0
+        self.planning_updates = 0
         self._build_state_action_pairs()
         self._initialize_model()
         self._initialize_qvalues()
-        self._seen_states = {}
+        if self.exploration == "ucb":
+            self._initialize_counts()
+        if self.storage == "array":
+            self._make_views()
+
+    def _random(self) -> float:
+        # Next uniform number in [0, 1) from the current block, drawing a new one when used up
+        if self._next_uniform == len(self._uniforms):
+            self._uniforms = self._rng.random(self._random_block_size).tolist()
+            self._next_uniform = 0
+        self._next_uniform += 1
+        return self._uniforms[self._next_uniform - 1]
+
+    def _choice(self, options):
+        # Uniform choice from a sequence, without drawing when there's only one option
+        if len(options) == 1:
+            return options[0]
+        return options[int(self._random() * len(options))]
+
+    def _make_views(self) -> None:
+        # Array storage keeps NumPy arrays for the vectorized paths, and flat memoryviews on
+        # them for the scalar ones, which then don't create a NumPy scalar per access. Pair
+        # (state, action) is at state * n_actions + action. Called again whenever the arrays
+        # are replaced.
+        self._n_actions = len(self._actions)
+        # Max Q-value of each state, 0 for terminal states, kept up to date by every write
+        # to the Q-values so that backups don't reduce over a row of the Q-table
+        self._state_values = np.where(self._terminal, 0.0, self._qvalues.max(axis=1))
+        self._state_values_view = memoryview(self._state_values)
+        self._qvalues_view = memoryview(self._qvalues.ravel())
+        self._seen_pairs_view = memoryview(self._seen_pairs.ravel())
+        self._model_seen_view = memoryview(self._model_seen.ravel())
+        if self.model == "deterministic":
+            self._model_rewards_view = memoryview(self._model_rewards.ravel())
+            self._model_next_states_view = memoryview(self._model_next_states.ravel())
+        if self.exploration == "ucb":
+            self._counts_actions_view = memoryview(self._counts_actions.ravel())
+            self._ucb_weights_view = memoryview(self._ucb_weights.ravel())
+
+    def _set_qvalue(self, state: int, action: int, value: float) -> None:
+        # Write one Q-value with array storage, updating the max of its state
+        index = state * self._n_actions + action
+        qvalues = self._qvalues_view
+        state_values = self._state_values_view
+        prev_value = qvalues[index]
+        qvalues[index] = value
+        if value >= state_values[state]:
+            state_values[state] = value
+        elif prev_value == state_values[state]:
+            # The max went down, so look for the new one in the row
+            first = index - action
+            state_values[state] = max(qvalues[first : first + self._n_actions])
+
+    def _refresh_state_values(self, states: np.ndarray) -> None:
+        # After a vectorized write to the Q-values of states, which can't be terminal
+        self._state_values[states] = self._qvalues[states].max(axis=1)
 
     def _build_state_action_pairs(self) -> None:
+        if (self.storage == "array") and hasattr(self.env, "compile_dynamics"):
+            # Valid actions come from the compiled action mask, states from its state ids,
+            # so there's no Python object per state or state-action pair
+            self.env.compile_dynamics()
+            action_mask = self.env.action_mask
+            self._actions = sorted(
+                action for i, action in enumerate(self.env.action_list) if action_mask[:, i].any()
+            )
+            self._action_ids = {action: i for i, action in enumerate(self._actions)}
+            columns = [self.env.action_ids[action] for action in self._actions]
+            # C order, so that the memoryviews on the Q-values don't end up on a copy
+            self._valid_actions = np.ascontiguousarray(action_mask[:, columns])
+            self._n_pairs = int(self._valid_actions.sum())
+            self._states = self.env.state_coords
+            self._state_ids = _StateIds(self.env.state_ids)
+            return
+
         self._states = self.env.get_all_possible_states()
+        self._state_ids = {state: i for i, state in enumerate(self._states)}
         self._state_action_pairs = []
         for state in self._states:
             actions = self.env.get_possible_actions(state)
@@ -84,17 +334,51 @@ class DynaAgent:
             for action in actions:
                 self._state_action_pairs.append((state, action))
 
-                if self.exploration == "ucb":
-                    self._counts_actions[(state, action)] = 1
-
         self._state_action_pairs.sort()
+        self._n_pairs = len(self._state_action_pairs)
+        self._actions = sorted(set(action for _, action in self._state_action_pairs))
+        self._action_ids = {action: i for i, action in enumerate(self._actions)}
+        if self.storage == "array":
+            self._valid_actions = np.zeros((len(self._states), len(self._actions)), dtype=bool)
+            for state, action in self._state_action_pairs:
+                self._valid_actions[self._state_ids[state], self._action_ids[action]] = True
 
     def _initialize_model(self) -> None:
+        if self.model == "stochastic":
+            # Up to max_outcomes observed (new_state, mean reward, count) per state-action pair
+            shape = (len(self._states), len(self._actions), self.max_outcomes)
+            self._outcome_next_states = np.full(shape, -1, dtype=np.int32)
+            self._outcome_rewards = np.zeros(shape, dtype=np.float64)
+            self._outcome_counts = np.zeros(shape, dtype=np.uint32)
+            self._model_seen = np.zeros(shape[:2], dtype=bool)
+            self._seen_pairs = np.empty((self._n_pairs, 2), dtype=np.int32)
+            self._n_seen_pairs = 0
+            return
+
+        if self.storage == "array":
+            # Last observed reward and next state of each state-action pair
+            shape = (len(self._states), len(self._actions))
+            self._model_rewards = np.zeros(shape, dtype=np.float64)
+            self._model_next_states = np.full(shape, -1, dtype=np.int32)
+            self._model_seen = np.zeros(shape, dtype=bool)
+            # Observed pairs in order of first visit, so planning samples one random index
+            self._seen_pairs = np.empty((self._n_pairs, 2), dtype=np.int32)
+            self._n_seen_pairs = 0
+            return
+
         self._model = {}
         for state_action in self._state_action_pairs:
             self._model[state_action] = None
+        self._seen_pairs = []
+        self._n_seen_pairs = 0
 
     def _initialize_qvalues(self) -> None:
+        if self.storage == "array":
+            # Invalid actions are masked with -inf so they're never the max
+            self._terminal = ~self._valid_actions.any(axis=1)
+            self._qvalues = np.where(self._valid_actions, 0.0, -np.inf)
+            return
+
         self._qvalues = {}
         for state in self._states:
             actions = self.env.get_possible_actions(state)
@@ -103,30 +387,301 @@ class DynaAgent:
                 for action in actions:
                     self._qvalues[state][action] = 0
 
-    def _update_qvalue(self, state, action, reward, new_state) -> None:
+    def _initialize_counts(self) -> None:
+        # Times each action has been played, laid out like the Q-values
+        if self.storage == "array":
+            self._counts_actions = np.ones(self._qvalues.shape, dtype=np.float64)
+            # 1 / sqrt(counts), updated only for the played action
+            self._ucb_weights = np.ones(self._qvalues.shape, dtype=np.float64)
+            return
+
+        self._counts_actions = {}
+        for state, qvalues in self._qvalues.items():
+            self._counts_actions[state] = {action: 1 for action in qvalues}
+
+    def _td_error(self, state, action, reward, new_state) -> float:
+        if self.storage == "array":
+            # State and actions are ids, see _state_ids and _action_ids
+            prev_qvalue = self._qvalues_view[state * self._n_actions + action]
+            max_value_new_state = self._state_values_view[new_state]
+            return reward + (self.gamma * max_value_new_state) - prev_qvalue
+
         prev_qvalue = self._qvalues[state][action]
         if new_state in self._qvalues:
             max_value_new_state = max(self._qvalues[new_state].values())
         else:
             # We're in a (possibly terminal) state that has no actions
             max_value_new_state = 0
-        td = reward + (self.gamma * max_value_new_state) - prev_qvalue
-        self._qvalues[state][action] = prev_qvalue + self.alfa * td
+        return reward + (self.gamma * max_value_new_state) - prev_qvalue
+
+    def _update_qvalue(self, state, action, reward, new_state) -> float:
+        td = self._td_error(state, action, reward, new_state)
+        if self.storage == "array":
+            index = state * self._n_actions + action
+            self._set_qvalue(state, action, self._qvalues_view[index] + self.alfa * td)
+        else:
+            self._qvalues[state][action] += self.alfa * td
+        return td
+
+    def _get_model(self, state, action) -> tuple:
+        if self.model == "stochastic":
+            return self._sample_outcome(state, action)
+        if self.storage == "array":
+            index = state * self._n_actions + action
+            return (self._model_rewards_view[index], self._model_next_states_view[index])
+        return self._model[(state, action)]
+
+    def _sample_outcome(self, state, action) -> tuple:
+        # Pick an outcome with probability proportional to its count
+        counts = self._outcome_counts[state, action]
+        cumulative = counts.cumsum()
+        slot = cumulative.searchsorted(self._random() * cumulative[-1], side="right")
+        return (
+            self._outcome_rewards[state, action, slot],
+            self._outcome_next_states[state, action, slot],
+        )
+
+    def _model_td_error(self, state, action) -> float:
+        # TD error of a pair according to the model, used by planning
+        if (self.model == "stochastic") and (self.model_backup == "expectation"):
+            counts = self._outcome_counts[state, action]
+            next_states = self._outcome_next_states[state, action]
+            # Empty slots (next state -1) have no weight
+            max_values_next_states = self._state_values[next_states]
+            targets = self._outcome_rewards[state, action] + self.gamma * max_values_next_states
+            return (counts * targets).sum() / counts.sum() - self._qvalues[state, action]
+
+        reward, new_state = self._get_model(state, action)
+        return self._td_error(state, action, reward, new_state)
+
+    def _update_outcome_model(self, state_action, reward, new_state) -> None:
+        next_states = self._outcome_next_states[state_action]
+        counts = self._outcome_counts[state_action]
+        matches = np.flatnonzero(next_states == new_state)
+        if len(matches) > 0:
+            slot = matches[0]
+        else:
+            # Take an empty slot, or evict the rarest outcome when all are used
+            slot = counts.argmin()
+            if (counts[slot] > 0) and (self.planning == "prioritized"):
+                self._predecessors[next_states[slot]].pop(state_action, None)
+            next_states[slot] = new_state
+            counts[slot] = 0
+            self._outcome_rewards[state_action][slot] = 0
+
+            if self.planning == "prioritized":
+                self._predecessors.setdefault(new_state, {})[state_action] = None
+
+        # Running mean of the rewards observed with this outcome
+        counts[slot] += 1
+        self._outcome_rewards[state_action][slot] += (
+            reward - self._outcome_rewards[state_action][slot]
+        ) / counts[slot]
+        self._model_seen[state_action] = True
 
     def _update_model(self, state_action, reward, new_state) -> None:
-        # IMPROVEMENT implement a non-deterministic model
-        # Keep track of last X observed new_states for each state_action pair,
-        # and define a probability distribution for transitioning to each one.
-        # Then in _do_planning sample the new state according to the distribution.
-        # This would be useful for environments that are non-deterministic.
+        if self.model == "stochastic":
+            self._update_outcome_model(state_action, reward, new_state)
+            return
+
+        if self.planning == "prioritized":
+            self._update_predecessors(state_action, new_state)
+
+        if self.storage == "array":
+            index = state_action[0] * self._n_actions + state_action[1]
+            self._model_rewards_view[index] = reward
+            self._model_next_states_view[index] = new_state
+            self._model_seen_view[index] = True
+            return
+
         self._model[state_action] = (reward, new_state)
 
-    def _do_planning(self, n_updates) -> None:
+    def _add_seen_pair(self, state, action) -> None:
+        # A pair is seen for the first time when it's not in the model yet
+        if self.storage == "array":
+            if not self._model_seen_view[state * self._n_actions + action]:
+                self._seen_pairs_view[2 * self._n_seen_pairs] = state
+                self._seen_pairs_view[2 * self._n_seen_pairs + 1] = action
+                self._n_seen_pairs += 1
+        elif self._model[(state, action)] is None:
+            self._seen_pairs.append((state, action))
+            self._n_seen_pairs += 1
+
+    def _update_predecessors(self, state_action, new_state) -> None:
+        if self.storage == "array":
+            index = state_action[0] * self._n_actions + state_action[1]
+            seen = self._model_seen_view[index]
+            old_new_state = self._model_next_states_view[index]
+        else:
+            seen = self._model[state_action] is not None
+            old_new_state = self._model[state_action][1] if seen else None
+
+        if seen and (old_new_state != new_state):
+            # The model no longer predicts the old new_state for this pair
+            self._predecessors[old_new_state].pop(state_action, None)
+
+        self._predecessors.setdefault(new_state, {})[state_action] = None
+
+    def _queue_pair(self, state, action, priority) -> None:
+        # Only keep the highest priority of each pair, older entries are skipped when popped
+        if (priority > self.priority_threshold) and (
+            priority > self._queued_priorities.get((state, action), 0)
+        ):
+            self._queued_priorities[(state, action)] = priority
+            heapq.heappush(
+                self._priority_queue, (-priority, next(self._queue_counter), state, action)
+            )
+
+    def _do_planning(self, n_updates) -> int:
+        # Returns the number of Q-values actually backed up
+        updates = 0
+        if (self.replay_buffer is not None) and (len(self.replay_buffer) > 0):
+            n_replay = round(n_updates * self.replay_fraction)
+            updates += self._do_replay(n_replay)
+            n_updates -= n_replay
+
+        if self.planning == "prioritized":
+            return updates + self._do_prioritized_planning(n_updates)
+        elif self.planning == "batched":
+            return updates + self._do_batched_planning(n_updates)
+        elif self.storage == "array":
+            return updates + self._do_array_planning(n_updates)
+
         for _ in range(n_updates):
-            state = random.choice(list(self._seen_states.keys()))
-            action = random.choice(list(self._seen_states[state]))
-            reward, new_state = self._model[(state, action)]
+            state, action = self._seen_pairs[int(self._random() * self._n_seen_pairs)]
+            reward, new_state = self._get_model(state, action)
             self._update_qvalue(state, action, reward, new_state)
+        return updates + n_updates
+
+    def _do_array_planning(self, n_updates) -> int:
+        # Uniform planning with array storage. Everything is read from the flat views, and
+        # with the deterministic model the backup of _update_qvalue and _set_qvalue is inlined,
+        # as this is the innermost loop of the agent
+        seen_pairs = self._seen_pairs_view
+        if self.model == "stochastic":
+            for _ in range(n_updates):
+                i = 2 * int(self._random() * self._n_seen_pairs)
+                self._plan_outcome_update(seen_pairs[i], seen_pairs[i + 1])
+            return n_updates
+
+        n_actions = self._n_actions
+        qvalues = self._qvalues_view
+        state_values = self._state_values_view
+        model_rewards = self._model_rewards_view
+        model_next_states = self._model_next_states_view
+        for _ in range(n_updates):
+            i = 2 * int(self._random() * self._n_seen_pairs)
+            state = seen_pairs[i]
+            action = seen_pairs[i + 1]
+            index = state * n_actions + action
+            prev_value = qvalues[index]
+            max_value_new_state = state_values[model_next_states[index]]
+            value = prev_value + self.alfa * (
+                model_rewards[index] + (self.gamma * max_value_new_state) - prev_value
+            )
+            qvalues[index] = value
+            if value >= state_values[state]:
+                state_values[state] = value
+            elif prev_value == state_values[state]:
+                first = index - action
+                state_values[state] = max(qvalues[first : first + n_actions])
+        return n_updates
+
+    def _plan_outcome_update(self, state, action) -> None:
+        index = state * self._n_actions + action
+        td = self._model_td_error(state, action)
+        self._set_qvalue(state, action, self._qvalues_view[index] + self.alfa * td)
+
+    def _first_occurrences(self, states, actions) -> np.ndarray:
+        # Index of the first occurrence of each distinct pair
+        _, first_occurrences = np.unique(states * len(self._actions) + actions, return_index=True)
+        return first_occurrences
+
+    def _do_replay(self, n_updates) -> int:
+        # Synchronous backup of a minibatch of real transitions from the replay buffer, each
+        # pair backed up once like in batched planning
+        if n_updates == 0:
+            return 0
+
+        batch = self.replay_buffer.sample(n_updates, self._rng, self.replay_recency)
+        batch = batch[self._first_occurrences(batch["state"], batch["action"])]
+        states = batch["state"]
+        actions = batch["action"]
+        new_states = batch["next_state"]
+
+        targets = batch["reward"] + (self.gamma * self._state_values[new_states])
+        prev_qvalues = self._qvalues[states, actions]
+        self._qvalues[states, actions] = prev_qvalues + self.alfa * (targets - prev_qvalues)
+        self._refresh_state_values(states)
+        return len(states)
+
+    def _do_batched_planning(self, n_updates) -> int:
+        # Synchronous sweep over a minibatch of n_updates pairs sampled with replacement:
+        # every target uses the Q-values from before the batch. A pair sampled more than
+        # once is backed up only once, with its first occurrence in the batch.
+        if (n_updates == 0) or (self._n_seen_pairs == 0):
+            return 0
+
+        indices = self._rng.integers(0, self._n_seen_pairs, size=n_updates)
+        pairs = self._seen_pairs[indices]
+        first_occurrences = self._first_occurrences(pairs[:, 0], pairs[:, 1])
+        states = pairs[first_occurrences, 0]
+        actions = pairs[first_occurrences, 1]
+
+        if self.model == "stochastic":
+            targets = self._batched_outcome_targets(states, actions)
+        else:
+            rewards = self._model_rewards[states, actions]
+            new_states = self._model_next_states[states, actions]
+            targets = rewards + (self.gamma * self._state_values[new_states])
+        prev_qvalues = self._qvalues[states, actions]
+        td = targets - prev_qvalues
+        self._qvalues[states, actions] = prev_qvalues + self.alfa * td
+        self._refresh_state_values(states)
+        return len(states)
+
+    def _batched_outcome_targets(self, states, actions) -> np.ndarray:
+        counts = self._outcome_counts[states, actions]
+        next_states = self._outcome_next_states[states, actions]
+        rewards = self._outcome_rewards[states, actions]
+        # Empty slots (next state -1) have no weight
+        targets = rewards + (self.gamma * self._state_values[next_states])
+        totals = counts.sum(axis=1)
+
+        if self.model_backup == "expectation":
+            return (counts * targets).sum(axis=1) / totals
+
+        # One outcome per pair, with probability proportional to its count
+        cumulative = counts.cumsum(axis=1)
+        uniforms = self._rng.random(len(states)) * totals
+        slots = (cumulative <= uniforms[:, None]).sum(axis=1)
+        return targets[np.arange(len(states)), slots]
+
+    def _do_prioritized_planning(self, n_updates) -> int:
+        # Back up the pairs with the largest TD error first, then queue their predecessors
+        updates = 0
+        while (updates < n_updates) and (len(self._priority_queue) > 0):
+            neg_priority, _, state, action = heapq.heappop(self._priority_queue)
+            if self._queued_priorities.get((state, action)) != -neg_priority:
+                # Stale entry, the pair was queued again with a higher priority
+                continue
+            del self._queued_priorities[(state, action)]
+
+            if self.model == "stochastic":
+                self._plan_outcome_update(state, action)
+            else:
+                reward, new_state = self._get_model(state, action)
+                self._update_qvalue(state, action, reward, new_state)
+            updates += 1
+
+            for prev_state, prev_action in self._predecessors.get(state, ()):
+                if self.model == "stochastic":
+                    priority = abs(self._model_td_error(prev_state, prev_action))
+                else:
+                    prev_reward, _ = self._get_model(prev_state, prev_action)
+                    priority = abs(self._td_error(prev_state, prev_action, prev_reward, state))
+                self._queue_pair(prev_state, prev_action, priority)
+        return updates
 
     def _update_epsilon(self):
         # Decay epsilon to 0 after decay_eps_episodes
@@ -141,15 +696,23 @@ class DynaAgent:
             self.alfa = r * (self.alfa - self.end_alfa) + self.end_alfa
 
     def _get_e_greedy_action(self) -> str:
-        actions = self.env.get_possible_actions(self.current_state)
-
-        if np.random.uniform() <= self.epsilon:
+        if self._random() <= self.epsilon:
             # Play randomly
-            action = random.choice(actions)
+            action = self._choice(self.env.get_possible_actions(self.current_state))
+        elif self.storage == "array":
+            # Play greedy, breaking ties randomly
+            state_id = self._state_ids[self.current_state]
+            first = state_id * self._n_actions
+            max_value = self._state_values_view[state_id]
+            qvalues = self._qvalues_view
+            action_id = self._choice(
+                [i for i in range(self._n_actions) if qvalues[first + i] == max_value]
+            )
+            action = self._actions[action_id]
         else:
             # Play greedy
             max_value = max(self._qvalues[self.current_state].values())
-            action = random.choice(
+            action = self._choice(
                 [
                     key
                     for key, value in self._qvalues[self.current_state].items()
@@ -160,25 +723,42 @@ class DynaAgent:
         return action
 
     def _get_ucb_action(self) -> str:
-        actions = self.env.get_possible_actions(self.current_state)
+        if self._ucb_episode != self.episodes:
+            self._ucb_episode = self.episodes
+            self._ucb_scale = math.sqrt(2 * math.log(self.episodes))
 
-        adjusted_qvalues = {}
-        for action in actions:
-            # Get current qvalue
-            adjusted_qvalues[action] = self._qvalues[self.current_state][action]
-
-            # Add exploration bonus based on current round and times the action has been played
-            times_played = self._counts_actions[(self.current_state, action)]
-            adjusted_qvalues[action] += self.ucb_c * math.sqrt(
-                2 * math.log(self.episodes) / times_played
-            )
+        # Exploration bonus based on current round and times the action has been played
+        bonus_scale = self.ucb_c * self._ucb_scale
+        if self.storage == "array":
+            first = self._state_ids[self.current_state] * self._n_actions
+            qvalues = self._qvalues_view
+            weights = self._ucb_weights_view
+            # Invalid actions stay at -inf after adding the bonus, so any valid action is better
+            max_value = -math.inf
+            best_actions = []
+            for i in range(self._n_actions):
+                value = qvalues[first + i] + weights[first + i] * bonus_scale
+                if value > max_value:
+                    max_value = value
+                    best_actions = [i]
+                elif value == max_value:
+                    best_actions.append(i)
+            action_id = self._choice(best_actions)
+            count = self._counts_actions_view[first + action_id] + 1
+            self._counts_actions_view[first + action_id] = count
+            weights[first + action_id] = 1 / math.sqrt(count)
+            return self._actions[action_id]
 
+        counts = self._counts_actions[self.current_state]
+        adjusted_qvalues = {
+            action: value + bonus_scale / math.sqrt(counts[action])
+            for action, value in self._qvalues[self.current_state].items()
+        }
         max_value = max(adjusted_qvalues.values())
-        action = random.choice(
+        action = self._choice(
             [key for key, value in adjusted_qvalues.items() if value == max_value]
         )
-
-        self._counts_actions[(self.current_state, action)] += 1
+        counts[action] += 1
 
         return action
 
@@ -193,20 +773,26 @@ class DynaAgent:
 
     def init_round(self, method: str = None, state=None) -> None:
         self.steps = 0
+        self.episode_return = 0
+        self.planning_updates = 0
         self.episodes += 1
         self._initialize_env(method=method, state=state)
 
     def reset_agent(self) -> None:
+        # Same constructor arguments as a checkpoint, so that none of them is lost
         self.__init__(
             env=self.env,
-            exploration=self.exploration,
-            epsilon=self.epsilon,
-            decay_eps_episodes=self.decay_eps_episodes,
-            alfa=self.alfa,
-            gamma=self.gamma,
+            random_block_size=self._random_block_size,
+            **{name: getattr(self, name) for name in _CHECKPOINT_ARGS if hasattr(self, name)},
         )
 
-    def play_step(self, n_updates: int = 10, verbose: bool = False) -> None:
+    def play_step(self, n_updates: int = 10, verbose: bool = False) -> tuple:
+        # Returns the transition (state, action, reward, new_state, td_error) of the step
+        state = self.current_state
+        profiler = self.profiler
+        if profiler is not None:
+            lap_start = time.perf_counter()
+
         # Get an action according to the strategy being used
         if self.exploration in ["epsilon", "decaying-epsilon"]:
             action = self._get_e_greedy_action()
@@ -215,25 +801,51 @@ class DynaAgent:
         else:
             raise InvalidExplorationMethod("Invalid exploration method!")
 
-        # Update seen states and actions taken
-        if self.current_state in self._seen_states:
-            self._seen_states[self.current_state].update(action)
+        # Q-values and model are indexed by ids when using array storage
+        if self.storage == "array":
+            state_key = self._state_ids[self.current_state]
+            action_key = self._action_ids[action]
         else:
-            self._seen_states[self.current_state] = set([action])
+            state_key = self.current_state
+            action_key = action
+
+        self._add_seen_pair(state_key, action_key)
 
         if verbose:
             print(action)
 
+        if profiler is not None:
+            lap_start = profiler.lap("action_selection", lap_start)
         reward, new_state = self.env.take_action(action)
+        if self.storage == "array":
+            new_state = self._state_ids[new_state]
+        if profiler is not None:
+            lap_start = profiler.lap("take_action", lap_start)
 
-        self._update_qvalue(self.current_state, action, reward, new_state)
-        self._update_model((self.current_state, action), reward, new_state)
+        if self.planning == "prioritized":
+            priority = abs(self._td_error(state_key, action_key, reward, new_state))
+            self._queue_pair(state_key, action_key, priority)
+
+        td = self._update_qvalue(state_key, action_key, reward, new_state)
+        if profiler is not None:
+            lap_start = profiler.lap("q_update", lap_start)
+        self._update_model((state_key, action_key), reward, new_state)
+        if self.replay_buffer is not None:
+            self.replay_buffer.add(state_key, action_key, reward, new_state)
         self.current_state = self.env.current_state
         self.current_cell = self.env.current_cell
+        if profiler is not None:
+            lap_start = profiler.lap("model_update", lap_start)
 
-        self._do_planning(n_updates)
+        n_planning_updates = self._do_planning(n_updates)
+        self.planning_updates += n_planning_updates
+        if profiler is not None:
+            profiler.lap("planning", lap_start)
+            profiler.count("planning_updates", n_planning_updates)
+            profiler.set("seen_pairs", self._n_seen_pairs)
 
         self.steps += 1
+        self.episode_return += reward
 
         if self.current_cell == "G":
             # Epsiode finished, do some updates
@@ -242,9 +854,346 @@ class DynaAgent:
             if self.exploration == "decaying-epsilon":
                 self._update_epsilon()
 
+        writer = self.trajectory_writer
+        if writer is not None:
+            writer.append(
+                self.episodes,
+                self._state_ids[state],
+                writer.action_ids[action],
+                reward,
+                self._state_ids[self.current_state],
+            )
+
+        return (state, action, reward, self.current_state, td)
+
     def finished(self) -> bool:
         return self.current_cell == "G"
 
+    def enable_profiling(self, profiler: Profiler = None) -> Profiler:
+        """
+        Record the time and calls of each phase of play_step (action_selection, take_action,
+        q_update, model_update, planning), the planning updates and the number of distinct seen
+        pairs. The environment shares the profiler when it supports profiling, and its
+        env.take_action phase is reported inside take_action. Returns the profiler, whose
+        snapshot() and report() show the measurements.
+        """
+        self.profiler = profiler if profiler is not None else Profiler()
+        if hasattr(self.env, "enable_profiling"):
+            self.env.enable_profiling(self.profiler)
+            self.profiler.nest("env.take_action", "take_action")
+        return self.profiler
+
+    def disable_profiling(self) -> None:
+        self.profiler = None
+        if hasattr(self.env, "disable_profiling"):
+            self.env.disable_profiling()
+
+    def enable_trajectory_log(self, writer) -> None:
+        """
+        Append every real step played by play_step to writer, a TrajectoryWriter whose actions
+        include the ones of the agent, with agent.episodes as the episode id.
+        """
+        self.trajectory_writer = writer
+
+    def disable_trajectory_log(self) -> None:
+        self.trajectory_writer = None
+
+    def run_episodes(
+        self,
+        n_episodes: int,
+        init_method: str = "default",
+        n_updates: int = 10,
+        max_steps: int = None,
+        callback=None,
+        callback_every: int = 1,
+    ) -> dict:
+        """
+        Play n_episodes full episodes, stopping an episode early after max_steps steps if
+        given. Returns a dict of per-episode arrays: steps, returns (sum of rewards), wall_time
+        (seconds) and planning_updates (Q-values backed up by planning). If given,
+        callback(agent, episodes_done, results) is called every callback_every episodes, with
+        the results of the episodes played so far.
+        """
+        results = {
+            "steps": np.zeros(n_episodes, dtype=np.int64),
+            "returns": np.zeros(n_episodes, dtype=np.float64),
+            "wall_time": np.zeros(n_episodes, dtype=np.float64),
+            "planning_updates": np.zeros(n_episodes, dtype=np.int64),
+        }
+        if max_steps is None:
+            max_steps = math.inf
+        play_step = self.play_step
+
+        for i in range(n_episodes):
+            start = time.perf_counter()
+            self.init_round(method=init_method)
+            while (self.current_cell != "G") and (self.steps < max_steps):
+                play_step(n_updates)
+
+            results["wall_time"][i] = time.perf_counter() - start
+            results["steps"][i] = self.steps
+            results["returns"][i] = self.episode_return
+            results["planning_updates"][i] = self.planning_updates
+
+            if (callback is not None) and ((i + 1) % callback_every == 0):
+                callback(self, i + 1, {key: values[: i + 1] for key, values in results.items()})
+
+        return results
+
+    def iter_steps(
+        self,
+        n_episodes: int = None,
+        init_method: str = "default",
+        n_updates: int = 10,
+        max_steps: int = None,
+    ):
+        """
+        Generator that plays episodes like run_episodes, lazily yielding a StepRecord after every
+        step and an EpisodeRecord after the last step of each episode (done is also True in that
+        StepRecord). Plays forever if n_episodes is None, so consumers stop it by breaking out.
+        Nothing is kept between records, so memory doesn't grow with the number of steps.
+        """
+        if max_steps is None:
+            max_steps = math.inf
+        play_step = self.play_step
+
+        episode = 0
+        while (n_episodes is None) or (episode < n_episodes):
+            self.init_round(method=init_method)
+            done = False
+            while not done:
+                state, action, reward, new_state, td = play_step(n_updates)
+                done = (self.current_cell == "G") or (self.steps >= max_steps)
+                yield StepRecord(
+                    self.episodes, self.steps, state, action, reward, new_state, float(td), done
+                )
+            yield EpisodeRecord(
+                self.episodes,
+                self.steps,
+                self.episode_return,
+                self.planning_updates,
+                self.current_cell == "G",
+            )
+            episode += 1
+
+    def save_checkpoint(self, path: str) -> None:
+        """
+        Save Q-values, model, seen-pair index, UCB counts, priority queue, replay buffer and
+        schedule state to the directory path, as one .npy file per array plus agent.json. Dict
+        storage is saved in the array layout, indexed by the ids of the sorted states and actions.
+        The files are written to a sibling directory that then replaces path, so overwriting the
+        checkpoint an agent was memory-mapped from is safe.
+        """
+        path = os.path.normpath(path)
+        new_path = f"{path}.tmp"
+        shutil.rmtree(new_path, ignore_errors=True)
+        os.makedirs(new_path)
+        for name, values in self._checkpoint_arrays().items():
+            np.save(os.path.join(new_path, f"{name}.npy"), values)
+
+        agent_state = {
+            "version": _CHECKPOINT_FORMAT_VERSION,
+            "args": {name: getattr(self, name) for name in _CHECKPOINT_ARGS if hasattr(self, name)},
+            "random_block_size": self._random_block_size,
+            "start_epsilon": getattr(self, "start_epsilon", None),
+            "episodes": self.episodes,
+            "n_seen_pairs": self._n_seen_pairs,
+            "replay_position": getattr(self.replay_buffer, "position", None),
+            "replay_size": getattr(self.replay_buffer, "size", None),
+            "actions": self._actions,
+            "rng_state": self._rng.bit_generator.state,
+        }
+        with open(os.path.join(new_path, "agent.json"), "w") as agent_file:
+            json.dump(agent_state, agent_file)
+
+        # Mapped files of a previous checkpoint stay valid after it's renamed and removed
+        if os.path.exists(path):
+            old_path = f"{path}.old"
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(path, old_path)
+            os.replace(new_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(new_path, path)
+
+    def _checkpoint_arrays(self) -> dict:
+        shape = (len(self._states), len(self._actions))
+        arrays = {
+            "states": np.array(self._states, dtype=np.int32).reshape(-1, 2),
+            "uniforms": np.array(self._uniforms[self._next_uniform :], dtype=np.float64),
+        }
+
+        if self.storage == "array":
+            arrays["qvalues"] = self._qvalues
+            arrays["seen_pairs"] = self._seen_pairs
+        else:
+            arrays["qvalues"] = np.full(shape, -np.inf)
+            for state, qvalues in self._qvalues.items():
+                for action, value in qvalues.items():
+                    arrays["qvalues"][self._state_ids[state], self._action_ids[action]] = value
+            arrays["seen_pairs"] = np.zeros((self._n_pairs, 2), dtype=np.int32)
+            for i, (state, action) in enumerate(self._seen_pairs):
+                arrays["seen_pairs"][i] = (self._state_ids[state], self._action_ids[action])
+
+        if self.model == "stochastic":
+            arrays["outcome_next_states"] = self._outcome_next_states
+            arrays["outcome_rewards"] = self._outcome_rewards
+            arrays["outcome_counts"] = self._outcome_counts
+            arrays["model_seen"] = self._model_seen
+        elif self.storage == "array":
+            arrays["model_rewards"] = self._model_rewards
+            arrays["model_next_states"] = self._model_next_states
+            arrays["model_seen"] = self._model_seen
+        else:
+            arrays["model_rewards"] = np.zeros(shape, dtype=np.float64)
+            arrays["model_next_states"] = np.full(shape, -1, dtype=np.int32)
+            arrays["model_seen"] = np.zeros(shape, dtype=bool)
+            for (state, action), outcome in self._model.items():
+                if outcome is not None:
+                    key = (self._state_ids[state], self._action_ids[action])
+                    arrays["model_rewards"][key] = outcome[0]
+                    arrays["model_next_states"][key] = self._state_ids[outcome[1]]
+                    arrays["model_seen"][key] = True
+
+        if self.exploration == "ucb":
+            if self.storage == "array":
+                arrays["counts_actions"] = self._counts_actions
+            else:
+                arrays["counts_actions"] = np.ones(shape, dtype=np.float64)
+                for state, counts in self._counts_actions.items():
+                    for action, times_played in counts.items():
+                        arrays["counts_actions"][
+                            self._state_ids[state], self._action_ids[action]
+                        ] = times_played
+
+        if self.replay_buffer is not None:
+            arrays["replay"] = self.replay_buffer.data
+
+        if self.planning == "prioritized":
+            queued = list(self._queued_priorities.items())
+            if self.storage == "array":
+                pairs = [pair for pair, _ in queued]
+            else:
+                pairs = [(self._state_ids[s], self._action_ids[a]) for (s, a), _ in queued]
+            arrays["queue_pairs"] = np.array(pairs, dtype=np.int32).reshape(-1, 2)
+            arrays["queue_priorities"] = np.array([p for _, p in queued], dtype=np.float64)
+
+        return arrays
+
+    @classmethod
+    def load_checkpoint(cls, env: Environment, path: str, mmap_mode: str = None) -> "DynaAgent":
+        """
+        Build an agent for env from a directory written by save_checkpoint. With array storage
+        and mmap_mode ("r", "r+" or "c", see np.load) the Q-values, model and counts are
+        memory-mapped instead of read, so restoring doesn't copy them and read-only workers
+        share the same pages. Use "c" (copy-on-write) to keep training from a shared checkpoint.
+        """
+        agent_path = os.path.join(path, "agent.json")
+        if not os.path.exists(agent_path):
+            raise InvalidCheckpoint(f"No complete checkpoint in {path}")
+        with open(agent_path) as agent_file:
+            agent_state = json.load(agent_file)
+        if agent_state["version"] != _CHECKPOINT_FORMAT_VERSION:
+            raise InvalidCheckpoint("Checkpoint written by an incompatible version!")
+
+        agent = cls(env, random_block_size=agent_state["random_block_size"], **agent_state["args"])
+        states = np.load(os.path.join(path, "states.npy"))
+        if (agent._actions != agent_state["actions"]) or (
+            not np.array_equal(states, np.array(agent._states, dtype=np.int32).reshape(-1, 2))
+        ):
+            raise InvalidCheckpoint("Checkpoint doesn't match the environment!")
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        agent._restore_checkpoint_arrays(load, agent_state["n_seen_pairs"])
+        if agent.replay_buffer is not None:
+            agent.replay_buffer.data = load("replay")
+            agent.replay_buffer.position = agent_state["replay_position"]
+            agent.replay_buffer.size = agent_state["replay_size"]
+        if agent_state["start_epsilon"] is not None:
+            agent.start_epsilon = agent_state["start_epsilon"]
+        agent.episodes = agent_state["episodes"]
+        agent._rng.bit_generator.state = agent_state["rng_state"]
+        agent._uniforms = np.load(os.path.join(path, "uniforms.npy")).tolist()
+        agent._next_uniform = 0
+        return agent
+
+    def _restore_checkpoint_arrays(self, load, n_seen_pairs) -> None:
+        qvalues = load("qvalues")
+        seen_pairs = load("seen_pairs")
+        self._n_seen_pairs = n_seen_pairs
+
+        if self.storage == "array":
+            self._qvalues = qvalues
+            self._seen_pairs = seen_pairs
+        else:
+            for state, state_qvalues in self._qvalues.items():
+                for action in state_qvalues:
+                    state_qvalues[action] = float(
+                        qvalues[self._state_ids[state], self._action_ids[action]]
+                    )
+            self._seen_pairs = [
+                (self._states[state], self._actions[action])
+                for state, action in seen_pairs[:n_seen_pairs].tolist()
+            ]
+
+        if self.model == "stochastic":
+            self._outcome_next_states = load("outcome_next_states")
+            self._outcome_rewards = load("outcome_rewards")
+            self._outcome_counts = load("outcome_counts")
+            self._model_seen = load("model_seen")
+        elif self.storage == "array":
+            self._model_rewards = load("model_rewards")
+            self._model_next_states = load("model_next_states")
+            self._model_seen = load("model_seen")
+        else:
+            rewards = load("model_rewards")
+            next_states = load("model_next_states")
+            for state, action in self._seen_pairs:
+                key = (self._state_ids[state], self._action_ids[action])
+                self._model[(state, action)] = (
+                    rewards[key].item(),
+                    self._states[next_states[key]],
+                )
+
+        if self.exploration == "ucb":
+            counts = load("counts_actions")
+            if self.storage == "array":
+                self._counts_actions = counts
+                self._ucb_weights = 1 / np.sqrt(counts)
+            else:
+                for state, state_counts in self._counts_actions.items():
+                    for action in state_counts:
+                        state_counts[action] = counts[
+                            self._state_ids[state], self._action_ids[action]
+                        ].item()
+
+        if self.storage == "array":
+            self._make_views()
+
+        if self.planning == "prioritized":
+            # Predecessors follow from the model, only the queue itself is stored
+            for state, action in self._seen_pairs[: self._n_seen_pairs]:
+                if self.storage == "array":
+                    state, action = int(state), int(action)
+                if self.model == "stochastic":
+                    outcomes = self._outcome_next_states[state, action]
+                    new_states = outcomes[self._outcome_counts[state, action] > 0].tolist()
+                else:
+                    new_states = [self._get_model(state, action)[1]]
+                    if self.storage == "array":
+                        new_states = [int(new_states[0])]
+                for new_state in new_states:
+                    self._predecessors.setdefault(new_state, {})[(state, action)] = None
+
+            for (state, action), priority in zip(
+                load("queue_pairs").tolist(), load("queue_priorities").tolist()
+            ):
+                if self.storage == "dict":
+                    state, action = self._states[state], self._actions[action]
+                self._queue_pair(state, action, priority)
+
 
 # IMPROVEMENT
 # Define properties, getter, setter, etc.
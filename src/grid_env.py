@@ -1,374 +1,1143 @@
-from typing import Tuple
-import random
-import re
-
-try:
-    from base_env import Environment  # Works with normal code
-except ModuleNotFoundError:
-    from src.base_env import Environment  # Works when called from unittest
-
-
-class InvalidGridError(Exception):
-    """
-    Raised when:
-     - The input grid has more than one 'S' or 'G' cell
-     - The input grid has a row with no elements
-     - The input grid has an invalid line (not starting with '|' or '-')
-     - There are cells with invalid characters (not 'S', 'G', 'X', '.')
-     - Rows have different lengths
-    """
-
-    pass
-
-
-class InvalidActionError(Exception):
-    """
-    Raised when:
-     - The input grid has an action that is not 'L', 'R', 'U', 'D'
-     - The action taken is not valid for the current state
-    """
-
-    pass
-
-
-class InvalidStateError(Exception):
-    """
-    Raised when:
-     - Trying to set a state that is not within the grid
-     - Trying to set a state with an invalid value passed (not tuple, not ints, etc.)
-    """
-
-    pass
-
-
-class InvalidRewardConfigError(Exception):
-    """
-    Raised when:
-     - A reward in the config file doesn't match the default reward format
-     - A reward in the config file doesn't match the custom reward format
-     - A reward in the config file specifies a state that is off grid
-    """
-
-    pass
-
-
-class InvalidTransitionConfigError(Exception):
-    """
-    Raised when:
-     - A custom transition in the config file doesn't match the format
-    """
-
-    pass
-
-
-class IlegalCellChangeError(Exception):
-    """
-    Raised when trying to change the current cell from outside the class
-    """
-
-    pass
-
-
-class IlegalStateChangeError(Exception):
-    """
-    Raised when trying to change the current state from outside the class
-    """
-
-    pass
-
-
-class Gridworld(Environment):
-    _VALID_GRID_CHARS = set(["S", "G", "X", "."])
-    _VALID_ACTIONS = set(["L", "R", "U", "D"])
-    _PATTERN_DEFAULT_REWARD = r"DEFAULT = (-{0,1}\d+)"
-    _ACTIONS_FOR_REGEX = "[" + "".join(_VALID_ACTIONS) + "]"
-    _PATTERN_CUSTOM_REWARD = r"(\d+,\d+-" + _ACTIONS_FOR_REGEX + r") = (-{0,1}\d+)"
-    _PATTERN_CUSTOM_TRANSITION = (
-        r"(\d+,\d+-" + _ACTIONS_FOR_REGEX + r")-(\d+,\d+) = (-{0,1}\d+|DEFAULT)"
-    )
-
-    def __init__(self, input_grid_path: str, input_rules_path: str) -> None:
-        self._default_start_state = None
-        self._current_state = None
-        self._current_cell = None
-        self._goal_state = None
-        self._load_grid(input_grid_path)
-        self._load_rules(input_rules_path)
-        self._define_dynamics()
-        self._validate_custom_rewards()
-
-    def _load_grid(self, grid_path: str) -> None:
-        self.grid = []
-
-        with open(grid_path, "r") as grid_file:
-            lines = grid_file.readlines()
-
-        s_seen = 0
-        g_seen = 0
-        col_max = 0
-        row = 0
-        for line in lines:
-            line = line.rstrip()
-
-            if line.startswith("|") and line.endswith("|"):
-                self.grid.append([])
-                cells = line.split("|")
-                cells = cells[1:-1]
-
-                col = 0
-                for cell in cells:
-                    if cell.upper() not in self._VALID_GRID_CHARS:
-                        raise InvalidGridError("The input grid has cells with invalid characters!")
-
-                    if cell.upper() == "S":
-                        s_seen += 1
-                        self._default_start_state = (row, col)
-                    elif cell.upper() == "G":
-                        g_seen += 1
-                        self._goal_state = (row, col)
-
-                    self.grid[row].append(cell)
-                    col += 1
-
-                if col_max != 0:
-                    if col != col_max:
-                        raise InvalidGridError("The input grid has rows of different lenghts!")
-                elif col > 0:
-                    col_max = col
-                else:
-                    raise InvalidGridError("The grid has a row with no elements")
-
-                row += 1
-
-            elif not line.startswith("-"):
-                raise InvalidGridError(f"The grid has an invalid line:\n{line}")
-
-        self.row_num = len(self.grid)
-        self.column_num = len(self.grid[0])
-
-        if (s_seen != 1) or (g_seen != 1):
-            raise InvalidGridError("The input grid has invalid amount of 'S' or 'G' cell!")
-
-    def _load_rules(self, rules_path: str) -> None:
-        with open(rules_path, "r") as rules_file:
-            lines = rules_file.readlines()
-
-        self.actions = set()
-        self.custom_rewards = {}
-        self.custom_transitions = {}
-        current_section = None
-
-        for line in lines:
-            line = line.rstrip()
-            line = line.split("#")[0].strip()  # Remove comments
-
-            if line.startswith("["):
-                current_section = line[1:-1]
-
-            elif line != "":
-                if current_section == "ACTIONS":
-                    if line in self._VALID_ACTIONS:
-                        self.actions.add(line)
-                    else:
-                        raise InvalidActionError(f"Invalid action: {line}")
-
-                elif current_section == "REWARDS":
-                    match_default_reward = re.match(self._PATTERN_DEFAULT_REWARD, line)
-                    match_custom_reward = re.match(self._PATTERN_CUSTOM_REWARD, line)
-
-                    if match_default_reward:
-                        self.default_reward = int(match_default_reward.groups()[0])
-
-                    elif match_custom_reward:
-                        state_action = match_custom_reward.groups()[0]
-                        reward = int(match_custom_reward.groups()[1])
-                        self.custom_rewards[state_action] = reward
-
-                    else:
-                        raise InvalidRewardConfigError(f"Invalid reward: {line}")
-
-                elif current_section == "TRANSITIONS":
-                    match_custom_transition = re.match(self._PATTERN_CUSTOM_TRANSITION, line)
-                    if match_custom_transition:
-                        state_action = match_custom_transition.groups()[0]
-                        result_state = match_custom_transition.groups()[1]
-                        reward = match_custom_transition.groups()[2]
-                        if reward == "DEFAULT":
-                            reward = self.default_reward
-                        else:
-                            reward = int(reward)
-                        self.custom_transitions[state_action] = (result_state, reward)
-                    else:
-                        raise InvalidTransitionConfigError(f"Invalid transition: {line}")
-
-    def _add_transitions_to_cell(self, row: int, column: int) -> None:
-        for action in self.actions:
-            # Check if there is a custom reward for this state-action pair
-            try:
-                reward = self.custom_rewards[f"{row},{column}-{action}"]
-            except KeyError:
-                reward = self.default_reward
-
-            # Check what lies ahead
-            h_offset = 0
-            v_offset = 0
-            if action == "L":
-                h_offset = -1
-            elif action == "R":
-                h_offset = 1
-            elif action == "U":
-                v_offset = -1
-            elif action == "D":
-                v_offset = 1
-            next_col = column + h_offset
-            next_row = row + v_offset
-
-            # Check if there is a custom transition for this state-action pair
-            try:
-                result_state, reward = self.custom_transitions[f"{row},{column}-{action}"]
-                next_row = int(result_state.split(",")[0])
-                next_col = int(result_state.split(",")[1])
-            except KeyError:
-                pass
-
-            if (0 <= next_row < self.row_num) and (0 <= next_col < self.column_num):
-                if self.grid[next_row][next_col] in [".", "S", "G"]:
-                    # Add transition to new state
-                    self.transitions[row][column][action] = (next_row, next_col, reward)
-
-                elif self.grid[next_row][next_col] == "X":
-                    # Moving to an X, stay in same state
-                    self.transitions[row][column][action] = (row, column, reward)
-
-            else:
-                # Going off grid, stay in same state
-                self.transitions[row][column][action] = (row, column, reward)
-
-    def _define_dynamics(self) -> None:
-        # IMPROVEMENT instead of defining all transitions (memory intensive),
-        # could compute them on the fly depending on action selected.
-        # Careful with custom transitions though.
-
-        self.transitions = {}
-
-        for row in range(self.row_num):
-            for column in range(self.column_num):
-                if row not in self.transitions:
-                    self.transitions[row] = {}
-                if column not in self.transitions[row]:
-                    self.transitions[row][column] = {}
-
-                if self.grid[row][column] in [".", "S"]:
-                    self._add_transitions_to_cell(row, column)
-
-                else:
-                    # No action for 'X' or 'G' states
-                    pass
-
-    def _validate_custom_rewards(self) -> None:
-        for state_action in self.custom_rewards.keys():
-            # No need to validate action because it was already done in the regex matching
-            state, _ = state_action.split("-")
-            row, column = [int(x) for x in state.split(",")]
-
-            if (row < 0) or (row >= self.row_num) or (column < 0) or (column >= self.column_num):
-                raise InvalidRewardConfigError(
-                    f"Invalid reward due to state off grid: {state_action}"
-                )
-
-    def print_grid(self) -> None:
-        print("-" * (self.column_num * 2 + 1))
-        for row in self.grid:
-            row_str = "|"
-            for cell in row:
-                row_str += f"{cell}|"
-            print(row_str)
-        print("-" * (self.column_num * 2 + 1))
-
-    def _change_state_and_cell(self, state: Tuple[int, int]) -> None:
-        self._current_state = state
-        self._current_cell = self.grid[state[0]][state[1]]
-
-    def initialize(
-        self, method: str = None, state: Tuple[int, int] = None
-    ) -> Tuple[Tuple[int, int], str]:
-        if method == "default":
-            self._change_state_and_cell(self._default_start_state)
-
-        elif method == "random":
-            # Avoid 'X' and 'G'
-            row = None
-            column = None
-            while (row is None) or (column is None) or (self.grid[row][column] not in [".", "S"]):
-                row = random.randint(0, self.row_num - 1)
-                column = random.randint(0, self.column_num - 1)
-            self._change_state_and_cell((row, column))
-
-        elif state is not None:
-            # Check it has the format: Tuple[int, int]
-            if (
-                (not isinstance(state, tuple))
-                or (len(state) != 2)
-                or (not isinstance(state[0], int))
-                or (not isinstance(state[1], int))
-            ):
-                raise InvalidStateError("Invalid state passed!")
-
-            # Check state is within grid and is not an 'X' or 'G'
-            if (0 <= state[0] < self.row_num) and (0 <= state[1] < self.column_num):
-                if self.grid[state[0]][state[1]] in [".", "S"]:
-                    self._change_state_and_cell(state)
-                else:
-                    raise InvalidStateError("State needs to be a cell with '.' or 'S'")
-            else:
-                raise InvalidStateError("State not within grid!")
-
-        return (self.current_state, self.current_cell)
-
-    def get_possible_actions(self, state: Tuple[int, int] = None) -> list:
-        if state is not None:
-            # Use argument state
-            if (0 <= state[0] < self.row_num) and (0 <= state[1] < self.column_num):
-                row, column = state
-            else:
-                raise InvalidStateError("State not within grid!")
-        else:
-            # Use current state
-            row, column = self.current_state
-        return list(self.transitions[row][column].keys())
-
-    def get_all_possible_states(self) -> list[Tuple[int, int]]:
-        states = []
-        for row in range(self.row_num):
-            for column in range(self.column_num):
-                # 'X' states are not allowed
-                if self.grid[row][column] in ["S", ".", "G"]:
-                    states.append((row, column))
-
-        return states
-
-    def take_action(self, action: str) -> Tuple[int, Tuple[int, int]]:
-        # Check if the action is valid
-        row, column = self.current_state
-        if action in self.transitions[row][column].keys():
-            new_row, new_column, reward = self.transitions[row][column][action]
-            self._change_state_and_cell((new_row, new_column))
-            return (reward, (new_row, new_column))
-        else:
-            raise InvalidActionError(f"Action {action} is not valid for state {row},{column}")
-
-    @property
-    def current_cell(self):
-        return self._current_cell
-
-    @current_cell.setter
-    def current_cell(self, value):
-        raise IlegalCellChangeError("Cannot change current cell from outside the class!")
-
-    @property
-    def current_state(self):
-        return self._current_state
-
-    @current_state.setter
-    def current_state(self, value):
-        raise IlegalStateChangeError("Cannot change current state from outside the class!")
+from typing import Tuple
+from multiprocessing import shared_memory
+import hashlib
+import os
+import random
+import re
+
+import numpy as np
+
+try:
+    from base_env import Environment  # Works with normal code
+    from profiling import Profiler
+except ModuleNotFoundError:
+    from src.base_env import Environment  # Works when called from unittest
+    from src.profiling import Profiler
+
+
+class InvalidGridError(Exception):
+    """
+    Raised when:
+     - The input grid has more than one 'S' or 'G' cell
+     - The input grid has a row with no elements
+     - The input grid has an invalid line (not starting with '|' or '-')
+     - There are cells with invalid characters (not 'S', 'G', 'X', '.')
+     - Rows have different lengths
+    """
+
+    pass
+
+
+class InvalidActionError(Exception):
+    """
+    Raised when:
+     - The input grid has an action that is not 'L', 'R', 'U', 'D'
+     - The action taken is not valid for the current state
+    """
+
+    pass
+
+
+class InvalidStateError(Exception):
+    """
+    Raised when:
+     - Trying to set a state that is not within the grid
+     - Trying to set a state with an invalid value passed (not tuple, not ints, etc.)
+    """
+
+    pass
+
+
+class InvalidRewardConfigError(Exception):
+    """
+    Raised when:
+     - A reward in the config file doesn't match the default reward format
+     - A reward in the config file doesn't match the custom reward format
+     - A reward in the config file specifies a state that is off grid
+    """
+
+    pass
+
+
+class InvalidTransitionConfigError(Exception):
+    """
+    Raised when:
+     - A custom transition in the config file doesn't match the format
+     - The slip probability in the config file doesn't match the format or is not in [0, 1]
+     - The probabilities of the stochastic transitions of a state-action pair add up to more
+       than 1
+    """
+
+    pass
+
+
+class InvalidDynamicsModeError(Exception):
+    """
+    Raised when the passed dynamics mode is not:
+     - "dict"
+     - "compiled"
+     - "lazy"
+    Or when using stochastic rules (slip or stochastic transitions) with a dynamics mode other
+    than "compiled", or a cache_dir with "dict" dynamics.
+    """
+
+    pass
+
+
+class IlegalCellChangeError(Exception):
+    """
+    Raised when trying to change the current cell from outside the class
+    """
+
+    pass
+
+
+class IlegalStateChangeError(Exception):
+    """
+    Raised when trying to change the current state from outside the class
+    """
+
+    pass
+
+
+class IlegalLayoutChangeError(Exception):
+    """
+    Raised when trying to change a GridLayout, which is shared by several Gridworlds
+    """
+
+    pass
+
+
+class GridLayout:
+    """
+    Grid, rules and dynamics of a Gridworld, without its episode state. Gridworlds spawned
+    from a layout point at the same objects instead of copying them, so a layout can't be
+    changed once built and its numpy arrays are read-only. Its lists and dicts (grid,
+    transitions, overrides) are shared the same way and must be treated as read-only too.
+    """
+
+    def __init__(self, attributes: dict) -> None:
+        for name, value in attributes.items():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise IlegalLayoutChangeError("Cannot change a GridLayout!")
+
+    def __delattr__(self, name):
+        raise IlegalLayoutChangeError("Cannot change a GridLayout!")
+
+
+def build_alias_tables(probs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Alias tables (Vose's method) for each row of probs, an (n, k) array of distributions.
+    An outcome is sampled in O(1) by picking a column i uniformly and keeping it with
+    probability alias_probs[row, i], or taking alias_indices[row, i] otherwise.
+    """
+    n, k = probs.shape
+    rows = np.arange(n)
+    scaled = probs * k
+    alias_probs = np.ones((n, k), dtype=np.float64)
+    alias_indices = np.tile(np.arange(k, dtype=np.int32), (n, 1))
+    done = np.zeros((n, k), dtype=bool)
+
+    # Each iteration pairs one column below the average with one above it in every row
+    for _ in range(k - 1):
+        small_candidates = (~done) & (scaled < 1)
+        large_candidates = (~done) & (scaled >= 1)
+        active = small_candidates.any(axis=1) & large_candidates.any(axis=1)
+        active_rows = rows[active]
+        small = small_candidates[active].argmax(axis=1)
+        large = large_candidates[active].argmax(axis=1)
+
+        alias_probs[active_rows, small] = scaled[active_rows, small]
+        alias_indices[active_rows, small] = large
+        scaled[active_rows, large] -= 1 - scaled[active_rows, small]
+        done[active_rows, small] = True
+
+    # Columns left are (up to rounding) exactly the average, so they keep themselves
+    return (alias_probs, alias_indices)
+
+
+class Gridworld(Environment):
+    _VALID_GRID_CHARS = set(["S", "G", "X", "."])
+    _VALID_ACTIONS = set(["L", "R", "U", "D"])
+    _ACTION_ORDER = ["L", "R", "U", "D"]
+    _ACTION_OFFSETS = {"L": (0, -1), "R": (0, 1), "U": (-1, 0), "D": (1, 0)}
+    # Integer code of each action in the override index, its position in _ACTION_ORDER
+    _ACTION_CODES = {"L": 0, "R": 1, "U": 2, "D": 3}
+    _PERPENDICULAR_ACTIONS = {"L": ["U", "D"], "R": ["U", "D"], "U": ["L", "R"], "D": ["L", "R"]}
+    _DYNAMICS_MODES = ["dict", "compiled", "lazy"]
+    # Everything else in a Gridworld is layout, shared by spawn() and clone()
+    _EPISODE_ATTRIBUTES = set(
+        [
+            "_current_state",
+            "_current_cell",
+            "_current_state_id",
+            "profiler",
+            "trajectory_writer",
+            "_trajectory_episode",
+            "_layout",
+            "take_action",
+            "initialize",
+        ]
+    )
+    # Arrays built by _compile_outcomes for stochastic rules
+    _OUTCOME_ARRAYS = [
+        "outcome_next_states",
+        "outcome_rewards",
+        "outcome_probs",
+        "alias_probs",
+        "alias_indices",
+    ]
+    # Bump when the content of the files written by save_compiled changes
+    _COMPILED_FORMAT_VERSION = 3
+    _PATTERN_DEFAULT_REWARD = re.compile(r"DEFAULT = (-{0,1}\d+)")
+    _ACTIONS_FOR_REGEX = "[" + "".join(_VALID_ACTIONS) + "]"
+    _PATTERN_CUSTOM_REWARD = re.compile(r"(\d+),(\d+)-(" + _ACTIONS_FOR_REGEX + r") = (-{0,1}\d+)")
+    _PATTERN_CUSTOM_TRANSITION = re.compile(
+        r"(\d+),(\d+)-(" + _ACTIONS_FOR_REGEX + r")-(\d+),(\d+) = (-{0,1}\d+|DEFAULT)"
+        r"(?: @ (\d*\.?\d+))?$"
+    )
+    _PATTERN_SLIP = re.compile(r"SLIP = (\d*\.?\d+)$")
+
+    def __init__(
+        self,
+        input_grid_path: str,
+        input_rules_path: str,
+        dynamics: str = "dict",
+        cache_dir: str = None,
+    ) -> None:
+        if dynamics not in self._DYNAMICS_MODES:
+            raise InvalidDynamicsModeError(f"Invalid dynamics mode: {dynamics}")
+        if (cache_dir is not None) and (dynamics == "dict"):
+            # Building the transition dicts takes longer than parsing, so the cache can't help
+            raise InvalidDynamicsModeError("cache_dir requires compiled or lazy dynamics!")
+        self.dynamics = dynamics
+
+        self._default_start_state = None
+        self._current_state = None
+        self._current_cell = None
+        self._current_state_id = None
+        self._goal_state = None
+        self.next_state_table = None
+        self.outcome_probs = None
+        self.profiler = None
+        self.trajectory_writer = None
+        self._layout = None
+
+        # The cache is keyed on the content of both files, so a cached file is always fresh
+        if cache_dir is not None:
+            content_hash = self._content_hash(input_grid_path, input_rules_path)
+            cache_path = os.path.join(cache_dir, f"{content_hash}.npz")
+            if os.path.exists(cache_path) and self._load_compiled(cache_path):
+                self._set_dynamics()
+                return
+
+        self._load_grid(input_grid_path)
+        self._load_rules(input_rules_path)
+        self._set_dynamics()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.save_compiled(cache_path)
+
+    @classmethod
+    def from_compiled(cls, compiled_path: str, dynamics: str = "compiled") -> "Gridworld":
+        """Create a Gridworld from a file written by save_compiled, without the source files"""
+        if dynamics not in cls._DYNAMICS_MODES:
+            raise InvalidDynamicsModeError(f"Invalid dynamics mode: {dynamics}")
+
+        gridworld = cls.__new__(cls)
+        gridworld.dynamics = dynamics
+        gridworld._current_state = None
+        gridworld._current_cell = None
+        gridworld._current_state_id = None
+        gridworld.next_state_table = None
+        gridworld.outcome_probs = None
+        gridworld.profiler = None
+        gridworld.trajectory_writer = None
+        gridworld._layout = None
+        if not gridworld._load_compiled(compiled_path):
+            raise InvalidGridError(f"Compiled grid with an outdated format: {compiled_path}")
+        gridworld._set_dynamics()
+        return gridworld
+
+    @classmethod
+    def from_shared(cls, spec: dict) -> "Gridworld":
+        """
+        Create a compiled Gridworld from read-only views on the arrays published by a
+        SharedLayout, given its spec. Only the current state and cell are private to the
+        returned Gridworld, so attaching is cheap and every process shares one copy of the grid.
+        """
+        gridworld = cls.__new__(cls)
+        gridworld.dynamics = "compiled"
+        gridworld._current_state = None
+        gridworld._current_cell = None
+        gridworld._current_state_id = None
+        gridworld.next_state_table = None
+        gridworld.outcome_probs = None
+        gridworld.profiler = None
+        gridworld.trajectory_writer = None
+        gridworld._layout = None
+
+        # Keep a reference so the block stays mapped as long as the Gridworld exists
+        gridworld._shared_memory = shared_memory.SharedMemory(name=spec["name"])
+        compiled = {}
+        for name, (dtype, shape, offset) in spec["arrays"].items():
+            compiled[name] = np.ndarray(
+                shape, dtype=dtype, buffer=gridworld._shared_memory.buf, offset=offset
+            )
+            compiled[name].flags.writeable = False
+        if int(compiled["version"]) != cls._COMPILED_FORMAT_VERSION:
+            raise InvalidGridError("Shared grid with an outdated format!")
+
+        gridworld._load_arrays(compiled, shared=True)
+        gridworld._set_dynamics()
+        return gridworld
+
+    def _set_dynamics(self) -> None:
+        if self.stochastic and (self.dynamics != "compiled"):
+            raise InvalidDynamicsModeError("Stochastic rules require compiled dynamics!")
+
+        if self.dynamics == "dict":
+            self._define_dynamics()
+        elif self.dynamics == "compiled":
+            self.compile_dynamics()
+        else:
+            # Transitions are computed on the fly by _compute_transition
+            pass
+
+    @staticmethod
+    def _content_hash(grid_path: str, rules_path: str) -> str:
+        content_hash = hashlib.sha256()
+        for path in [grid_path, rules_path]:
+            with open(path, "rb") as input_file:
+                content_hash.update(input_file.read())
+            # Separator so moving content from one file to the other changes the hash
+            content_hash.update(b"\0")
+        content_hash.update(str(Gridworld._COMPILED_FORMAT_VERSION).encode())
+        return content_hash.hexdigest()
+
+    def save_compiled(self, compiled_path: str) -> None:
+        """
+        Save the grid, rules and compiled dynamics as a single .npz file, which
+        Gridworld.from_compiled() or the cache_dir argument load without parsing anything.
+        """
+        had_tables = self.next_state_table is not None
+        self.compile_dynamics()
+        arrays = self._compiled_arrays()
+
+        # Write to a temporary file first so readers never see a partial file
+        tmp_path = f"{compiled_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as compiled_file:
+            np.savez(compiled_file, **arrays)
+        os.replace(tmp_path, compiled_path)
+
+        if not had_tables:
+            # Don't keep the arrays around for the other dynamics modes
+            self.next_state_table = None
+            self.outcome_probs = None
+            self._layout = None
+
+    def _compiled_arrays(self) -> dict:
+        # Everything needed to rebuild the Gridworld, used by save_compiled and SharedLayout
+        reward_keys, reward_values = self._override_arrays(self._reward_overrides, 1)
+        transition_keys, transition_values = self._override_arrays(self._transition_overrides, 3)
+        stochastic = [
+            (key, outcome)
+            for key, outcomes in self._stochastic_transitions.items()
+            for outcome in outcomes
+        ]
+        arrays = {
+            "version": np.array(self._COMPILED_FORMAT_VERSION),
+            "cells": np.array(self.grid, dtype="S1"),
+            "default_start_state": np.array(self._default_start_state),
+            "goal_state": np.array(self._goal_state),
+            "actions": np.array(self.action_list, dtype="U1"),
+            "default_reward": np.array(self.default_reward),
+            "reward_override_keys": reward_keys,
+            "reward_override_values": reward_values,
+            "transition_override_keys": transition_keys,
+            "transition_override_values": transition_values,
+            "slip": np.array(self.slip),
+            "stochastic_keys": np.array([key for key, _ in stochastic], dtype=np.int64).reshape(
+                -1, 2
+            ),
+            "stochastic_targets": np.array(
+                [outcome[:3] for _, outcome in stochastic], dtype=np.int64
+            ).reshape(-1, 3),
+            "stochastic_probs": np.array(
+                [outcome[3] for _, outcome in stochastic], dtype=np.float64
+            ),
+            "state_ids": self.state_ids,
+            "state_coords": self.state_coords,
+            "next_state_table": self.next_state_table,
+            "reward_table": self.reward_table,
+            "action_mask": self.action_mask,
+        }
+        return arrays
+
+    def _load_compiled(self, compiled_path: str) -> bool:
+        # Returns False if the file was written with another format version
+        with np.load(compiled_path) as compiled:
+            if int(compiled["version"]) != self._COMPILED_FORMAT_VERSION:
+                return False
+            self._load_arrays(compiled)
+        return True
+
+    def _load_arrays(self, compiled, shared: bool = False) -> None:
+        # With shared=True the arrays are read-only views on shared memory, and are used as is
+        # for the cells and the compiled dynamics, including the stochastic outcomes
+        if shared:
+            self.grid = compiled["cells"]
+        else:
+            self.grid = compiled["cells"].astype("U1").tolist()
+        self.row_num = len(self.grid)
+        self.column_num = len(self.grid[0])
+        self._default_start_state = tuple(compiled["default_start_state"].tolist())
+        self._goal_state = tuple(compiled["goal_state"].tolist())
+
+        self.action_list = compiled["actions"].tolist()
+        self.action_ids = {action: i for i, action in enumerate(self.action_list)}
+        self.actions = set(self.action_list)
+        self.default_reward = int(compiled["default_reward"])
+        self._reward_overrides = dict(
+            zip(
+                map(tuple, compiled["reward_override_keys"].tolist()),
+                compiled["reward_override_values"].ravel().tolist(),
+            )
+        )
+        self._transition_overrides = dict(
+            zip(
+                map(tuple, compiled["transition_override_keys"].tolist()),
+                map(tuple, compiled["transition_override_values"].tolist()),
+            )
+        )
+        self.slip = float(compiled["slip"])
+        self._stochastic_transitions = {}
+        for key, target, prob in zip(
+            compiled["stochastic_keys"].tolist(),
+            compiled["stochastic_targets"].tolist(),
+            compiled["stochastic_probs"].tolist(),
+        ):
+            self._stochastic_transitions.setdefault(tuple(key), []).append((*target, prob))
+
+        if self.dynamics == "compiled":
+            self.state_ids = compiled["state_ids"]
+            self.state_coords = compiled["state_coords"]
+            self.next_state_table = compiled["next_state_table"]
+            self.reward_table = compiled["reward_table"]
+            self.action_mask = compiled["action_mask"]
+        if shared and self.stochastic:
+            for name in self._OUTCOME_ARRAYS:
+                setattr(self, name, compiled[name])
+
+    def _load_grid(self, grid_path: str) -> None:
+        self.grid = []
+
+        with open(grid_path, "r") as grid_file:
+            lines = grid_file.readlines()
+
+        s_seen = 0
+        g_seen = 0
+        col_max = 0
+        row = 0
+        for line in lines:
+            line = line.rstrip()
+
+            if line.startswith("|") and line.endswith("|"):
+                self.grid.append([])
+                cells = line.split("|")
+                cells = cells[1:-1]
+
+                col = 0
+                for cell in cells:
+                    if cell.upper() not in self._VALID_GRID_CHARS:
+                        raise InvalidGridError("The input grid has cells with invalid characters!")
+
+                    if cell.upper() == "S":
+                        s_seen += 1
+                        self._default_start_state = (row, col)
+                    elif cell.upper() == "G":
+                        g_seen += 1
+                        self._goal_state = (row, col)
+
+                    self.grid[row].append(cell)
+                    col += 1
+
+                if col_max != 0:
+                    if col != col_max:
+                        raise InvalidGridError("The input grid has rows of different lenghts!")
+                elif col > 0:
+                    col_max = col
+                else:
+                    raise InvalidGridError("The grid has a row with no elements")
+
+                row += 1
+
+            elif not line.startswith("-"):
+                raise InvalidGridError(f"The grid has an invalid line:\n{line}")
+
+        self.row_num = len(self.grid)
+        self.column_num = len(self.grid[0])
+
+        if (s_seen != 1) or (g_seen != 1):
+            raise InvalidGridError("The input grid has invalid amount of 'S' or 'G' cell!")
+
+    def _load_rules(self, rules_path: str) -> None:
+        # Custom rewards and transitions are stored in override indexes keyed by
+        # (cell, action code), with cell = row * column_num + column. Transitions hold the
+        # parsed (next_row, next_col, reward). Stochastic transitions hold a list of
+        # (next_row, next_col, reward, probability) per key.
+        self.actions = set()
+        self._reward_overrides = {}
+        self._transition_overrides = {}
+        self._stochastic_transitions = {}
+        self.slip = 0.0
+        current_section = None
+
+        with open(rules_path, "r") as rules_file:
+            for line in rules_file:
+                line = line.split("#")[0].strip()  # Remove comments
+
+                if line.startswith("["):
+                    current_section = line[1:-1]
+
+                elif line != "":
+                    if current_section == "ACTIONS":
+                        if line in self._VALID_ACTIONS:
+                            self.actions.add(line)
+                        else:
+                            raise InvalidActionError(f"Invalid action: {line}")
+
+                    elif current_section == "REWARDS":
+                        self._parse_reward(line)
+
+                    elif current_section == "TRANSITIONS":
+                        self._parse_transition(line)
+
+                    elif current_section == "DYNAMICS":
+                        self._parse_slip(line)
+
+        self.action_list = [action for action in self._ACTION_ORDER if action in self.actions]
+        self.action_ids = {action: i for i, action in enumerate(self.action_list)}
+
+    def _parse_reward(self, line: str) -> None:
+        match_custom_reward = self._PATTERN_CUSTOM_REWARD.match(line)
+        if match_custom_reward:
+            row, column, action, reward = match_custom_reward.groups()
+            row = int(row)
+            column = int(column)
+            if (row >= self.row_num) or (column >= self.column_num):
+                raise InvalidRewardConfigError(f"Invalid reward due to state off grid: {line}")
+            cell = row * self.column_num + column
+            self._reward_overrides[(cell, self._ACTION_CODES[action])] = int(reward)
+            return
+
+        match_default_reward = self._PATTERN_DEFAULT_REWARD.match(line)
+        if match_default_reward:
+            self.default_reward = int(match_default_reward.groups()[0])
+        else:
+            raise InvalidRewardConfigError(f"Invalid reward: {line}")
+
+    def _parse_transition(self, line: str) -> None:
+        match_custom_transition = self._PATTERN_CUSTOM_TRANSITION.match(line)
+        if not match_custom_transition:
+            raise InvalidTransitionConfigError(f"Invalid transition: {line}")
+
+        row, column, action, next_row, next_col, reward, prob = match_custom_transition.groups()
+        row = int(row)
+        column = int(column)
+        if (row >= self.row_num) or (column >= self.column_num):
+            # The cell key would wrap around to another cell
+            raise InvalidTransitionConfigError(f"Invalid transition due to state off grid: {line}")
+        if reward == "DEFAULT":
+            reward = self.default_reward
+        key = (row * self.column_num + column, self._ACTION_CODES[action])
+
+        if prob is None:
+            self._transition_overrides[key] = (int(next_row), int(next_col), int(reward))
+            return
+
+        # Stochastic transition, the remaining probability goes to the regular move
+        prob = float(prob)
+        outcomes = self._stochastic_transitions.setdefault(key, [])
+        if (prob <= 0) or (prob + sum(outcome[3] for outcome in outcomes) > 1 + 1e-9):
+            raise InvalidTransitionConfigError(f"Invalid transition probability: {line}")
+        outcomes.append((int(next_row), int(next_col), int(reward), prob))
+
+    def _parse_slip(self, line: str) -> None:
+        match_slip = self._PATTERN_SLIP.match(line)
+        if (not match_slip) or (float(match_slip.groups()[0]) > 1):
+            raise InvalidTransitionConfigError(f"Invalid slip probability: {line}")
+        self.slip = float(match_slip.groups()[0])
+
+    @property
+    def stochastic(self) -> bool:
+        """Whether the rules define a slip probability or stochastic transitions"""
+        return (self.slip > 0) or (len(self._stochastic_transitions) > 0)
+
+    @staticmethod
+    def _override_arrays(overrides: dict, width: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Keys as an (n, 2) array of (cell, action code) and values as an (n, width) array
+        keys = np.array(list(overrides.keys()), dtype=np.int64).reshape(-1, 2)
+        values = np.array(list(overrides.values()), dtype=np.int64).reshape(-1, width)
+        return (keys, values)
+
+    @property
+    def custom_rewards(self) -> dict:
+        """Custom rewards keyed by "row,column-action", as written in the rules file"""
+        return {
+            f"{cell // self.column_num},{cell % self.column_num}-{self._ACTION_ORDER[code]}": reward
+            for (cell, code), reward in self._reward_overrides.items()
+        }
+
+    @property
+    def custom_transitions(self) -> dict:
+        """Custom transitions keyed by "row,column-action", with ("row,column", reward) values"""
+        return {
+            f"{cell // self.column_num},{cell % self.column_num}-{self._ACTION_ORDER[code]}": (
+                f"{next_row},{next_col}",
+                reward,
+            )
+            for (cell, code), (next_row, next_col, reward) in self._transition_overrides.items()
+        }
+
+    def _compute_transition(self, row: int, column: int, action: str) -> Tuple[int, int, int]:
+        key = (row * self.column_num + column, self._ACTION_CODES[action])
+
+        # Check if there is a custom reward for this state-action pair
+        reward = self._reward_overrides.get(key, self.default_reward)
+
+        # Check what lies ahead
+        v_offset, h_offset = self._ACTION_OFFSETS[action]
+        next_row = row + v_offset
+        next_col = column + h_offset
+
+        # Check if there is a custom transition for this state-action pair
+        custom_transition = self._transition_overrides.get(key)
+        if custom_transition is not None:
+            next_row, next_col, reward = custom_transition
+
+        if (0 <= next_row < self.row_num) and (0 <= next_col < self.column_num):
+            if self.grid[next_row][next_col] != "X":
+                # Transition to new state
+                return (next_row, next_col, reward)
+
+        # Going off grid or moving to an X, stay in same state
+        return (row, column, reward)
+
+    def _add_transitions_to_cell(self, row: int, column: int) -> None:
+        # In action_list order, iterating the actions set would depend on the hash seed
+        for action in self.action_list:
+            self.transitions[row][column][action] = self._compute_transition(row, column, action)
+
+    def _define_dynamics(self) -> None:
+        # Defining all transitions is memory intensive for large grids,
+        # use dynamics="lazy" to compute them on the fly instead
+
+        self.transitions = {}
+
+        for row in range(self.row_num):
+            for column in range(self.column_num):
+                if row not in self.transitions:
+                    self.transitions[row] = {}
+                if column not in self.transitions[row]:
+                    self.transitions[row][column] = {}
+
+                if self.grid[row][column] in [".", "S"]:
+                    self._add_transitions_to_cell(row, column)
+
+                else:
+                    # No action for 'X' or 'G' states
+                    pass
+
+    def compile_dynamics(self) -> None:
+        """
+        Build dense transition arrays indexed by integer state and action ids:
+         - state_ids[row, column]: state id of each cell, -1 for 'X' cells
+         - state_coords[state]: (row, column) of each state id
+         - next_state_table[state, action]: state id reached by taking the action
+         - reward_table[state, action]: reward received by taking the action
+         - action_mask[state, action]: whether the action can be taken in the state
+        States are the non 'X' cells in row-major order, same as get_all_possible_states().
+        Actions follow _ACTION_ORDER, restricted to the ones defined in the rules.
+
+        With stochastic rules, the tables above hold the intended move and each state-action
+        pair also gets a distribution over outcomes, see _compile_outcomes().
+        """
+        if self.next_state_table is None:
+            self._compile_tables()
+            self._layout = None
+        if self.stochastic and (self.outcome_probs is None):
+            self._compile_outcomes()
+            self._layout = None
+        if self.dynamics == "compiled":
+            self._make_step_views()
+
+    def _make_step_views(self) -> None:
+        # Flat memoryviews on the tables used by take_action. Indexing them returns plain
+        # Python ints and bools, which is several times cheaper than NumPy scalar indexing,
+        # and they don't copy the tables, so shared tables stay shared.
+        self._n_actions = len(self.action_list)
+        self._state_id_view = memoryview(self.state_ids.ravel())
+        self._state_row_view = memoryview(self.state_coords[:, 0])
+        self._state_column_view = memoryview(self.state_coords[:, 1])
+        self._next_state_view = memoryview(self.next_state_table.ravel())
+        self._reward_view = memoryview(self.reward_table.ravel())
+        self._action_mask_view = memoryview(self.action_mask.ravel())
+        if self.outcome_probs is not None:
+            # Outcome tables, so stochastic steps draw from the alias tables in plain Python
+            self._n_outcomes = self.alias_probs.shape[2]
+            self._alias_prob_view = memoryview(self.alias_probs.ravel())
+            self._alias_index_view = memoryview(self.alias_indices.ravel())
+            self._outcome_next_state_view = memoryview(self.outcome_next_states.ravel())
+            self._outcome_reward_view = memoryview(self.outcome_rewards.ravel())
+
+    def _compile_tables(self) -> None:
+        cells = np.char.upper(np.array(self.grid))
+        free_cells = cells != "X"
+        active_cells = (cells == ".") | (cells == "S")
+
+        n_states = int(free_cells.sum())
+        self.state_ids = np.full(cells.shape, -1, dtype=np.int32)
+        self.state_ids[free_cells] = np.arange(n_states, dtype=np.int32)
+        self.state_coords = np.argwhere(free_cells).astype(np.int32)
+
+        n_actions = len(self.action_list)
+
+        # By default every action keeps you in the same state ('X' or off grid)
+        own_states = np.arange(n_states, dtype=np.int32)
+        self.next_state_table = np.repeat(own_states[:, None], n_actions, axis=1)
+        self.reward_table = np.full((n_states, n_actions), self.default_reward, dtype=np.int32)
+        # No action for 'X' or 'G' states
+        self.action_mask = np.zeros((n_states, n_actions), dtype=bool)
+        self.action_mask[active_cells[free_cells]] = True
+
+        rows = self.state_coords[:, 0]
+        columns = self.state_coords[:, 1]
+        for action_id, action in enumerate(self.action_list):
+            v_offset, h_offset = self._ACTION_OFFSETS[action]
+            next_rows = rows + v_offset
+            next_cols = columns + h_offset
+            on_grid = (
+                (next_rows >= 0)
+                & (next_rows < self.row_num)
+                & (next_cols >= 0)
+                & (next_cols < self.column_num)
+            )
+            targets = np.full(n_states, -1, dtype=np.int32)
+            targets[on_grid] = self.state_ids[next_rows[on_grid], next_cols[on_grid]]
+            moved = targets >= 0
+            self.next_state_table[moved, action_id] = targets[moved]
+
+        # Compiled action id of each action code, -1 for actions not defined in the rules
+        action_code_ids = np.array(
+            [self.action_ids.get(action, -1) for action in self._ACTION_ORDER], dtype=np.int32
+        )
+        flat_state_ids = self.state_ids.ravel()
+
+        keys, values = self._override_arrays(self._reward_overrides, 1)
+        state_ids = flat_state_ids[keys[:, 0]]
+        action_ids = action_code_ids[keys[:, 1]]
+        # Overrides of 'X' cells or undefined actions are ignored
+        valid = (state_ids >= 0) & (action_ids >= 0)
+        self.reward_table[state_ids[valid], action_ids[valid]] = values[valid, 0]
+
+        keys, values = self._override_arrays(self._transition_overrides, 3)
+        state_ids = flat_state_ids[keys[:, 0]]
+        action_ids = action_code_ids[keys[:, 1]]
+        valid = (state_ids >= 0) & (action_ids >= 0)
+        next_rows, next_cols, rewards = values[valid].T
+        on_grid = (
+            (next_rows >= 0)
+            & (next_rows < self.row_num)
+            & (next_cols >= 0)
+            & (next_cols < self.column_num)
+        )
+        next_state_ids = state_ids[valid].copy()
+        # Going off grid or to an 'X', stay in same state
+        targets = self.state_ids[next_rows[on_grid], next_cols[on_grid]]
+        next_state_ids[on_grid] = np.where(targets >= 0, targets, next_state_ids[on_grid])
+        self.next_state_table[state_ids[valid], action_ids[valid]] = next_state_ids
+        self.reward_table[state_ids[valid], action_ids[valid]] = rewards
+
+    def _compile_outcomes(self) -> None:
+        # Possible outcomes of each state-action pair in the last axis of:
+        #  - outcome_next_states[state, action, outcome] and outcome_rewards[...]
+        #  - outcome_probs[...]: probability of each outcome
+        #  - alias_probs[...] and alias_indices[...]: alias tables to sample them in O(1)
+        # Outcomes are the intended move, the two perpendicular moves (slip) and the
+        # stochastic transitions of the pair, if any.
+        n_states, n_actions = self.next_state_table.shape
+        n_teleports = max(
+            [len(outcomes) for outcomes in self._stochastic_transitions.values()] + [0]
+        )
+        shape = (n_states, n_actions, 3 + n_teleports)
+        self.outcome_next_states = np.zeros(shape, dtype=np.int32)
+        self.outcome_rewards = np.zeros(shape, dtype=np.int32)
+        self.outcome_probs = np.zeros(shape, dtype=np.float64)
+
+        for action_id, action in enumerate(self.action_list):
+            self.outcome_next_states[:, action_id, 0] = self.next_state_table[:, action_id]
+            self.outcome_rewards[:, action_id, 0] = self.reward_table[:, action_id]
+            self.outcome_probs[:, action_id, 0] = 1 - self.slip
+            for i, slip_action in enumerate(self._PERPENDICULAR_ACTIONS[action]):
+                if slip_action in self.action_ids:
+                    slip_id = self.action_ids[slip_action]
+                    self.outcome_next_states[:, action_id, i + 1] = self.next_state_table[
+                        :, slip_id
+                    ]
+                    self.outcome_rewards[:, action_id, i + 1] = self.reward_table[:, slip_id]
+                    self.outcome_probs[:, action_id, i + 1] = self.slip / 2
+                else:
+                    # Can't slip towards an action that doesn't exist
+                    self.outcome_probs[:, action_id, 0] += self.slip / 2
+
+        flat_state_ids = self.state_ids.ravel()
+        for (cell, code), outcomes in self._stochastic_transitions.items():
+            state_id = flat_state_ids[cell]
+            action_id = self.action_ids.get(self._ACTION_ORDER[code])
+            if (state_id < 0) or (action_id is None):
+                continue
+            self.outcome_probs[state_id, action_id, :3] *= 1 - sum(o[3] for o in outcomes)
+            for i, (next_row, next_col, reward, prob) in enumerate(outcomes):
+                next_state_id = state_id
+                if (0 <= next_row < self.row_num) and (0 <= next_col < self.column_num):
+                    if self.state_ids[next_row, next_col] >= 0:
+                        next_state_id = self.state_ids[next_row, next_col]
+                self.outcome_next_states[state_id, action_id, 3 + i] = next_state_id
+                self.outcome_rewards[state_id, action_id, 3 + i] = reward
+                self.outcome_probs[state_id, action_id, 3 + i] = prob
+
+        alias_probs, alias_indices = build_alias_tables(self.outcome_probs.reshape(-1, shape[2]))
+        self.alias_probs = alias_probs.reshape(shape)
+        self.alias_indices = alias_indices.reshape(shape)
+
+    def sample_outcomes(
+        self, state_ids: np.ndarray, action_ids: np.ndarray, uniforms: np.ndarray
+    ) -> np.ndarray:
+        """
+        Outcome index of each (state, action) pair for stochastic rules, using one uniform
+        number in [0, 1) per pair. Works on scalars and arrays alike.
+        """
+        n_outcomes = self.alias_probs.shape[2]
+        scaled = uniforms * n_outcomes
+        columns = np.minimum(np.asarray(scaled).astype(np.int64), n_outcomes - 1)
+        keep = (scaled - columns) < self.alias_probs[state_ids, action_ids, columns]
+        return np.where(keep, columns, self.alias_indices[state_ids, action_ids, columns])
+
+    def print_grid(self) -> None:
+        print("-" * (self.column_num * 2 + 1))
+        for row in self.grid:
+            row_str = "|"
+            for cell in row:
+                row_str += f"{cell}|"
+            print(row_str)
+        print("-" * (self.column_num * 2 + 1))
+
+    def _change_state_and_cell(self, state: Tuple[int, int], state_id: int = None) -> None:
+        # state_id is only kept by compiled dynamics, None means it's looked up when needed
+        self._current_state = state
+        self._current_cell = self.grid[state[0]][state[1]]
+        self._current_state_id = state_id
+
+    def initialize(
+        self, method: str = None, state: Tuple[int, int] = None
+    ) -> Tuple[Tuple[int, int], str]:
+        if method == "default":
+            self._change_state_and_cell(self._default_start_state)
+
+        elif method == "random":
+            # Avoid 'X' and 'G'
+            row = None
+            column = None
+            while (row is None) or (column is None) or (self.grid[row][column] not in [".", "S"]):
+                row = random.randint(0, self.row_num - 1)
+                column = random.randint(0, self.column_num - 1)
+            self._change_state_and_cell((row, column))
+
+        elif state is not None:
+            # Check it has the format: Tuple[int, int]
+            if (
+                (not isinstance(state, tuple))
+                or (len(state) != 2)
+                or (not isinstance(state[0], int))
+                or (not isinstance(state[1], int))
+            ):
+                raise InvalidStateError("Invalid state passed!")
+
+            # Check state is within grid and is not an 'X' or 'G'
+            if (0 <= state[0] < self.row_num) and (0 <= state[1] < self.column_num):
+                if self.grid[state[0]][state[1]] in [".", "S"]:
+                    self._change_state_and_cell(state)
+                else:
+                    raise InvalidStateError("State needs to be a cell with '.' or 'S'")
+            else:
+                raise InvalidStateError("State not within grid!")
+
+        return (self.current_state, self.current_cell)
+
+    def get_possible_actions(self, state: Tuple[int, int] = None) -> list:
+        if state is not None:
+            # Use argument state
+            if (0 <= state[0] < self.row_num) and (0 <= state[1] < self.column_num):
+                row, column = state
+            else:
+                raise InvalidStateError("State not within grid!")
+        else:
+            # Use current state
+            row, column = self.current_state
+
+        if self.dynamics == "compiled":
+            state_id = self._state_id_view[row * self.column_num + column]
+            if state_id < 0:
+                return []
+            first = state_id * self._n_actions
+            return [
+                action
+                for action_id, action in enumerate(self.action_list)
+                if self._action_mask_view[first + action_id]
+            ]
+        elif self.dynamics == "lazy":
+            # No action for 'X' or 'G' states
+            if self.grid[row][column] in [".", "S"]:
+                return list(self.action_list)
+            return []
+        return list(self.transitions[row][column].keys())
+
+    def get_all_possible_states(self) -> list[Tuple[int, int]]:
+        states = []
+        for row in range(self.row_num):
+            for column in range(self.column_num):
+                # 'X' states are not allowed
+                if self.grid[row][column] in ["S", ".", "G"]:
+                    states.append((row, column))
+
+        return states
+
+    def take_action(self, action: str) -> Tuple[int, Tuple[int, int]]:
+        if self.dynamics == "compiled":
+            # Hot path, reads plain Python ints from the step views and keeps the state id
+            state_id = self._current_state_id
+            if state_id is None:
+                row, column = self._current_state
+                state_id = self._state_id_view[row * self.column_num + column]
+            action_id = self.action_ids.get(action)
+            if action_id is not None:
+                index = state_id * self._n_actions + action_id
+                if self._action_mask_view[index]:
+                    if self.outcome_probs is None:
+                        new_state_id = self._next_state_view[index]
+                        reward = self._reward_view[index]
+                    else:
+                        # Same draw as sample_outcomes, for a single pair
+                        n_outcomes = self._n_outcomes
+                        scaled = random.random() * n_outcomes
+                        column = min(int(scaled), n_outcomes - 1)
+                        outcome_index = index * n_outcomes + column
+                        if (scaled - column) >= self._alias_prob_view[outcome_index]:
+                            outcome_index += self._alias_index_view[outcome_index] - column
+                        new_state_id = self._outcome_next_state_view[outcome_index]
+                        reward = self._outcome_reward_view[outcome_index]
+                    new_row = self._state_row_view[new_state_id]
+                    new_column = self._state_column_view[new_state_id]
+                    # Same as _change_state_and_cell, without the extra call
+                    self._current_state = (new_row, new_column)
+                    self._current_cell = self.grid[new_row][new_column]
+                    self._current_state_id = new_state_id
+                    return (reward, self._current_state)
+
+            row, column = self._current_state
+            raise InvalidActionError(f"Action {action} is not valid for state {row},{column}")
+
+        # Check if the action is valid
+        row, column = self.current_state
+        if self.dynamics == "lazy":
+            if (self.grid[row][column] in [".", "S"]) and (action in self.actions):
+                new_row, new_column, reward = self._compute_transition(row, column, action)
+                self._change_state_and_cell((new_row, new_column))
+                return (reward, (new_row, new_column))
+            else:
+                raise InvalidActionError(f"Action {action} is not valid for state {row},{column}")
+
+        if action in self.transitions[row][column].keys():
+            new_row, new_column, reward = self.transitions[row][column][action]
+            self._change_state_and_cell((new_row, new_column))
+            return (reward, (new_row, new_column))
+        else:
+            raise InvalidActionError(f"Action {action} is not valid for state {row},{column}")
+
+    @property
+    def layout(self) -> GridLayout:
+        # Built on first use, and again if compile_dynamics adds tables afterwards
+        if self._layout is None:
+            self._layout = GridLayout(
+                {
+                    name: value
+                    for name, value in vars(self).items()
+                    if name not in self._EPISODE_ATTRIBUTES
+                }
+            )
+        return self._layout
+
+    @classmethod
+    def from_layout(cls, layout: GridLayout) -> "Gridworld":
+        """Create a Gridworld with no episode started that shares layout, in O(1)"""
+        gridworld = cls.__new__(cls)
+        gridworld.__dict__.update(vars(layout))
+        gridworld._layout = layout
+        gridworld._current_state = None
+        gridworld._current_cell = None
+        gridworld._current_state_id = None
+        gridworld.profiler = None
+        gridworld.trajectory_writer = None
+        return gridworld
+
+    def spawn(self) -> "Gridworld":
+        """New Gridworld on the same layout, with no episode started"""
+        return type(self).from_layout(self.layout)
+
+    def clone(self) -> "Gridworld":
+        """New Gridworld on the same layout, in the same state as this one"""
+        gridworld = self.spawn()
+        gridworld._current_state = self._current_state
+        gridworld._current_cell = self._current_cell
+        gridworld._current_state_id = self._current_state_id
+        return gridworld
+
+    def _install_hooks(self) -> None:
+        # Profiling and trajectory logging wrap take_action and initialize through instance
+        # attributes that shadow the methods, so there's no cost at all when both are off
+        self.__dict__.pop("take_action", None)
+        self.__dict__.pop("initialize", None)
+        take_action = self.take_action
+        initialize = self.initialize
+
+        if self.trajectory_writer is not None:
+            take_action = self._logged_take_action(take_action)
+            initialize = self._logged_initialize(initialize)
+        if self.profiler is not None:
+            take_action = self.profiler.wrap("env.take_action", take_action)
+            initialize = self.profiler.wrap("env.initialize", initialize)
+
+        if (self.trajectory_writer is not None) or (self.profiler is not None):
+            self.take_action = take_action
+            self.initialize = initialize
+
+    def enable_profiling(self, profiler: Profiler = None) -> Profiler:
+        self.profiler = profiler if profiler is not None else Profiler()
+        self._install_hooks()
+        return self.profiler
+
+    def disable_profiling(self) -> None:
+        self.profiler = None
+        self._install_hooks()
+
+    def enable_trajectory_log(self, writer) -> None:
+        """
+        Append every transition to writer, a TrajectoryWriter whose actions include the ones of
+        this Gridworld. Each initialize() starts a new episode, numbered from 1.
+        """
+        self.trajectory_writer = writer
+        self._trajectory_episode = 0
+        self._install_hooks()
+
+    def disable_trajectory_log(self) -> None:
+        self.trajectory_writer = None
+        self._install_hooks()
+
+    def _logged_take_action(self, take_action):
+        state_ids = {state: i for i, state in enumerate(self.get_all_possible_states())}
+        writer = self.trajectory_writer
+
+        def logged(action):
+            state = self._current_state
+            reward, new_state = take_action(action)
+            writer.append(
+                self._trajectory_episode,
+                state_ids[state],
+                writer.action_ids[action],
+                reward,
+                state_ids[new_state],
+            )
+            return (reward, new_state)
+
+        return logged
+
+    def _logged_initialize(self, initialize):
+        def logged(*args, **kwargs):
+            self._trajectory_episode += 1
+            return initialize(*args, **kwargs)
+
+        return logged
+
+    @property
+    def current_cell(self):
+        return self._current_cell
+
+    @current_cell.setter
+    def current_cell(self, value):
+        raise IlegalCellChangeError("Cannot change current cell from outside the class!")
+
+    @property
+    def current_state(self):
+        return self._current_state
+
+    @current_state.setter
+    def current_state(self, value):
+        raise IlegalStateChangeError("Cannot change current state from outside the class!")
+
+
+class SharedLayout:
+    """
+    Publishes the grid, rules and compiled dynamics of a Gridworld once into a block of shared
+    memory. Pass spec (a small picklable dict) to worker processes and attach to the block with
+    Gridworld.from_shared(spec). The publisher owns the block and frees it with close(), or at
+    the end of a with statement. Gridworlds that are already attached keep working after that.
+    """
+
+    # Offset alignment of each array in the block
+    _ALIGNMENT = 64
+
+    def __init__(self, env: Gridworld) -> None:
+        had_tables = env.next_state_table is not None
+        env.compile_dynamics()
+        arrays = env._compiled_arrays()
+        # Attached Gridworlds read cells straight from the block, so they're stored as str
+        arrays["cells"] = arrays["cells"].astype("U1")
+        if env.stochastic:
+            for name in Gridworld._OUTCOME_ARRAYS:
+                arrays[name] = getattr(env, name)
+        if not had_tables:
+            env.next_state_table = None
+            env.outcome_probs = None
+            env._layout = None
+
+        layout = {}
+        size = 0
+        for name, values in arrays.items():
+            layout[name] = (values.dtype.str, values.shape, size)
+            size += -(-values.nbytes // self._ALIGNMENT) * self._ALIGNMENT
+
+        self._shared_memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, (dtype, shape, offset) in layout.items():
+            view = np.ndarray(shape, dtype=dtype, buffer=self._shared_memory.buf, offset=offset)
+            view[...] = arrays[name]
+        del view
+        self.spec = {"name": self._shared_memory.name, "arrays": layout}
+        self.nbytes = size
+
+    def close(self) -> None:
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory.unlink()
+            self._shared_memory = None
+
+    def __enter__(self) -> "SharedLayout":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
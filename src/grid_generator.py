@@ -0,0 +1,296 @@
+from typing import BinaryIO, TextIO
+import argparse
+
+import numpy as np
+
+
+class InvalidGeneratorConfigError(Exception):
+    """
+    Raised when:
+     - The style is not "open", "rooms" or "maze"
+     - The grid is too small to hold an 'S' and a 'G' cell
+     - The room size is smaller than 2
+     - There are no cells left to place the requested teleports
+     - The wall density is not within [0, 1]
+    """
+
+    pass
+
+
+_STYLES = ["open", "rooms", "maze"]
+_ACTIONS = ["L", "R", "U", "D"]
+_FREE, _WALL, _START, _GOAL = b".", b"X", b"S", b"G"
+
+
+def _write_row(grid_file: BinaryIO, cells: np.ndarray) -> None:
+    # cells is a uint8 array of characters, written as |c|c|...|c|
+    line = np.full(2 * len(cells) + 2, ord("|"), dtype=np.uint8)
+    line[1:-1:2] = cells
+    line[-1] = ord("\n")
+    grid_file.write(line.tobytes())
+
+
+def _monotone_path(rows: int, columns: int, rng: np.random.Generator) -> np.ndarray:
+    # Column where a down/right path from (0, 0) to (rows - 1, columns - 1) leaves each row,
+    # so in row r it covers the columns between down_columns[r - 1] and down_columns[r]
+    down_columns = np.sort(rng.integers(0, columns, size=rows))
+    down_columns[-1] = columns - 1
+    return down_columns
+
+
+def _path_row(row: int, down_columns: np.ndarray) -> slice:
+    first_column = down_columns[row - 1] if row > 0 else 0
+    return slice(first_column, down_columns[row] + 1)
+
+
+def _open_rows(rows, columns, wall_density, rng, down_columns, room_size=None):
+    # Random walls, plus room walls with one door per room side for the "rooms" style.
+    # The cells of the monotone path are always free, which keeps 'G' reachable from 'S'
+    n_rooms = (columns + room_size - 1) // room_size if room_size else 0
+    vertical_doors = None
+    for row in range(rows):
+        walls = rng.random(columns) < wall_density
+
+        if room_size:
+            if row % room_size == 0:
+                # Row of each door in the vertical walls of this band of rooms
+                vertical_doors = row + rng.integers(0, room_size - 1, size=n_rooms)
+            if row % room_size == room_size - 1:
+                walls[:] = True
+                doors = np.arange(n_rooms) * room_size + rng.integers(0, room_size - 1, n_rooms)
+                walls[doors[doors < columns]] = False
+            else:
+                wall_columns = np.arange(room_size - 1, columns, room_size)
+                walls[wall_columns] = vertical_doors[: len(wall_columns)] != row
+
+        walls[_path_row(row, down_columns)] = False
+        cells = np.where(walls, ord(_WALL), ord(_FREE)).astype(np.uint8)
+        if row == 0:
+            cells[0] = ord(_START)
+        if row == rows - 1:
+            cells[-1] = ord(_GOAL)
+        yield cells
+
+
+def _maze_rows(rows, columns, rng):
+    # Sidewinder maze, generated one maze row at a time. Maze cells are at even coordinates
+    # and the odd ones are walls or passages between them. Every maze cell is connected to
+    # every other, so 'G' is reachable from 'S'.
+    maze_rows = (rows + 1) // 2
+    maze_columns = (columns + 1) // 2
+    cell_columns = np.arange(0, columns, 2)
+    passage_columns = np.arange(1, columns, 2)
+    goal_column = 2 * (maze_columns - 1)
+
+    for maze_row in range(maze_rows):
+        if maze_row == 0:
+            # The first row is a single corridor
+            east = np.ones(maze_columns - 1, dtype=bool)
+        else:
+            east = rng.random(maze_columns - 1) < 0.5
+            # Each run of cells joined to the east gets one passage to the north
+            run_ends = np.append(np.flatnonzero(~east), maze_columns - 1)
+            run_starts = np.append(0, run_ends[:-1] + 1)
+            run_lengths = run_ends - run_starts + 1
+            north = run_starts + (rng.random(len(run_starts)) * run_lengths).astype(np.int64)
+
+            cells = np.full(columns, ord(_WALL), dtype=np.uint8)
+            cells[2 * north] = ord(_FREE)
+            yield cells
+
+        cells = np.full(columns, ord(_WALL), dtype=np.uint8)
+        cells[cell_columns] = ord(_FREE)
+        cells[passage_columns[: len(east)][east]] = ord(_FREE)
+        if maze_row == 0:
+            cells[0] = ord(_START)
+        if maze_row == maze_rows - 1:
+            cells[goal_column] = ord(_GOAL)
+        yield cells
+
+    if rows % 2 == 0:
+        # Last row falls between maze rows
+        yield np.full(columns, ord(_WALL), dtype=np.uint8)
+
+
+def generate_grid(
+    grid_path: str,
+    rows: int,
+    columns: int,
+    style: str = "open",
+    wall_density: float = 0.2,
+    room_size: int = 8,
+    seed: int = None,
+) -> dict:
+    """
+    Write a random rows x columns grid in the format read by Gridworld, one row at a time so
+    memory doesn't grow with the grid size. Styles:
+     - "open": each cell is a wall with probability wall_density
+     - "rooms": room_size x room_size rooms with a door per side, plus random walls
+     - "maze": sidewinder maze, wall_density is not used
+    'G' is always reachable from 'S'. Returns a description of the grid needed by
+    generate_rules: rows, columns, style, start, goal and, for "open" and "rooms", the
+    down_columns of the guaranteed path from 'S' to 'G'.
+    """
+    if style not in _STYLES:
+        raise InvalidGeneratorConfigError(f"Invalid style: {style}")
+    if (rows < 1) or (columns < 1) or (rows * columns < 2):
+        raise InvalidGeneratorConfigError("The grid is too small!")
+    if (style == "maze") and (((rows + 1) // 2) * ((columns + 1) // 2) < 2):
+        raise InvalidGeneratorConfigError("The grid is too small!")
+    if (style == "rooms") and (room_size < 2):
+        raise InvalidGeneratorConfigError("The room size must be at least 2!")
+    if not 0 <= wall_density <= 1:
+        raise InvalidGeneratorConfigError("The wall density must be within [0, 1]!")
+
+    rng = np.random.default_rng(seed)
+    grid_info = {"rows": rows, "columns": columns, "style": style, "start": (0, 0)}
+    if style == "maze":
+        grid_info["goal"] = (2 * ((rows + 1) // 2 - 1), 2 * ((columns + 1) // 2 - 1))
+        grid_rows = _maze_rows(rows, columns, rng)
+    else:
+        grid_info["goal"] = (rows - 1, columns - 1)
+        grid_info["down_columns"] = _monotone_path(rows, columns, rng)
+        grid_rows = _open_rows(
+            rows,
+            columns,
+            wall_density,
+            rng,
+            grid_info["down_columns"],
+            room_size=room_size if style == "rooms" else None,
+        )
+
+    border = b"-" * (2 * columns + 1) + b"\n"
+    with open(grid_path, "wb") as grid_file:
+        grid_file.write(border)
+        for cells in grid_rows:
+            _write_row(grid_file, cells)
+        grid_file.write(border)
+
+    return grid_info
+
+
+def _random_teleport(grid_info: dict, rng: np.random.Generator) -> tuple:
+    # Returns (row, column, action, target_row, target_column) for a teleport that can't
+    # disconnect 'G' from 'S'
+    rows, columns = grid_info["rows"], grid_info["columns"]
+    if grid_info["style"] == "maze":
+        # Only from passages towards the walls next to them, which are always walls, so the
+        # teleport adds a way out of the cell instead of replacing one. Every maze cell can
+        # reach 'G', so any of them is a valid target.
+        if rng.random() < 0.5:
+            row = 2 * int(rng.integers(0, (rows + 1) // 2))
+            column = 2 * int(rng.integers(0, columns // 2)) + 1
+            action = ["U", "D"][int(rng.integers(0, 2))]
+        else:
+            row = 2 * int(rng.integers(0, rows // 2)) + 1
+            column = 2 * int(rng.integers(0, (columns + 1) // 2))
+            action = ["L", "R"][int(rng.integers(0, 2))]
+        target_row = 2 * int(rng.integers(0, (rows + 1) // 2))
+        target_column = 2 * int(rng.integers(0, (columns + 1) // 2))
+        return (row, column, action, target_row, target_column)
+
+    # Never from the guaranteed path, so its moves are kept, and always to a cell on it
+    down_columns = grid_info["down_columns"]
+    while True:
+        row = int(rng.integers(0, rows))
+        column = int(rng.integers(0, columns))
+        path = _path_row(row, down_columns)
+        if not path.start <= column < path.stop:
+            break
+    action = _ACTIONS[int(rng.integers(0, len(_ACTIONS)))]
+    target_row = int(rng.integers(0, rows))
+    path = _path_row(target_row, down_columns)
+    target_column = int(rng.integers(path.start, path.stop))
+    return (row, column, action, target_row, target_column)
+
+
+def _write_rules(
+    rules_file: TextIO,
+    grid_info: dict,
+    n_custom_rewards: int,
+    n_teleports: int,
+    reward_range: tuple,
+    default_reward: int,
+    rng: np.random.Generator,
+) -> None:
+    rules_file.write("[ACTIONS]\n" + "\n".join(_ACTIONS) + "\n\n")
+    rules_file.write(f"[REWARDS]\nDEFAULT = {default_reward}\n")
+    for _ in range(n_custom_rewards):
+        row = int(rng.integers(0, grid_info["rows"]))
+        column = int(rng.integers(0, grid_info["columns"]))
+        action = _ACTIONS[int(rng.integers(0, len(_ACTIONS)))]
+        reward = int(rng.integers(reward_range[0], reward_range[1] + 1))
+        rules_file.write(f"{row},{column}-{action} = {reward}\n")
+
+    rules_file.write("\n[TRANSITIONS]\n")
+    for _ in range(n_teleports):
+        row, column, action, target_row, target_column = _random_teleport(grid_info, rng)
+        rules_file.write(f"{row},{column}-{action}-{target_row},{target_column} = DEFAULT\n")
+
+
+def generate_rules(
+    rules_path: str,
+    grid_info: dict,
+    n_custom_rewards: int = 0,
+    n_teleports: int = 0,
+    reward_range: tuple = (-5, 5),
+    default_reward: int = -1,
+    seed: int = None,
+) -> None:
+    """
+    Write a rules file for a grid made by generate_grid, with all actions, n_custom_rewards
+    random custom rewards within reward_range and n_teleports random teleports. Teleports
+    are placed so that 'G' stays reachable from 'S'.
+    """
+    maze_too_small = (grid_info["rows"] < 2) or (grid_info["columns"] < 2)
+    if (grid_info["style"] == "maze") and maze_too_small and (n_teleports > 0):
+        raise InvalidGeneratorConfigError("No cells left for teleports!")
+    if (grid_info["style"] != "maze") and (n_teleports > 0):
+        # The guaranteed path covers rows + columns - 1 cells, including 'S' and 'G'
+        if grid_info["rows"] + grid_info["columns"] - 1 >= grid_info["rows"] * grid_info["columns"]:
+            raise InvalidGeneratorConfigError("No cells left for teleports!")
+
+    rng = np.random.default_rng(seed)
+    with open(rules_path, "w") as rules_file:
+        _write_rules(
+            rules_file,
+            grid_info,
+            n_custom_rewards,
+            n_teleports,
+            reward_range,
+            default_reward,
+            rng,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a random Gridworld grid")
+    parser.add_argument("grid_path")
+    parser.add_argument("rows", type=int)
+    parser.add_argument("columns", type=int)
+    parser.add_argument("--style", default="open", choices=_STYLES)
+    parser.add_argument("--wall-density", type=float, default=0.2)
+    parser.add_argument("--room-size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--rules-path", default=None, help="Also write a matching rules file")
+    parser.add_argument("--custom-rewards", type=int, default=0)
+    parser.add_argument("--teleports", type=int, default=0)
+    args = parser.parse_args()
+
+    generated_grid = generate_grid(
+        args.grid_path,
+        args.rows,
+        args.columns,
+        style=args.style,
+        wall_density=args.wall_density,
+        room_size=args.room_size,
+        seed=args.seed,
+    )
+    if args.rules_path is not None:
+        generate_rules(
+            args.rules_path,
+            generated_grid,
+            n_custom_rewards=args.custom_rewards,
+            n_teleports=args.teleports,
+            seed=args.seed,
+        )
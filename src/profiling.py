@@ -0,0 +1,94 @@
+from typing import Callable
+import functools
+import time
+
+
+class Profiler:
+    """
+    Cumulative wall time and call counts per phase, plus named counters. Instrumented code
+    only touches a Profiler when one is attached, so there's no cost when profiling is off.
+    """
+
+    def __init__(self) -> None:
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        # Phases measured inside another phase, mapped to it
+        self.parents = {}
+
+    def add(self, phase: str, elapsed: float) -> None:
+        self.times[phase] = self.times.get(phase, 0) + elapsed
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def lap(self, phase: str, start: float) -> float:
+        # Charge the time since start to phase, and return the end so it can start the next one
+        end = time.perf_counter()
+        self.add(phase, end - start)
+        return end
+
+    def nest(self, phase: str, parent: str) -> None:
+        # phase runs inside parent, so its time is already part of the time of parent
+        self.parents[phase] = parent
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name: str, value) -> None:
+        self.counters[name] = value
+
+    def wrap(self, phase: str, func: Callable) -> Callable:
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+
+        return profiled
+
+    def reset(self) -> None:
+        self.times.clear()
+        self.calls.clear()
+        self.counters.clear()
+
+    def snapshot(self) -> dict:
+        """
+        Copy of the current measurements: {"phases": {phase: {"time", "calls", "mean"}},
+        "counters": {name: value}}. Times are in seconds.
+        """
+        phases = {}
+        for phase, total in self.times.items():
+            calls = self.calls[phase]
+            phases[phase] = {"time": total, "calls": calls, "mean": total / calls}
+        return {"phases": phases, "counters": dict(self.counters)}
+
+    def report(self) -> str:
+        # Phases sorted by cumulative time, with their share of the total. Nested phases are
+        # listed under their parent and left out of the total, so they aren't counted twice.
+        phases = self.snapshot()["phases"]
+        nested = {
+            name: parent
+            for name, parent in self.parents.items()
+            if (name in phases) and (parent in phases)
+        }
+        total = sum(phase["time"] for name, phase in phases.items() if name not in nested)
+
+        def by_time(names):
+            return sorted(names, key=lambda name: phases[name]["time"], reverse=True)
+
+        def line(label, phase):
+            share = phase["time"] / total if total > 0 else 0
+            return (
+                f"{label:<24}{phase['calls']:>10}{phase['time']:>12.4f}"
+                f"{phase['mean'] * 1e6:>12.2f}{share:>8.1%}"
+            )
+
+        lines = [f"{'phase':<24}{'calls':>10}{'total_s':>12}{'mean_us':>12}{'share':>8}"]
+        for name in by_time(name for name in phases if name not in nested):
+            lines.append(line(name, phases[name]))
+            for child in by_time(child for child, parent in nested.items() if parent == name):
+                lines.append(line(f"  {child}", phases[child]))
+        for name, value in self.counters.items():
+            lines.append(f"{name:<24}{value:>10}")
+        return "\n".join(lines)
@@ -0,0 +1,57 @@
+import numpy as np
+
+# One transition per entry, states and actions are the agent's ids
+REPLAY_DTYPE = np.dtype(
+    [
+        ("state", "<i4"),
+        ("action", "<i4"),
+        ("reward", "<f8"),
+        ("next_state", "<i4"),
+    ]
+)
+
+
+class ReplayBuffer:
+    """
+    Fixed capacity ring buffer of real transitions, preallocated as a structured array, so its
+    memory (nbytes) is known up front. Inserting is O(1) and overwrites the oldest transition
+    once the buffer is full.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=REPLAY_DTYPE)
+        # Index where the next transition goes, and number of valid transitions
+        self.position = 0
+        self.size = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, state: int, action: int, reward: float, next_state: int) -> None:
+        self.data[self.position] = (state, action, reward, next_state)
+        self.position = (self.position + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def sample(
+        self, batch_size: int, rng: np.random.Generator, recency_scale: float = None
+    ) -> np.ndarray:
+        """
+        Copy of batch_size transitions sampled with replacement. Uniform if recency_scale is
+        None, otherwise a transition inserted a transitions ago is drawn with probability
+        proportional to exp(-a / recency_scale).
+        """
+        if recency_scale is None:
+            indices = rng.integers(0, self.size, size=batch_size)
+            return self.data[indices]
+
+        # Inverse CDF of the exponential truncated to ages in [0, size)
+        uniforms = rng.random(batch_size)
+        ages = -recency_scale * np.log1p(-uniforms * -np.expm1(-self.size / recency_scale))
+        ages = np.minimum(ages.astype(np.int64), self.size - 1)
+        return self.data[(self.position - 1 - ages) % self.capacity]
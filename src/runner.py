@@ -1,6 +1,7 @@
 import os
 from grid_env import Gridworld
 from dyna_agent import DynaAgent
+from solver import value_iteration, policy_steps
 
 if __name__ == "__main__":
     file_path = os.path.dirname(__file__)
@@ -13,7 +14,7 @@ if __name__ == "__main__":
     myGridworld = Gridworld(grid_path, rules_path)
     # myGridworld.print_grid()
 
-    # TODO test random epsilon and alfa values, store results, plot and find best
+    # Use sweep.py to test many epsilon and alfa values and store the results
     n_episodes = 100
     myDynaAgent = DynaAgent(
         myGridworld,
@@ -28,12 +29,8 @@ if __name__ == "__main__":
         gamma=1,
     )
 
-    steps_per_episode = [0] * n_episodes
-    for i in range(n_episodes):
-        myDynaAgent.init_round(method="default")
-        while not myDynaAgent.finished():
-            myDynaAgent.play_step(n_updates=50)
-        steps_per_episode[i] = myDynaAgent.steps
+    results = myDynaAgent.run_episodes(n_episodes, init_method="default", n_updates=50)
+    steps_per_episode = results["steps"]
 
     # Repeat with epsilon set to 0 to see how close are we to the optimal policy
     # myDynaAgent.epsilon = 0
@@ -42,4 +39,8 @@ if __name__ == "__main__":
     while not myDynaAgent.finished():
         myDynaAgent.play_step(n_updates=0, verbose=True)
     final_steps = myDynaAgent.steps
+
+    # Optimal number of steps from the default start state, for comparison
+    _, optimal_policy, _ = value_iteration(myGridworld, gamma=1)
+    optimal_steps = policy_steps(myGridworld, optimal_policy)
     pass
@@ -0,0 +1,206 @@
+from typing import Tuple
+import time
+
+import numpy as np
+
+try:
+    from grid_env import Gridworld  # Works with normal code
+except ModuleNotFoundError:
+    from src.grid_env import Gridworld  # Works when called from unittest
+
+
+def _action_values(env: Gridworld, values: np.ndarray, gamma: float) -> np.ndarray:
+    # Q(s, a) for every state-action pair, -inf for invalid actions
+    if env.stochastic:
+        # Expectation over the outcomes of each pair. Outcomes with probability 0 are left out,
+        # as they can lead to states with a value of -inf
+        returns = env.outcome_rewards + gamma * values[env.outcome_next_states]
+        returns = np.where(env.outcome_probs > 0, returns, 0)
+        qvalues = (env.outcome_probs * returns).sum(axis=2)
+    else:
+        qvalues = env.reward_table + gamma * values[env.next_state_table]
+    return np.where(env.action_mask, qvalues, -np.inf)
+
+
+def _policy_values(
+    env: Gridworld, values: np.ndarray, gamma: float, states: np.ndarray, actions: np.ndarray
+) -> np.ndarray:
+    # Q(s, policy(s)) for every state
+    if env.stochastic:
+        returns = (
+            env.outcome_rewards[states, actions]
+            + gamma * values[env.outcome_next_states[states, actions]]
+        )
+        probs = env.outcome_probs[states, actions]
+        return (probs * np.where(probs > 0, returns, 0)).sum(axis=1)
+    return env.reward_table[states, actions] + gamma * values[env.next_state_table[states, actions]]
+
+
+def _greedy_policy(env: Gridworld, qvalues: np.ndarray, terminal: np.ndarray) -> np.ndarray:
+    # Action id with the highest value in each state, -1 for terminal states. States where
+    # every action has a value of -inf get their first valid action.
+    best_actions = np.where(
+        np.isneginf(qvalues.max(axis=1)), env.action_mask.argmax(axis=1), qvalues.argmax(axis=1)
+    )
+    return np.where(terminal, -1, best_actions)
+
+
+def _reaching_states(env: Gridworld, terminal: np.ndarray) -> np.ndarray:
+    # Whether each state can reach a terminal state, by a breadth-first search backwards from
+    # the terminal states over the transitions with a positive probability
+    if env.stochastic:
+        sources, actions, outcomes = np.nonzero(
+            env.action_mask[:, :, None] & (env.outcome_probs > 0)
+        )
+        targets = env.outcome_next_states[sources, actions, outcomes]
+    else:
+        sources, actions = np.nonzero(env.action_mask)
+        targets = env.next_state_table[sources, actions]
+
+    # Sources of the transitions into each state, grouped by target
+    order = np.argsort(targets, kind="stable")
+    sorted_sources = sources[order]
+    offsets = np.zeros(len(terminal) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(targets, minlength=len(terminal)), out=offsets[1:])
+
+    reaching = terminal.copy()
+    frontier = np.flatnonzero(terminal)
+    while len(frontier) > 0:
+        starts = offsets[frontier]
+        lengths = offsets[frontier + 1] - starts
+        # Positions of all the transitions into the frontier in sorted_sources
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(
+            lengths.sum()
+        )
+        predecessors = np.unique(sorted_sources[positions])
+        frontier = predecessors[~reaching[predecessors]]
+        reaching[frontier] = True
+    return reaching
+
+
+def _solved_states(env: Gridworld, gamma: float, terminal: np.ndarray) -> np.ndarray:
+    # States whose values are backed up. Without discount, states that can't reach a terminal
+    # state have no finite value: they're left out and keep a value of -inf.
+    if gamma < 1:
+        return ~terminal
+    return _reaching_states(env, terminal) & ~terminal
+
+
+def value_iteration(
+    env: Gridworld, gamma: float = 1, tolerance: float = 1e-6, max_iterations: int = 10000
+) -> Tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Solve the Gridworld by value iteration over its compiled transition tables.
+    Returns the optimal state values, the greedy policy as action ids (-1 for terminal
+    states) and a dict of stats: iterations, final delta, converged, unsolved and time in
+    seconds. With gamma = 1, the unsolved states that can't reach a terminal state get a
+    value of -inf and their first valid action, and aren't part of the delta.
+    States and actions are the ids of Gridworld.compile_dynamics().
+    """
+    env.compile_dynamics()
+    start_time = time.perf_counter()
+    terminal = ~env.action_mask.any(axis=1)
+    solved = _solved_states(env, gamma, terminal)
+    # Terminal states have no actions and keep a value of 0
+    values = np.where(solved | terminal, 0.0, -np.inf)
+
+    delta = np.inf
+    iterations = 0
+    while (delta > tolerance) and (iterations < max_iterations):
+        new_values = np.where(solved, _action_values(env, values, gamma).max(axis=1), values)
+        delta = np.abs(new_values[solved] - values[solved]).max(initial=0)
+        values = new_values
+        iterations += 1
+
+    policy = _greedy_policy(env, _action_values(env, values, gamma), terminal)
+    stats = {
+        "iterations": iterations,
+        "delta": float(delta),
+        "converged": bool(delta <= tolerance),
+        "unsolved": int((~solved & ~terminal).sum()),
+        "time": time.perf_counter() - start_time,
+    }
+    return (values, policy, stats)
+
+
+def policy_iteration(
+    env: Gridworld,
+    gamma: float = 1,
+    tolerance: float = 1e-6,
+    max_iterations: int = 1000,
+    max_evaluation_iterations: int = 100,
+) -> Tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Solve the Gridworld by policy iteration over its compiled transition tables, using
+    iterative policy evaluation truncated to max_evaluation_iterations sweeps (policies that
+    never reach the goal have diverging values when gamma is 1). Returns the same values,
+    policy and stats as value_iteration, with stats also counting the evaluation sweeps.
+    """
+    env.compile_dynamics()
+    start_time = time.perf_counter()
+    terminal = ~env.action_mask.any(axis=1)
+    solved = _solved_states(env, gamma, terminal)
+    states = np.arange(len(env.state_coords))
+    values = np.where(solved | terminal, 0.0, -np.inf)
+    # Start with the first valid action of each state
+    policy = np.where(terminal, -1, env.action_mask.argmax(axis=1))
+    policy_actions = np.maximum(policy, 0)
+
+    iterations = 0
+    evaluation_sweeps = 0
+    stable = False
+    while (not stable) and (iterations < max_iterations):
+        # Policy evaluation
+        delta = np.inf
+        evaluation_iterations = 0
+        while (delta > tolerance) and (evaluation_iterations < max_evaluation_iterations):
+            policy_values = _policy_values(env, values, gamma, states, policy_actions)
+            new_values = np.where(solved, policy_values, values)
+            delta = np.abs(new_values[solved] - values[solved]).max(initial=0)
+            values = new_values
+            evaluation_iterations += 1
+        evaluation_sweeps += evaluation_iterations
+
+        # Policy improvement, keeping the current action when it's still among the best
+        qvalues = _action_values(env, values, gamma)
+        best_values = qvalues.max(axis=1)
+        keep = qvalues[states, policy_actions] >= best_values - tolerance
+        new_policy = np.where(keep, policy, _greedy_policy(env, qvalues, terminal))
+        stable = bool((new_policy == policy).all())
+        policy = new_policy
+        policy_actions = np.maximum(policy, 0)
+        iterations += 1
+
+    stats = {
+        "iterations": iterations,
+        "evaluation_sweeps": evaluation_sweeps,
+        "converged": stable and bool(delta <= tolerance),
+        "unsolved": int((~solved & ~terminal).sum()),
+        "time": time.perf_counter() - start_time,
+    }
+    return (values, policy, stats)
+
+
+def policy_steps(
+    env: Gridworld, policy: np.ndarray, state: Tuple[int, int] = None, max_steps: int = None
+) -> int:
+    """
+    Number of steps the policy takes to reach a terminal state from state (the default start
+    state if None). Returns -1 if it doesn't get there within max_steps (number of states if
+    None), which with deterministic dynamics means it never will. With stochastic rules it
+    follows the intended moves only.
+    """
+    env.compile_dynamics()
+    if state is None:
+        state = env._default_start_state
+    if max_steps is None:
+        max_steps = len(env.state_coords)
+
+    state_id = env.state_ids[state]
+    steps = 0
+    while policy[state_id] >= 0:
+        if steps >= max_steps:
+            return -1
+        state_id = env.next_state_table[state_id, policy[state_id]]
+        steps += 1
+    return steps
@@ -0,0 +1,290 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Tuple
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+
+import numpy as np
+
+try:
+    from grid_env import Gridworld, SharedLayout  # Works with normal code
+    from dyna_agent import DynaAgent
+except ModuleNotFoundError:
+    from src.grid_env import Gridworld, SharedLayout  # Works when called from unittest
+    from src.dyna_agent import DynaAgent
+
+
+# Config keys that are passed to play_step instead of the DynaAgent constructor
+_PLAY_STEP_ARGS = ["n_updates"]
+
+# Config keys that only take integers, so their (low, high) ranges are sampled as integers
+_INTEGER_PARAMS = [
+    "n_updates",
+    "decay_eps_episodes",
+    "decay_alfa_episodes",
+    "max_outcomes",
+    "replay_capacity",
+]
+
+# Gridworld built once per worker process and reused by all its jobs
+_worker_envs = {}
+
+# Part of every job id, bump when the same job no longer gives the same results so that
+# shards from older runs aren't resumed. Version 2 made dict dynamics hash seed independent.
+_JOB_VERSION = 2
+
+
+class SweepJobError(Exception):
+    """
+    Raised by run_sweep once every run has finished when some of them failed. The runs that
+    succeeded are saved, so running the sweep again only retries the failed ones.
+    """
+
+    pass
+
+
+def grid_configs(param_grid: dict) -> list:
+    """All combinations of the values in param_grid, e.g. {"epsilon": [0.05, 0.1]}"""
+    names = sorted(param_grid.keys())
+    return [
+        dict(zip(names, values)) for values in itertools.product(*(param_grid[n] for n in names))
+    ]
+
+
+def random_configs(param_distributions: dict, n_configs: int, seed: int = None) -> list:
+    """
+    n_configs random configs. Each distribution is either a list of values to choose from or
+    a (low, high) tuple to sample uniformly from. Ranges of integer parameters (n_updates,
+    decay_*_episodes, ...) or with two int bounds are sampled as integers, bounds included.
+    """
+    rng = random.Random(seed)
+    configs = []
+    for _ in range(n_configs):
+        config = {}
+        for name in sorted(param_distributions.keys()):
+            distribution = param_distributions[name]
+            if isinstance(distribution, tuple):
+                low, high = distribution
+                if (name in _INTEGER_PARAMS) or all(isinstance(v, int) for v in distribution):
+                    config[name] = rng.randint(math.ceil(low), math.floor(high))
+                else:
+                    config[name] = rng.uniform(low, high)
+            else:
+                config[name] = rng.choice(distribution)
+        configs.append(config)
+    return configs
+
+
+def _job_id(config: dict, seed: int, run_args: dict) -> str:
+    # Same config, seed and run arguments always map to the same job, which is what resume uses
+    key = json.dumps(
+        {"config": config, "seed": seed, "run": run_args, "version": _JOB_VERSION}, sort_keys=True
+    )
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _attach_shared_env(grid_path: str, rules_path: str, spec: dict) -> None:
+    # Worker initializer, so jobs find the shared Gridworld instead of building their own
+    _worker_envs[(grid_path, rules_path)] = Gridworld.from_shared(spec)
+
+
+def _run_job(
+    grid_path: str, rules_path: str, config: dict, seed: int, run_args: dict, cache_dir: str = None
+) -> np.ndarray:
+    random.seed(seed)
+    np.random.seed(seed)
+
+    if (grid_path, rules_path) not in _worker_envs:
+        if cache_dir is not None:
+            env = Gridworld(grid_path, rules_path, dynamics="compiled", cache_dir=cache_dir)
+        else:
+            env = Gridworld(grid_path, rules_path)
+        _worker_envs[(grid_path, rules_path)] = env
+    env = _worker_envs[(grid_path, rules_path)]
+
+    agent_args = {k: v for k, v in config.items() if k not in _PLAY_STEP_ARGS}
+    play_step_args = {k: v for k, v in config.items() if k in _PLAY_STEP_ARGS}
+    agent = DynaAgent(env, seed=seed, **agent_args)
+
+    results = agent.run_episodes(
+        run_args["n_episodes"],
+        init_method=run_args["init_method"],
+        max_steps=run_args["max_steps"],
+        **play_step_args,
+    )
+    return results["steps"].astype(np.int32)
+
+
+def _save_shard(path: str, steps_per_episode: np.ndarray) -> None:
+    # Write to a temporary file first so an interrupted run never leaves a partial shard
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as shard_file:
+        np.save(shard_file, steps_per_episode)
+    os.replace(tmp_path, path)
+
+
+def _merge_shards(jobs: list, runs_dir: str, results_path: str) -> None:
+    names = sorted(set(name for _, config, _ in jobs for name in config.keys()))
+    columns = {
+        "job_id": np.array([job_id for job_id, _, _ in jobs]),
+        "seed": np.array([seed for _, _, seed in jobs], dtype=np.int64),
+        "steps": np.stack(
+            [np.load(os.path.join(runs_dir, f"{job_id}.npy")) for job_id, _, _ in jobs]
+        ),
+    }
+    for name in names:
+        values = [config.get(name) for _, config, _ in jobs]
+        if all(isinstance(v, (int, float)) or v is None for v in values):
+            columns[name] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        else:
+            columns[name] = np.array(["" if v is None else str(v) for v in values])
+    np.savez(results_path, **columns)
+
+
+def run_sweep(
+    grid_path: str,
+    rules_path: str,
+    configs: list,
+    seeds: list,
+    output_dir: str,
+    n_episodes: int = 100,
+    init_method: str = "default",
+    max_steps: int = None,
+    n_workers: int = None,
+    share_env: bool = False,
+    cache_dir: str = None,
+) -> Tuple[str, int]:
+    """
+    Train one DynaAgent per config and seed on a process pool (all cores if n_workers is
+    None). Each finished run is stored as a shard in output_dir/runs, and shards that already
+    exist are skipped, so an interrupted sweep resumes where it stopped. Once every run is
+    done they are merged into output_dir/results.npz, with one column per config parameter
+    plus job_id, seed and steps (n_runs x n_episodes).
+    With share_env the compiled Gridworld is published once in shared memory and every
+    worker attaches to it, instead of each worker building its own copy.
+    With cache_dir workers load the compiled Gridworld from the Gridworld cache in that
+    directory, which is filled once before starting them.
+    A run that fails doesn't stop the others: once they're all done, SweepJobError lists the
+    failed ones and results aren't merged.
+    Returns the results path and the number of runs executed by this call.
+    """
+    runs_dir = os.path.join(output_dir, "runs")
+    os.makedirs(runs_dir, exist_ok=True)
+
+    # Shared (compiled) and dict dynamics give the same runs, so they share job ids
+    run_args = {"n_episodes": n_episodes, "init_method": init_method, "max_steps": max_steps}
+    jobs = [(_job_id(config, seed, run_args), config, seed) for config in configs for seed in seeds]
+    pending = [job for job in jobs if not os.path.exists(os.path.join(runs_dir, f"{job[0]}.npy"))]
+
+    if len(pending) > 0:
+        layout = None
+        executor_args = {}
+        if share_env:
+            layout = SharedLayout(
+                Gridworld(grid_path, rules_path, dynamics="compiled", cache_dir=cache_dir)
+            )
+            executor_args["initializer"] = _attach_shared_env
+            executor_args["initargs"] = (grid_path, rules_path, layout.spec)
+        elif cache_dir is not None:
+            Gridworld(grid_path, rules_path, dynamics="compiled", cache_dir=cache_dir)
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers, **executor_args) as executor:
+                futures = {
+                    executor.submit(
+                        _run_job, grid_path, rules_path, config, seed, run_args, cache_dir
+                    ): job_id
+                    for job_id, config, seed in pending
+                }
+                failures = {}
+                for future in as_completed(futures):
+                    job_id = futures[future]
+                    try:
+                        steps_per_episode = future.result()
+                    except Exception as error:
+                        failures[job_id] = error
+                        continue
+                    _save_shard(os.path.join(runs_dir, f"{job_id}.npy"), steps_per_episode)
+        finally:
+            if layout is not None:
+                layout.close()
+        if len(failures) > 0:
+            details = "; ".join(f"{job_id}: {error!r}" for job_id, error in failures.items())
+            raise SweepJobError(
+                f"{len(failures)} of {len(pending)} runs failed: {details}"
+            ) from next(iter(failures.values()))
+
+    results_path = os.path.join(output_dir, "results.npz")
+    _merge_shards(jobs, runs_dir, results_path)
+    return (results_path, len(pending))
+
+
+def _parse_value(value: str):
+    for value_type in [int, float]:
+        try:
+            return value_type(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _parse_params(params: list) -> dict:
+    # "name=v1,v2,..." for grids, "name=low:high" for uniform distributions
+    parsed = {}
+    for param in params:
+        name, values = param.split("=")
+        if ":" in values:
+            low, high = values.split(":")
+            bound_type = int if name in _INTEGER_PARAMS else float
+            parsed[name] = (bound_type(low), bound_type(high))
+        else:
+            parsed[name] = [_parse_value(v) for v in values.split(",")]
+    return parsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep of DynaAgent")
+    parser.add_argument("grid_path")
+    parser.add_argument("rules_path")
+    parser.add_argument("output_dir")
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        help="name=v1,v2 to try every value, name=low:high to sample uniformly (needs --random)",
+    )
+    parser.add_argument("--random", type=int, default=None, help="Number of random configs")
+    parser.add_argument("--seeds", default="0", help="Comma separated seeds")
+    parser.add_argument("--episodes", type=int, default=100)
+    parser.add_argument("--init-method", default="default")
+    parser.add_argument("--max-steps", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--share-env", action="store_true", help="Share one compiled grid between workers"
+    )
+    parser.add_argument("--cache-dir", default=None, help="Cache of compiled grids")
+    args = parser.parse_args()
+
+    params = _parse_params(args.param)
+    if args.random is not None:
+        sweep_configs = random_configs(params, args.random, seed=0)
+    else:
+        sweep_configs = grid_configs(params)
+
+    results_path, n_executed = run_sweep(
+        args.grid_path,
+        args.rules_path,
+        sweep_configs,
+        [int(seed) for seed in args.seeds.split(",")],
+        args.output_dir,
+        n_episodes=args.episodes,
+        init_method=args.init_method,
+        max_steps=args.max_steps,
+        n_workers=args.workers,
+        share_env=args.share_env,
+        cache_dir=args.cache_dir,
+    )
+    print(f"{n_executed} runs executed, results in {results_path}")
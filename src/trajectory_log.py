@@ -0,0 +1,200 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+
+# Bump when the record layout or the files of a log change
+_LOG_FORMAT_VERSION = 1
+
+# One fixed width (17 bytes), packed record per step
+TRAJECTORY_DTYPE = np.dtype(
+    [
+        ("state", "<i4"),
+        ("action", "u1"),
+        ("reward", "<f4"),
+        ("next_state", "<i4"),
+        ("episode", "<i4"),
+    ]
+)
+
+
+class InvalidTrajectoryLogError(Exception):
+    """
+    Raised when a trajectory log directory has no metadata, was written by an incompatible
+    version, or is opened for appending with other actions than the ones it was created with.
+    """
+
+    pass
+
+
+def _chunk_paths(path: str) -> list:
+    return sorted(glob.glob(os.path.join(path, "chunk_*.bin")))
+
+
+def _chunk_path(path: str, index: int) -> str:
+    return os.path.join(path, f"chunk_{index:06d}.bin")
+
+
+class TrajectoryWriter:
+    """
+    Append-only log of transitions in the directory path, as raw TRAJECTORY_DTYPE records in
+    chunk files of chunk_records records each, plus meta.json. States are ids in the order of
+    get_all_possible_states() and actions are indices into actions. Records are buffered in
+    memory and written every buffer_records appends, on flush() and on close(). Opening an
+    existing log appends to it, dropping a partial record left by an interrupted write.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        actions: list,
+        chunk_records: int = 1_000_000,
+        buffer_records: int = 65536,
+    ) -> None:
+        self.path = path
+        self.actions = list(actions)
+        self.action_ids = {action: i for i, action in enumerate(self.actions)}
+        self.buffer_records = buffer_records
+        os.makedirs(path, exist_ok=True)
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            meta = _load_meta(path)
+            if meta["actions"] != self.actions:
+                raise InvalidTrajectoryLogError("Log was created with other actions!")
+            self.chunk_records = meta["chunk_records"]
+        else:
+            self.chunk_records = chunk_records
+            meta = {
+                "version": _LOG_FORMAT_VERSION,
+                "actions": self.actions,
+                "chunk_records": chunk_records,
+                "dtype": TRAJECTORY_DTYPE.descr,
+            }
+            with open(meta_path, "w") as meta_file:
+                json.dump(meta, meta_file)
+
+        # Continue after the last complete record of the last chunk
+        chunk_paths = _chunk_paths(path)
+        self._chunk_index = max(len(chunk_paths) - 1, 0)
+        self._chunk_count = 0
+        self._n_written = 0
+        for chunk_path in chunk_paths:
+            n_records = os.path.getsize(chunk_path) // TRAJECTORY_DTYPE.itemsize
+            self._n_written += n_records
+            self._chunk_count = n_records
+        if len(chunk_paths) > 0:
+            os.truncate(chunk_paths[-1], self._chunk_count * TRAJECTORY_DTYPE.itemsize)
+
+        self._file = None
+        self._buffer = []
+
+    def append(self, episode: int, state: int, action: int, reward: float, next_state: int):
+        self._buffer.append((state, action, reward, next_state, episode))
+        if len(self._buffer) >= self.buffer_records:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self._buffer) == 0:
+            return
+        records = np.array(self._buffer, dtype=TRAJECTORY_DTYPE)
+
+        start = 0
+        try:
+            while start < len(records):
+                if self._chunk_count == self.chunk_records:
+                    # The file isn't open yet when appending to a log whose last chunk is full
+                    if self._file is not None:
+                        self._file.close()
+                        self._file = None
+                    self._chunk_index += 1
+                    self._chunk_count = 0
+                if self._file is None:
+                    self._file = open(_chunk_path(self.path, self._chunk_index), "ab")
+
+                n_records = min(len(records) - start, self.chunk_records - self._chunk_count)
+                records[start : start + n_records].tofile(self._file)
+                self._chunk_count += n_records
+                start += n_records
+            self._file.flush()
+        finally:
+            # Only drop the records that were written, a failed flush keeps the rest buffered
+            del self._buffer[:start]
+            self._n_written += start
+
+    def close(self) -> None:
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self) -> int:
+        return self._n_written + len(self._buffer)
+
+    def __enter__(self) -> "TrajectoryWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class TrajectoryReader:
+    """
+    Read-only view of a log written by TrajectoryWriter. Chunks are memory-mapped, so nothing
+    is read until it's accessed, and records flushed after opening aren't seen.
+    """
+
+    def __init__(self, path: str) -> None:
+        meta = _load_meta(path)
+        self.path = path
+        self.actions = meta["actions"]
+        self.chunk_records = meta["chunk_records"]
+
+        self._chunks = []
+        for chunk_path in _chunk_paths(path):
+            # A partial record at the end of the last chunk is still being written
+            n_records = os.path.getsize(chunk_path) // TRAJECTORY_DTYPE.itemsize
+            if n_records > 0:
+                self._chunks.append(
+                    np.memmap(chunk_path, dtype=TRAJECTORY_DTYPE, mode="r", shape=(n_records,))
+                )
+        self._offsets = np.cumsum([0] + [len(chunk) for chunk in self._chunks])
+
+    def __len__(self) -> int:
+        return int(self._offsets[-1])
+
+    @property
+    def n_chunks(self) -> int:
+        return len(self._chunks)
+
+    def chunk(self, index: int) -> np.memmap:
+        return self._chunks[index]
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def read(self, start: int = 0, stop: int = None) -> np.ndarray:
+        """Copy of the records in [start, stop), only touching the chunks that hold them"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = []
+        for i, chunk in enumerate(self._chunks):
+            chunk_start = max(start - self._offsets[i], 0)
+            chunk_stop = min(stop - self._offsets[i], len(chunk))
+            if chunk_start < chunk_stop:
+                parts.append(chunk[chunk_start:chunk_stop])
+        if len(parts) == 0:
+            return np.zeros(0, dtype=TRAJECTORY_DTYPE)
+        return np.concatenate(parts)
+
+
+def _load_meta(path: str) -> dict:
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        raise InvalidTrajectoryLogError(f"No trajectory log in {path}")
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    if meta["version"] != _LOG_FORMAT_VERSION:
+        raise InvalidTrajectoryLogError("Trajectory log written by an incompatible version!")
+    return meta
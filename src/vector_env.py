@@ -0,0 +1,115 @@
+from typing import Tuple
+import numpy as np
+
+try:
+    from base_env import Environment  # Works with normal code
+    from grid_env import Gridworld, InvalidActionError
+except ModuleNotFoundError:
+    from src.base_env import Environment  # Works when called from unittest
+    from src.grid_env import Gridworld, InvalidActionError
+
+
+class InvalidInitMethodError(Exception):
+    """
+    Raised when the reset method of finished slots is not:
+     - "default"
+     - "random"
+    """
+
+    pass
+
+
+class VectorGridworld(Environment):
+    """
+    Runs n_envs copies of the same Gridworld layout at once. States, actions, rewards and
+    done flags are arrays of length n_envs, with states and actions given as the integer ids
+    of Gridworld.compile_dynamics(). Slots that reach a terminal state are automatically
+    reset with init_method ("default" or "random").
+    """
+
+    _INIT_METHODS = ["default", "random"]
+
+    def __init__(self, env: Gridworld, n_envs: int, init_method: str = "default") -> None:
+        if init_method not in self._INIT_METHODS:
+            raise InvalidInitMethodError(f"Invalid init method: {init_method}")
+
+        env.compile_dynamics()
+        self.env = env
+        self.n_envs = n_envs
+        self.init_method = init_method
+        self.action_list = env.action_list
+
+        self._next_state_table = env.next_state_table
+        self._reward_table = env.reward_table
+        self._action_mask = env.action_mask
+        # Terminal states are the ones with no actions ('G')
+        self._terminal = ~self._action_mask.any(axis=1)
+        self._start_states = np.flatnonzero(~self._terminal).astype(np.int32)
+        self._default_start_state = env.state_ids[env._default_start_state]
+
+        self.states = np.empty(n_envs, dtype=np.int32)
+        self.initialize(method=init_method)
+
+    def _initial_states(self, method: str, size: int) -> np.ndarray:
+        if method == "default":
+            return np.full(size, self._default_start_state, dtype=np.int32)
+        # Avoid 'X' and 'G'
+        return np.random.choice(self._start_states, size=size)
+
+    def initialize(self, method: str = None, state: Tuple[int, int] = None) -> np.ndarray:
+        if method in self._INIT_METHODS:
+            self.states[:] = self._initial_states(method, self.n_envs)
+        elif state is not None:
+            # Reuse the Gridworld validation of the state
+            self.env.initialize(state=state)
+            self.states[:] = self.env.state_ids[state]
+        else:
+            raise InvalidInitMethodError(f"Invalid init method: {method}")
+
+        return self.states.copy()
+
+    def get_all_possible_states(self) -> list:
+        return self.env.get_all_possible_states()
+
+    def get_possible_actions(self, state: Tuple[int, int] = None) -> np.ndarray:
+        if state is not None:
+            return self.env.get_possible_actions(state)
+        # Action mask of every slot, shape (n_envs, n_actions)
+        return self._action_mask[self.states]
+
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Take one action id per slot. Returns the rewards, the states reached and the done
+        flags. Finished slots are reset afterwards, so the states reached by them differ from
+        the current ones in self.states.
+        """
+        actions = np.asarray(actions)
+        if (actions.shape != (self.n_envs,)) or not np.issubdtype(actions.dtype, np.integer):
+            raise InvalidActionError(
+                f"Expected {self.n_envs} integer action ids, got {actions.dtype} {actions.shape}"
+            )
+        # Negative ids would wrap around to other actions
+        valid = (actions >= 0) & (actions < len(self.action_list))
+        valid[valid] = self._action_mask[self.states[valid], actions[valid]]
+        if not valid.all():
+            invalid_slots = np.flatnonzero(~valid)
+            raise InvalidActionError(f"Invalid actions for slots {invalid_slots.tolist()}")
+
+        if self.env.stochastic:
+            outcomes = self.env.sample_outcomes(self.states, actions, np.random.random(self.n_envs))
+            rewards = self.env.outcome_rewards[self.states, actions, outcomes]
+            new_states = self.env.outcome_next_states[self.states, actions, outcomes]
+        else:
+            rewards = self._reward_table[self.states, actions]
+            new_states = self._next_state_table[self.states, actions]
+        dones = self._terminal[new_states]
+
+        self.states[:] = new_states
+        n_done = int(dones.sum())
+        if n_done > 0:
+            self.states[dones] = self._initial_states(self.init_method, n_done)
+
+        return (rewards, new_states, dones)
+
+    def take_action(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return self.step(actions)
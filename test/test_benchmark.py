@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+
+from src import benchmark
+from src import grid_generator
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_benchmarks(self):
+        results = benchmark.run_benchmarks(
+            [5], n_steps=50, n_updates_list=[0, 2], n_episodes=1, max_episode_steps=100
+        )
+        self.assertIn("numpy", results["machine"])
+        benchmarks = set(result["benchmark"] for result in results["results"])
+        self.assertEqual(benchmarks, {"construction", "take_action", "play_step", "episodes"})
+        for result in results["results"]:
+            if result["benchmark"] in ["take_action", "play_step"]:
+                self.assertEqual(result["calls"], 50)
+                self.assertLessEqual(result["p50_us"], result["p99_us"])
+            elif result["benchmark"] == "construction":
+                self.assertGreater(result["peak_memory_mb"], 0)
+
+    @unittest.skipUnless(os.environ.get("GRIDWORLD_TIMING_TESTS"), "timing tests are opt-in")
+    def test_compiled_take_action_not_slower_than_dict(self):
+        # Compiled dynamics used to be several times slower per step than dict dynamics,
+        # median latencies are compared with some slack for timing noise. Wall-clock checks
+        # are flaky on loaded machines, so they only run with GRIDWORLD_TIMING_TESTS=1.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rules_path = os.path.join(tmp_dir, "rules.config")
+            with open(rules_path, "w") as rules_file:
+                rules_file.write(benchmark._RULES)
+            grid_path = os.path.join(tmp_dir, "grid.txt")
+            grid_generator.generate_grid(grid_path, 50, 50, style="open", wall_density=0.2, seed=0)
+
+            # Interleaved, keeping the best median of each mode
+            p50 = {"dict": [], "compiled": []}
+            for _ in range(5):
+                for dynamics, medians in p50.items():
+                    record = benchmark.bench_take_action(grid_path, rules_path, dynamics, 5000)
+                    medians.append(record["p50_us"])
+        self.assertLessEqual(min(p50["compiled"]), 1.25 * min(p50["dict"]))
@@ -0,0 +1,672 @@
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from src import dyna_agent
+from src import grid_env
+
+
+grid_good_path = "test/config/input_grid_good.txt"
+rules_good_path = "test/config/grid_rules_good.config"
+rules_stochastic_path = "test/config/grid_rules_stochastic.config"
+grid_customT_path = "test/config/input_grid_customT.txt"
+
+# Shortest path from 'S' (3, 0) to 'G' (2, 4) in the good grid
+optimal_steps = 9
+
+
+def train_agent(agent, n_episodes=60, n_updates=20):
+    for _ in range(n_episodes):
+        agent.init_round(method="default")
+        while not agent.finished():
+            agent.play_step(n_updates=n_updates)
+
+
+def greedy_steps(agent, max_steps=100):
+    agent.epsilon = 0
+    agent.init_round(method="default")
+    while (not agent.finished()) and (agent.steps < max_steps):
+        agent.play_step(n_updates=0)
+    return agent.steps
+
+
+class TestDynaAgentStorage(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        np.random.seed(0)
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_dict_storage_learns_optimal_policy(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5)
+        train_agent(agent)
+        self.assertEqual(greedy_steps(agent), optimal_steps)
+
+    def test_array_storage_learns_optimal_policy(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, storage="array")
+        train_agent(agent)
+        self.assertEqual(greedy_steps(agent), optimal_steps)
+
+    def test_array_storage_ucb(self):
+        agent = dyna_agent.DynaAgent(
+            self.gridworld, exploration="ucb", ucb_c=0.5, alfa=0.5, storage="array"
+        )
+        train_agent(agent)
+        agent.ucb_c = 0
+        self.assertEqual(greedy_steps(agent), optimal_steps)
+
+    def test_array_storage_masks_invalid_actions(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, storage="array")
+        goal_id = agent._state_ids[(2, 4)]
+        self.assertTrue(agent._terminal[goal_id])
+        self.assertTrue(np.isneginf(agent._qvalues[goal_id]).all())
+        self.assertTrue((agent._qvalues[agent._state_ids[(3, 0)]] == 0).all())
+
+    def test_array_storage_uses_compiled_tables(self):
+        gridworld = grid_env.Gridworld(grid_customT_path, rules_good_path)
+        agent = dyna_agent.DynaAgent(gridworld, storage="array")
+        # No list of pairs, and state ids are only added when looked up
+        self.assertNotIn("_state_action_pairs", vars(agent))
+        self.assertEqual(len(agent._state_ids), 0)
+        self.assertTrue(agent._qvalues.flags.c_contiguous)
+        for state_id, state in enumerate(gridworld.get_all_possible_states()):
+            self.assertEqual(agent._state_ids[state], state_id)
+            valid_actions = [
+                action
+                for action, valid in zip(agent._actions, agent._valid_actions[state_id])
+                if valid
+            ]
+            self.assertEqual(valid_actions, sorted(gridworld.get_possible_actions(state)))
+        self.assertEqual(agent._n_pairs, agent._valid_actions.sum())
+
+    def test_array_model(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, storage="array")
+        agent.init_round(state=(3, 4))
+        while agent.current_state == (3, 4):
+            agent.play_step(n_updates=0)
+        self.assertGreaterEqual(agent._model_seen.sum(), 1)
+        self.assertLessEqual(agent._model_seen.sum(), agent.steps)
+
+    def test_array_state_values_follow_qvalues(self):
+        for kwargs in [
+            {"exploration": "ucb"},
+            {"planning": "prioritized"},
+            {"planning": "batched"},
+            {"model": "stochastic"},
+            {"replay_capacity": 20},
+        ]:
+            agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, storage="array", **kwargs)
+            train_agent(agent, n_episodes=10)
+            expected = np.where(agent._terminal, 0, agent._qvalues.max(axis=1))
+            self.assertTrue(np.array_equal(agent._state_values, expected))
+
+    def test_invalid_storage(self):
+        with self.assertRaises(dyna_agent.InvalidStorageMode):
+            dyna_agent.DynaAgent(self.gridworld, storage="sparse")
+
+
+class TestDynaAgentSeenPairs(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        np.random.seed(0)
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_dict_seen_pairs_match_model(self):
+        agent = dyna_agent.DynaAgent(self.gridworld)
+        train_agent(agent, n_episodes=5)
+        seen = [pair for pair, outcome in agent._model.items() if outcome is not None]
+        self.assertEqual(agent._n_seen_pairs, len(seen))
+        self.assertEqual(set(agent._seen_pairs), set(seen))
+
+    def test_array_seen_pairs_match_model(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, storage="array")
+        train_agent(agent, n_episodes=5)
+        seen = agent._seen_pairs[: agent._n_seen_pairs]
+        self.assertEqual(agent._n_seen_pairs, agent._model_seen.sum())
+        self.assertTrue(agent._model_seen[seen[:, 0], seen[:, 1]].all())
+
+
+class TestDynaAgentPrioritizedPlanning(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        np.random.seed(0)
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_dict_storage_learns_optimal_policy(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, planning="prioritized")
+        train_agent(agent, n_updates=5)
+        self.assertEqual(greedy_steps(agent), optimal_steps)
+
+    def test_array_storage_learns_optimal_policy(self):
+        agent = dyna_agent.DynaAgent(
+            self.gridworld, alfa=0.5, storage="array", planning="prioritized"
+        )
+        train_agent(agent, n_updates=5)
+        self.assertEqual(greedy_steps(agent), optimal_steps)
+
+    def test_predecessors(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, planning="prioritized")
+        agent._queue_pair((3, 4), "U", 1)
+        agent._update_model(((3, 4), "U"), 0, (2, 4))
+        self.assertEqual(list(agent._predecessors[(2, 4)]), [((3, 4), "U")])
+        # Queue keeps only the highest priority of each pair
+        agent._queue_pair((3, 4), "U", 0.5)
+        self.assertEqual(agent._queued_priorities[((3, 4), "U")], 1)
+
+    def test_reset_keeps_priority_threshold(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, planning="prioritized", priority_threshold=0.5)
+        agent.reset_agent()
+        self.assertEqual(agent.priority_threshold, 0.5)
+
+    def test_invalid_planning(self):
+        with self.assertRaises(dyna_agent.InvalidPlanningMode):
+            dyna_agent.DynaAgent(self.gridworld, planning="random")
+
+
+class TestDynaAgentBatchedPlanning(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        np.random.seed(0)
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_learns_optimal_policy(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, storage="array", planning="batched")
+        train_agent(agent, n_updates=50)
+        self.assertEqual(greedy_steps(agent), optimal_steps)
+
+    def test_duplicates_backed_up_once(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, storage="array", planning="batched")
+        state = agent._state_ids[(3, 4)]
+        action = agent._action_ids["U"]
+        agent._add_seen_pair(state, action)
+        agent._update_model((state, action), -1, agent._state_ids[(2, 4)])
+        agent._do_planning(100)
+        self.assertEqual(agent._qvalues[state, action], -0.5)
+
+    def test_requires_array_storage(self):
+        with self.assertRaises(dyna_agent.InvalidPlanningMode):
+            dyna_agent.DynaAgent(self.gridworld, planning="batched")
+
+
+class TestDynaAgentStochasticModel(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        np.random.seed(0)
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_learns_optimal_policy(self):
+        for planning in ["uniform", "prioritized", "batched"]:
+            for model_backup in ["sample", "expectation"]:
+                agent = dyna_agent.DynaAgent(
+                    self.gridworld,
+                    alfa=0.5,
+                    storage="array",
+                    planning=planning,
+                    model="stochastic",
+                    model_backup=model_backup,
+                )
+                train_agent(agent)
+                self.assertEqual(greedy_steps(agent), optimal_steps)
+
+    def test_outcome_counts(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_stochastic_path, dynamics="compiled")
+        agent = dyna_agent.DynaAgent(gridworld, storage="array", model="stochastic", max_outcomes=5)
+        state = agent._state_ids[(0, 0)]
+        action = agent._action_ids["R"]
+        for _ in range(4000):
+            agent.init_round(state=(0, 0))
+            reward, new_state = agent.env.take_action("R")
+            agent._update_model((state, action), reward, agent._state_ids[new_state])
+        counts = agent._outcome_counts[state, action]
+        next_states = agent._outcome_next_states[state, action]
+        probs = dict(zip(next_states.tolist(), counts / counts.sum()))
+        self.assertEqual(counts.sum(), 4000)
+        self.assertAlmostEqual(probs[agent._state_ids[(0, 1)]], 0.4, delta=0.03)
+        self.assertAlmostEqual(probs[agent._state_ids[(5, 0)]], 0.25, delta=0.03)
+        slot = next_states.tolist().index(agent._state_ids[(5, 0)])
+        self.assertEqual(agent._outcome_rewards[state, action, slot], -5)
+
+    def test_evicts_rarest_outcome(self):
+        agent = dyna_agent.DynaAgent(
+            self.gridworld, storage="array", model="stochastic", max_outcomes=2
+        )
+        for new_state, reward in [(1, -1), (1, -1), (2, -3), (3, -2)]:
+            agent._add_seen_pair(0, 0)
+            agent._update_model((0, 0), reward, new_state)
+        self.assertEqual(agent._outcome_next_states[0, 0].tolist(), [1, 3])
+        self.assertEqual(agent._outcome_counts[0, 0].tolist(), [2, 1])
+        self.assertEqual(agent._outcome_rewards[0, 0].tolist(), [-1, -2])
+        self.assertEqual(agent._n_seen_pairs, 1)
+
+    def test_expected_td_error(self):
+        agent = dyna_agent.DynaAgent(
+            self.gridworld, storage="array", model="stochastic", model_backup="expectation"
+        )
+        goal = agent._state_ids[(2, 4)]
+        agent._qvalues[1] = np.where(agent._valid_actions[1], 4.0, -np.inf)
+        agent._refresh_state_values([1])
+        for new_state, reward in [(1, -1), (1, -1), (1, -1), (goal, 10)]:
+            agent._update_model((0, 0), reward, new_state)
+        self.assertAlmostEqual(agent._model_td_error(0, 0), 0.75 * 3 + 0.25 * 10)
+
+    def test_invalid_model(self):
+        with self.assertRaises(dyna_agent.InvalidModelMode):
+            dyna_agent.DynaAgent(self.gridworld, storage="array", model="ensemble")
+        with self.assertRaises(dyna_agent.InvalidModelMode):
+            dyna_agent.DynaAgent(self.gridworld, model="stochastic")
+        with self.assertRaises(dyna_agent.InvalidModelMode):
+            dyna_agent.DynaAgent(
+                self.gridworld, storage="array", model="stochastic", model_backup="max"
+            )
+
+
+class TestDynaAgentRandomBlocks(unittest.TestCase):
+    def setUp(self):
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_blocks_follow_generator(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, seed=3, random_block_size=8)
+        draws = [agent._random() for _ in range(20)]
+        expected = np.random.default_rng(3).random(24)[:20]
+        self.assertTrue(np.array_equal(draws, expected))
+
+    def test_seed_is_reproducible(self):
+        for storage, planning in [("dict", "uniform"), ("array", "uniform"), ("array", "batched")]:
+            qvalues = []
+            for _ in range(2):
+                agent = dyna_agent.DynaAgent(
+                    self.gridworld, storage=storage, planning=planning, seed=7
+                )
+                train_agent(agent, n_episodes=10)
+                qvalues.append(agent._qvalues)
+            if storage == "array":
+                self.assertTrue(np.array_equal(qvalues[0], qvalues[1]))
+            else:
+                self.assertEqual(qvalues[0], qvalues[1])
+
+    def test_seed_is_reproducible_across_processes(self):
+        # Results must not depend on the hash seed, e.g. through the iteration order of sets
+        script = (
+            "from src import dyna_agent, grid_env\n"
+            f"env = grid_env.Gridworld({grid_good_path!r}, {rules_good_path!r})\n"
+            "for kwargs in [{}, {'exploration': 'ucb'}, {'planning': 'prioritized'}]:\n"
+            "    agent = dyna_agent.DynaAgent(env, seed=1, **kwargs)\n"
+            "    print(agent.run_episodes(5, n_updates=5)['steps'].tolist())\n"
+        )
+        outputs = set()
+        for hash_seed in ["1", "2", "3"]:
+            result = subprocess.run(
+                [sys.executable, "-c", script],
+                env=dict(os.environ, PYTHONHASHSEED=hash_seed),
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            outputs.add(result.stdout)
+        self.assertEqual(len(outputs), 1)
+
+    def test_reset_keeps_seed(self):
+        agent = dyna_agent.DynaAgent(
+            self.gridworld, exploration="decaying-epsilon", seed=5, random_block_size=16
+        )
+        first_draw = agent._random()
+        agent.reset_agent()
+        self.assertEqual(agent._random(), first_draw)
+
+
+class TestDynaAgentUCB(unittest.TestCase):
+    def setUp(self):
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_dict_storage_learns_optimal_policy(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, exploration="ucb", ucb_c=0.5, alfa=0.5, seed=0)
+        train_agent(agent)
+        agent.ucb_c = 0
+        self.assertEqual(greedy_steps(agent), optimal_steps)
+
+    def test_counts_aligned_with_qvalues(self):
+        for storage in ["dict", "array"]:
+            agent = dyna_agent.DynaAgent(self.gridworld, exploration="ucb", storage=storage, seed=0)
+            agent.init_round(state=(3, 0))
+            action = agent._get_ucb_action()
+            if storage == "array":
+                self.assertEqual(agent._counts_actions.shape, agent._qvalues.shape)
+                state_id = agent._state_ids[(3, 0)]
+                self.assertEqual(agent._counts_actions[state_id, agent._action_ids[action]], 2)
+                self.assertEqual(agent._counts_actions.sum(), agent._qvalues.size + 1)
+            else:
+                self.assertEqual(agent._counts_actions[(3, 0)][action], 2)
+                for state, qvalues in agent._qvalues.items():
+                    self.assertEqual(set(agent._counts_actions[state]), set(qvalues))
+
+    def test_prefers_least_played_action(self):
+        for storage in ["dict", "array"]:
+            agent = dyna_agent.DynaAgent(self.gridworld, exploration="ucb", storage=storage, seed=0)
+            for _ in range(3):
+                agent.init_round(state=(3, 1))
+            # Every action but "U" has been played many times already
+            for action in agent.env.get_possible_actions((3, 1)):
+                times_played = 1 if action == "U" else 10
+                if storage == "array":
+                    state_id = agent._state_ids[(3, 1)]
+                    agent._counts_actions[state_id, agent._action_ids[action]] = times_played
+                    agent._ucb_weights[state_id, agent._action_ids[action]] = 1 / np.sqrt(
+                        times_played
+                    )
+                else:
+                    agent._counts_actions[(3, 1)][action] = times_played
+            self.assertEqual(agent._get_ucb_action(), "U")
+
+    def test_log_cached_per_episode(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, exploration="ucb", storage="array", seed=0)
+        with mock.patch.object(dyna_agent.math, "log", wraps=dyna_agent.math.log) as log:
+            agent.init_round(state=(3, 0))
+            for _ in range(5):
+                agent._get_ucb_action()
+            agent.init_round(state=(3, 0))
+            agent._get_ucb_action()
+        self.assertEqual(log.call_count, 2)
+
+
+class TestDynaAgentRunEpisodes(unittest.TestCase):
+    def setUp(self):
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_matches_manual_loop(self):
+        manual_agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, seed=0)
+        manual_steps = []
+        for _ in range(20):
+            manual_agent.init_round(method="default")
+            while not manual_agent.finished():
+                manual_agent.play_step(n_updates=5)
+            manual_steps.append(manual_agent.steps)
+
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, seed=0)
+        results = agent.run_episodes(20, n_updates=5)
+        self.assertEqual(results["steps"].tolist(), manual_steps)
+        self.assertEqual(agent.episodes, 20)
+        # Every step costs -1 in the good grid, except reaching 'G'
+        self.assertEqual(results["returns"].tolist(), [1 - steps for steps in manual_steps])
+        self.assertEqual(results["planning_updates"].tolist(), [5 * s for s in manual_steps])
+        self.assertTrue((results["wall_time"] > 0).all())
+
+    def test_max_steps(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0, end_alfa=0, seed=0)
+        results = agent.run_episodes(3, n_updates=0, max_steps=4)
+        self.assertEqual(results["steps"].tolist(), [4, 4, 4])
+        self.assertEqual(results["planning_updates"].tolist(), [0, 0, 0])
+
+    def test_planning_updates(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, storage="array", planning="batched", seed=0)
+        results = agent.run_episodes(5, n_updates=20)
+        self.assertTrue((results["planning_updates"] <= 20 * results["steps"]).all())
+        self.assertTrue((results["planning_updates"] > 0).all())
+
+    def test_callback(self):
+        calls = []
+
+        def callback(agent, episodes_done, results):
+            calls.append((episodes_done, len(results["steps"]), agent.episodes))
+
+        agent = dyna_agent.DynaAgent(self.gridworld, seed=0)
+        agent.run_episodes(7, n_updates=2, callback=callback, callback_every=3)
+        self.assertEqual(calls, [(3, 3, 3), (6, 6, 6)])
+
+
+class TestDynaAgentCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.checkpoint_path = os.path.join(self.tmp_dir.name, "checkpoint")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resume_matches_uninterrupted_run(self):
+        for storage in ["dict", "array"]:
+            for exploration in ["decaying-epsilon", "ucb"]:
+                agent = dyna_agent.DynaAgent(
+                    self.gridworld,
+                    exploration=exploration,
+                    decay_eps_episodes=20,
+                    alfa=0.5,
+                    end_alfa=0.1,
+                    decay_alfa_episodes=20,
+                    storage=storage,
+                    seed=0,
+                )
+                agent.run_episodes(5, n_updates=5)
+                agent.save_checkpoint(self.checkpoint_path)
+                restored = dyna_agent.DynaAgent.load_checkpoint(
+                    self.gridworld, self.checkpoint_path
+                )
+                self.assertEqual(restored.episodes, 5)
+                self.assertEqual(restored.alfa, agent.alfa)
+
+                expected = agent.run_episodes(5, n_updates=5)
+                results = restored.run_episodes(5, n_updates=5)
+                self.assertEqual(results["steps"].tolist(), expected["steps"].tolist())
+                if storage == "array":
+                    self.assertTrue(np.array_equal(restored._qvalues, agent._qvalues))
+                else:
+                    self.assertEqual(restored._qvalues, agent._qvalues)
+                    self.assertEqual(restored._model, agent._model)
+
+    def test_stochastic_model_and_prioritized_queue(self):
+        for storage, model in [("dict", "deterministic"), ("array", "stochastic")]:
+            agent = dyna_agent.DynaAgent(
+                self.gridworld, storage=storage, planning="prioritized", model=model, seed=0
+            )
+            agent.run_episodes(3, n_updates=2)
+            agent.save_checkpoint(self.checkpoint_path)
+            restored = dyna_agent.DynaAgent.load_checkpoint(self.gridworld, self.checkpoint_path)
+            self.assertEqual(restored._predecessors, agent._predecessors)
+            self.assertEqual(restored._queued_priorities, agent._queued_priorities)
+            self.assertEqual(restored._n_seen_pairs, agent._n_seen_pairs)
+            if model == "stochastic":
+                self.assertTrue(np.array_equal(restored._outcome_counts, agent._outcome_counts))
+
+    def test_memory_mapped_load(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, storage="array", seed=0)
+        agent.run_episodes(20, n_updates=10)
+        agent.save_checkpoint(self.checkpoint_path)
+
+        restored = dyna_agent.DynaAgent.load_checkpoint(
+            self.gridworld, self.checkpoint_path, mmap_mode="r"
+        )
+        self.assertIsInstance(restored._qvalues, np.memmap)
+        self.assertTrue(np.array_equal(restored._qvalues, agent._qvalues))
+        with self.assertRaises(ValueError):
+            restored._qvalues[0, 0] = 1
+
+        # Copy-on-write keeps training without touching the checkpoint
+        restored = dyna_agent.DynaAgent.load_checkpoint(
+            self.gridworld, self.checkpoint_path, mmap_mode="c"
+        )
+        restored.run_episodes(2, n_updates=10)
+        saved = np.load(os.path.join(self.checkpoint_path, "qvalues.npy"))
+        self.assertTrue(np.array_equal(saved, agent._qvalues))
+
+    def test_save_over_memory_mapped_checkpoint(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, storage="array", seed=0)
+        agent.run_episodes(5, n_updates=10)
+        agent.save_checkpoint(self.checkpoint_path)
+
+        for mmap_mode in ["c", "r+"]:
+            restored = dyna_agent.DynaAgent.load_checkpoint(
+                self.gridworld, self.checkpoint_path, mmap_mode=mmap_mode
+            )
+            restored.run_episodes(5, n_updates=10)
+            restored.save_checkpoint(self.checkpoint_path)
+            reloaded = dyna_agent.DynaAgent.load_checkpoint(self.gridworld, self.checkpoint_path)
+            self.assertTrue(np.array_equal(reloaded._qvalues, restored._qvalues))
+            self.assertEqual(reloaded.episodes, restored.episodes)
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["checkpoint"])
+
+    def test_invalid_checkpoint(self):
+        with self.assertRaises(dyna_agent.InvalidCheckpoint):
+            dyna_agent.DynaAgent.load_checkpoint(self.gridworld, self.checkpoint_path)
+
+        dyna_agent.DynaAgent(self.gridworld, seed=0).save_checkpoint(self.checkpoint_path)
+        other_gridworld = grid_env.Gridworld(grid_customT_path, rules_good_path)
+        with self.assertRaises(dyna_agent.InvalidCheckpoint):
+            dyna_agent.DynaAgent.load_checkpoint(other_gridworld, self.checkpoint_path)
+
+
+class TestDynaAgentProfiling(unittest.TestCase):
+    def setUp(self):
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_phases_and_counters(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, storage="array", seed=0)
+        profiler = agent.enable_profiling()
+        results = agent.run_episodes(5, n_updates=4)
+        snapshot = profiler.snapshot()
+
+        n_steps = results["steps"].sum()
+        for phase in ["action_selection", "take_action", "q_update", "model_update", "planning"]:
+            self.assertEqual(snapshot["phases"][phase]["calls"], n_steps)
+            self.assertGreater(snapshot["phases"][phase]["time"], 0)
+        self.assertEqual(snapshot["phases"]["env.take_action"]["calls"], n_steps)
+        self.assertEqual(snapshot["phases"]["env.initialize"]["calls"], 5)
+        self.assertEqual(
+            snapshot["counters"]["planning_updates"], results["planning_updates"].sum()
+        )
+        self.assertEqual(snapshot["counters"]["seen_pairs"], agent._n_seen_pairs)
+
+        # env.take_action is reported inside take_action, so top-level shares add up to 100%
+        lines = profiler.report().splitlines()
+        take_action_line = [line for line in lines if line.startswith("take_action")][0]
+        self.assertEqual(lines[lines.index(take_action_line) + 1].split()[0], "env.take_action")
+        shares = [
+            float(line.split()[-1][:-1])
+            for line in lines[1:]
+            if line.endswith("%") and not line.startswith(" ")
+        ]
+        self.assertAlmostEqual(sum(shares), 100, delta=0.5)
+
+    def test_disable(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, seed=0)
+        profiler = agent.enable_profiling()
+        agent.run_episodes(1, n_updates=1)
+        agent.disable_profiling()
+        calls = dict(profiler.calls)
+        agent.run_episodes(1, n_updates=1)
+        self.assertEqual(profiler.calls, calls)
+        self.assertIsNone(agent.env.profiler)
+
+
+class TestDynaAgentIterSteps(unittest.TestCase):
+    def setUp(self):
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_matches_run_episodes(self):
+        expected = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, seed=0).run_episodes(
+            5, n_updates=5
+        )
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0.5, seed=0)
+        records = list(agent.iter_steps(5, n_updates=5))
+
+        episodes = [r for r in records if isinstance(r, dyna_agent.EpisodeRecord)]
+        steps = [r for r in records if isinstance(r, dyna_agent.StepRecord)]
+        self.assertEqual([r.steps for r in episodes], expected["steps"].tolist())
+        self.assertEqual([r.episode_return for r in episodes], expected["returns"].tolist())
+        self.assertTrue(all(r.finished for r in episodes))
+        self.assertEqual(len(steps), expected["steps"].sum())
+
+        # Each episode record follows the step that ended it
+        for i, record in enumerate(records):
+            if isinstance(record, dyna_agent.EpisodeRecord):
+                self.assertTrue(records[i - 1].done)
+                self.assertEqual(records[i - 1].step, record.steps)
+                self.assertEqual(records[i - 1].next_state, (2, 4))
+
+    def test_step_records(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, seed=0)
+        records = agent.iter_steps(n_updates=0)
+        previous = None
+        for _ in range(20):
+            record = next(records)
+            if isinstance(record, dyna_agent.EpisodeRecord):
+                previous = None
+                continue
+            if previous is not None:
+                self.assertEqual(record.state, previous.next_state)
+            self.assertEqual(record.reward, -1 if record.next_state != (2, 4) else 0)
+            self.assertIsInstance(record.td_error, float)
+            previous = record
+        records.close()
+
+    def test_max_steps_and_endless_runs(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, alfa=0, end_alfa=0, seed=0)
+        episodes = []
+        for record in agent.iter_steps(max_steps=3, n_updates=0):
+            if isinstance(record, dyna_agent.EpisodeRecord):
+                episodes.append(record)
+                if len(episodes) == 4:
+                    break
+        self.assertEqual([r.steps for r in episodes], [3, 3, 3, 3])
+        self.assertFalse(any(r.finished for r in episodes))
+        self.assertEqual(agent.episodes, 4)
+
+
+class TestDynaAgentReplay(unittest.TestCase):
+    def setUp(self):
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_learns_optimal_policy(self):
+        for planning, replay_recency in [("uniform", None), ("batched", 20)]:
+            agent = dyna_agent.DynaAgent(
+                self.gridworld,
+                exploration="decaying-epsilon",
+                decay_eps_episodes=40,
+                alfa=0.5,
+                storage="array",
+                planning=planning,
+                replay_capacity=200,
+                replay_recency=replay_recency,
+                seed=0,
+            )
+            results = agent.run_episodes(60, n_updates=20)
+            self.assertEqual(len(agent.replay_buffer), 200)
+            self.assertEqual(greedy_steps(agent), optimal_steps)
+            self.assertGreater(results["planning_updates"].sum(), 0)
+
+    def test_replay_only(self):
+        agent = dyna_agent.DynaAgent(
+            self.gridworld, storage="array", replay_capacity=50, replay_fraction=1, seed=0
+        )
+        with mock.patch.object(agent, "_get_model", wraps=agent._get_model) as get_model:
+            agent.run_episodes(3, n_updates=5)
+        get_model.assert_not_called()
+        self.assertEqual(len(agent.replay_buffer), 50)
+
+    def test_invalid_config(self):
+        with self.assertRaises(dyna_agent.InvalidPlanningMode):
+            dyna_agent.DynaAgent(self.gridworld, storage="dict", replay_capacity=10)
+        with self.assertRaises(dyna_agent.InvalidPlanningMode):
+            dyna_agent.DynaAgent(
+                self.gridworld, storage="array", replay_capacity=10, replay_fraction=1.5
+            )
+
+    def test_checkpoint(self):
+        agent = dyna_agent.DynaAgent(
+            self.gridworld, storage="array", replay_capacity=30, replay_recency=10, seed=0
+        )
+        agent.run_episodes(5, n_updates=5)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            agent.save_checkpoint(tmp_dir)
+            restored = dyna_agent.DynaAgent.load_checkpoint(self.gridworld, tmp_dir)
+            self.assertEqual(restored.replay_recency, 10)
+            self.assertEqual(restored.replay_buffer.position, agent.replay_buffer.position)
+            self.assertTrue(np.array_equal(restored.replay_buffer.data, agent.replay_buffer.data))
+
+            expected = agent.run_episodes(3, n_updates=5)
+            results = restored.run_episodes(3, n_updates=5)
+        self.assertEqual(results["steps"].tolist(), expected["steps"].tolist())
+        self.assertTrue(np.array_equal(restored._qvalues, agent._qvalues))
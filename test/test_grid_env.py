@@ -1,4 +1,11 @@
+import multiprocessing
+import os
+import random
+import tempfile
 import unittest
+from unittest import mock
+
+import numpy as np
 
 from src import grid_env
 
@@ -6,6 +13,10 @@ from src import grid_env
 grid_good_path = "test/config/input_grid_good.txt"
 rules_good_path = "test/config/grid_rules_good.config"
 
+grid_customT_path = "test/config/input_grid_customT.txt"
+rules_customT_path = "test/config/grid_rules_customT.config"
+rules_stochastic_path = "test/config/grid_rules_stochastic.config"
+
 grid_bad_01_path = "test/config/input_grid_bad_01.txt"  # Invalid character
 grid_bad_02_path = "test/config/input_grid_bad_02.txt"  # Invalid character
 grid_bad_03_path = "test/config/input_grid_bad_03.txt"  # Different row lengths
@@ -124,6 +135,17 @@ class TestConfigLoadingPositive(unittest.TestCase):
             self.gridworld.custom_rewards["3,4-U"], 0, "Incorrect custom reward loading"
         )
 
+    def test_override_index(self):
+        # Keyed by (row * column_num + column, action code)
+        self.assertEqual(self.gridworld._reward_overrides[(1 * 5 + 4, 3)], 0)
+        self.assertEqual(self.gridworld._reward_overrides[(2 * 5 + 3, 1)], 0)
+        self.assertEqual(len(self.gridworld._reward_overrides), 3)
+
+    def test_custom_transition_loading(self):
+        gridworld = grid_env.Gridworld(grid_customT_path, rules_customT_path)
+        self.assertEqual(gridworld._transition_overrides[(3 * 5 + 2, 0)], (0, 3, -1))
+        self.assertEqual(gridworld.custom_transitions["3,2-L"], ("0,3", -1))
+
 
 class TestConfigLoadingNegative(unittest.TestCase):
     def test_invalid_action_definition(self):
@@ -151,6 +173,35 @@ class TestConfigLoadingNegative(unittest.TestCase):
         with self.assertRaises(grid_env.InvalidRewardConfigError):
             grid_env.Gridworld(grid_good_path, rules_bad_05_path)
 
+    def test_invalid_custom_transition_state(self):
+        # Off grid source states (0, 7) and (9, 0), which must not wrap around to other cells
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rules_path = os.path.join(tmp_dir, "rules.config")
+            for transition, dynamics_modes in [
+                ("0,7-R-5,0 = 7", ["dict", "compiled", "lazy"]),
+                ("9,0-R-0,0 = DEFAULT", ["dict", "compiled", "lazy"]),
+                ("9,0-R-0,0 = DEFAULT @ 0.5", ["compiled"]),
+            ]:
+                with open(rules_path, "w") as rules_file:
+                    rules_file.write(
+                        f"[ACTIONS]\nL\nR\n[REWARDS]\nDEFAULT = -1\n[TRANSITIONS]\n{transition}\n"
+                    )
+                for dynamics in dynamics_modes:
+                    with self.assertRaises(grid_env.InvalidTransitionConfigError):
+                        grid_env.Gridworld(grid_good_path, rules_path, dynamics=dynamics)
+
+    def test_invalid_custom_transition_format(self):
+        # Malformed probabilities must not be read as deterministic transitions
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rules_path = os.path.join(tmp_dir, "rules.config")
+            for transition in ["0,0-R-5,4 = DEFAULT @0.25", "0,0-R-5,4 = -1 0.25"]:
+                with open(rules_path, "w") as rules_file:
+                    rules_file.write(
+                        f"[ACTIONS]\nL\nR\n[REWARDS]\nDEFAULT = -1\n[TRANSITIONS]\n{transition}\n"
+                    )
+                with self.assertRaises(grid_env.InvalidTransitionConfigError):
+                    grid_env.Gridworld(grid_good_path, rules_path)
+
 
 class TestInitializePositive(unittest.TestCase):
     @classmethod
@@ -486,3 +537,327 @@ class TestDynamicsNegative(unittest.TestCase):
 
 
 # TODO add tests for custom transitions
+
+
+class TestDynamicsModes(unittest.TestCase):
+    def _assert_same_dynamics(self, grid_path, rules_path, dynamics):
+        dict_gridworld = grid_env.Gridworld(grid_path, rules_path)
+        compiled_gridworld = grid_env.Gridworld(grid_path, rules_path, dynamics=dynamics)
+        self.assertEqual(
+            dict_gridworld.get_all_possible_states(), compiled_gridworld.get_all_possible_states()
+        )
+        for state in dict_gridworld.get_all_possible_states():
+            actions = dict_gridworld.get_possible_actions(state)
+            self.assertEqual(set(actions), set(compiled_gridworld.get_possible_actions(state)))
+            for action in actions:
+                dict_gridworld.initialize(state=state)
+                compiled_gridworld.initialize(state=state)
+                self.assertEqual(
+                    dict_gridworld.take_action(action),
+                    compiled_gridworld.take_action(action),
+                    f"Different dynamic at {state}-{action}",
+                )
+                self.assertEqual(dict_gridworld.current_cell, compiled_gridworld.current_cell)
+
+    def test_compiled_same_dynamics_as_dict(self):
+        self._assert_same_dynamics(grid_good_path, rules_good_path, "compiled")
+
+    def test_compiled_same_dynamics_as_dict_custom_transitions(self):
+        self._assert_same_dynamics(grid_customT_path, rules_customT_path, "compiled")
+
+    def test_lazy_same_dynamics_as_dict(self):
+        self._assert_same_dynamics(grid_good_path, rules_good_path, "lazy")
+
+    def test_lazy_same_dynamics_as_dict_custom_transitions(self):
+        self._assert_same_dynamics(grid_customT_path, rules_customT_path, "lazy")
+
+    def test_lazy_no_transitions_stored(self):
+        gridworld = grid_env.Gridworld(grid_customT_path, rules_customT_path, dynamics="lazy")
+        self.assertFalse(hasattr(gridworld, "transitions"))
+        self.assertEqual(len(gridworld._transition_overrides), 4)
+        self.assertEqual(gridworld.get_possible_actions((2, 4)), [])
+
+    def test_tables(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_good_path, dynamics="compiled")
+        self.assertEqual(gridworld.next_state_table.shape, (26, 4))
+        self.assertEqual(gridworld.state_ids[1][3], -1)
+        goal_id = gridworld.state_ids[2][4]
+        self.assertFalse(gridworld.action_mask[goal_id].any())
+
+    def test_take_action_from_G(self):
+        for dynamics in ["compiled", "lazy"]:
+            gridworld = grid_env.Gridworld(grid_good_path, rules_good_path, dynamics=dynamics)
+            gridworld._current_state = (2, 4)
+            gridworld._current_cell = "G"
+            with self.assertRaises(grid_env.InvalidActionError):
+                gridworld.take_action("U")
+
+    def test_invalid_dynamics_mode(self):
+        with self.assertRaises(grid_env.InvalidDynamicsModeError):
+            grid_env.Gridworld(grid_good_path, rules_good_path, dynamics="sparse")
+
+
+class TestCompiledCache(unittest.TestCase):
+    def _assert_same_gridworld(self, expected, actual):
+        self.assertEqual(expected.grid, actual.grid)
+        self.assertEqual(expected._default_start_state, actual._default_start_state)
+        self.assertEqual(expected._goal_state, actual._goal_state)
+        self.assertEqual(expected.custom_rewards, actual.custom_rewards)
+        self.assertEqual(expected.custom_transitions, actual.custom_transitions)
+        for state in expected.get_all_possible_states():
+            self.assertEqual(
+                set(expected.get_possible_actions(state)), set(actual.get_possible_actions(state))
+            )
+            for action in expected.get_possible_actions(state):
+                expected.initialize(state=state)
+                actual.initialize(state=state)
+                self.assertEqual(expected.take_action(action), actual.take_action(action))
+
+    def test_save_and_load_compiled(self):
+        gridworld = grid_env.Gridworld(grid_customT_path, rules_customT_path, dynamics="compiled")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            compiled_path = os.path.join(tmp_dir, "grid.npz")
+            gridworld.save_compiled(compiled_path)
+            for dynamics in ["dict", "compiled", "lazy"]:
+                loaded = grid_env.Gridworld.from_compiled(compiled_path, dynamics=dynamics)
+                self._assert_same_gridworld(gridworld, loaded)
+
+    def test_cache_dir(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            gridworld = grid_env.Gridworld(
+                grid_customT_path, rules_customT_path, dynamics="compiled", cache_dir=cache_dir
+            )
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            with mock.patch.object(grid_env.Gridworld, "_load_grid") as load_grid:
+                cached = grid_env.Gridworld(
+                    grid_customT_path, rules_customT_path, dynamics="compiled", cache_dir=cache_dir
+                )
+                load_grid.assert_not_called()
+            self._assert_same_gridworld(gridworld, cached)
+
+            # Different content is a different cache entry
+            grid_env.Gridworld(
+                grid_good_path, rules_good_path, dynamics="lazy", cache_dir=cache_dir
+            )
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            with self.assertRaises(grid_env.InvalidDynamicsModeError):
+                grid_env.Gridworld(grid_good_path, rules_good_path, cache_dir=cache_dir)
+
+
+class TestStochasticDynamics(unittest.TestCase):
+    def test_alias_tables(self):
+        rng = np.random.default_rng(0)
+        probs = rng.random((50, 5))
+        probs[:, 4] = 0
+        probs /= probs.sum(axis=1, keepdims=True)
+        alias_probs, alias_indices = grid_env.build_alias_tables(probs)
+        # Probability of each outcome recovered from the tables
+        recovered = np.zeros_like(probs)
+        for row in range(50):
+            for column in range(5):
+                recovered[row, column] += alias_probs[row, column] / 5
+                recovered[row, alias_indices[row, column]] += (1 - alias_probs[row, column]) / 5
+        self.assertTrue(np.allclose(recovered, probs))
+
+    def test_outcome_probs(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_stochastic_path, dynamics="compiled")
+        self.assertTrue(gridworld.stochastic)
+        self.assertTrue(np.allclose(gridworld.outcome_probs.sum(axis=2), 1))
+        state_id = gridworld.state_ids[0, 0]
+        action_id = gridworld.action_ids["R"]
+        outcomes = {}
+        for next_state, reward, prob in zip(
+            gridworld.outcome_next_states[state_id, action_id],
+            gridworld.outcome_rewards[state_id, action_id],
+            gridworld.outcome_probs[state_id, action_id],
+        ):
+            next_state = tuple(gridworld.state_coords[next_state].tolist())
+            outcomes[(next_state, reward)] = outcomes.get((next_state, reward), 0) + prob
+        expected = {
+            ((0, 1), -1): 0.4,
+            ((0, 0), -1): 0.05,
+            ((1, 0), -1): 0.05,
+            ((5, 4), -1): 0.25,
+            ((5, 0), -5): 0.25,
+        }
+        self.assertEqual(set(outcomes), set(expected))
+        for outcome, prob in expected.items():
+            self.assertAlmostEqual(outcomes[outcome], prob)
+
+    def test_take_action_frequencies(self):
+        random.seed(0)
+        gridworld = grid_env.Gridworld(grid_good_path, rules_stochastic_path, dynamics="compiled")
+        counts = {}
+        for _ in range(20000):
+            gridworld.initialize(state=(0, 0))
+            outcome = gridworld.take_action("R")
+            counts[outcome] = counts.get(outcome, 0) + 1
+        self.assertAlmostEqual(counts[(-1, (0, 1))] / 20000, 0.4, delta=0.02)
+        self.assertAlmostEqual(counts[(-5, (5, 0))] / 20000, 0.25, delta=0.02)
+        self.assertAlmostEqual(counts[(-1, (1, 0))] / 20000, 0.05, delta=0.01)
+
+    def test_take_action_matches_sample_outcomes(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_stochastic_path, dynamics="compiled")
+        state_id = gridworld.state_ids[0, 0]
+        action_id = gridworld.action_ids["R"]
+        random.seed(0)
+        uniforms = [random.random() for _ in range(200)]
+        outcomes = gridworld.sample_outcomes(state_id, action_id, np.array(uniforms))
+        next_states = gridworld.state_coords[gridworld.outcome_next_states[state_id, action_id]]
+        rewards = gridworld.outcome_rewards[state_id, action_id]
+        expected = [
+            (int(rewards[outcome]), tuple(next_states[outcome].tolist())) for outcome in outcomes
+        ]
+        random.seed(0)
+        results = []
+        for _ in range(200):
+            gridworld.initialize(state=(0, 0))
+            results.append(gridworld.take_action("R"))
+        self.assertEqual(results, expected)
+
+    def test_requires_compiled_dynamics(self):
+        for dynamics in ["dict", "lazy"]:
+            with self.assertRaises(grid_env.InvalidDynamicsModeError):
+                grid_env.Gridworld(grid_good_path, rules_stochastic_path, dynamics=dynamics)
+
+    def test_save_and_load_compiled(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_stochastic_path, dynamics="compiled")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            compiled_path = os.path.join(tmp_dir, "grid.npz")
+            gridworld.save_compiled(compiled_path)
+            loaded = grid_env.Gridworld.from_compiled(compiled_path)
+        self.assertEqual(loaded.slip, 0.2)
+        self.assertTrue(np.array_equal(gridworld.outcome_probs, loaded.outcome_probs))
+        self.assertTrue(np.array_equal(gridworld.alias_indices, loaded.alias_indices))
+
+    def test_invalid_probabilities(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rules_path = os.path.join(tmp_dir, "rules.config")
+            for extra_rules in [
+                "[TRANSITIONS]\n0,0-R-5,4 = DEFAULT @ 0.75\n0,0-R-5,0 = DEFAULT @ 0.5\n",
+                "[DYNAMICS]\nSLIP = 1.5\n",
+            ]:
+                with open(rules_path, "w") as rules_file:
+                    rules_file.write("[ACTIONS]\nL\nR\n[REWARDS]\nDEFAULT = -1\n" + extra_rules)
+                with self.assertRaises(grid_env.InvalidTransitionConfigError):
+                    grid_env.Gridworld(grid_good_path, rules_path, dynamics="compiled")
+
+
+class TestProfiling(unittest.TestCase):
+    def test_enable_and_disable(self):
+        for dynamics in ["dict", "compiled"]:
+            gridworld = grid_env.Gridworld(grid_good_path, rules_good_path, dynamics=dynamics)
+            profiler = gridworld.enable_profiling()
+            gridworld.initialize(method="default")
+            gridworld.take_action("R")
+            gridworld.take_action("U")
+            self.assertEqual(profiler.calls, {"env.initialize": 1, "env.take_action": 2})
+
+            gridworld.disable_profiling()
+            self.assertIsNone(gridworld.profiler)
+            gridworld.take_action("D")
+            self.assertEqual(profiler.calls["env.take_action"], 2)
+            self.assertNotIn("take_action", vars(gridworld))
+
+
+def _shared_worker_steps(spec):
+    gridworld = grid_env.Gridworld.from_shared(spec)
+    gridworld.initialize(method="default")
+    return [gridworld.take_action(action) for action in ["U", "R", "R"]]
+
+
+class TestSharedLayout(unittest.TestCase):
+    def test_attach(self):
+        gridworld = grid_env.Gridworld(grid_customT_path, rules_customT_path, dynamics="compiled")
+        with grid_env.SharedLayout(gridworld) as layout:
+            attached = grid_env.Gridworld.from_shared(layout.spec)
+
+        # Still usable after the publisher freed the block
+        self.assertEqual(attached.grid.tolist(), gridworld.grid)
+        self.assertEqual(attached.custom_transitions, gridworld.custom_transitions)
+        self.assertEqual(attached.custom_rewards, gridworld.custom_rewards)
+        for name in ["state_ids", "state_coords", "next_state_table", "reward_table"]:
+            self.assertTrue(np.array_equal(getattr(attached, name), getattr(gridworld, name)))
+            with self.assertRaises(ValueError):
+                getattr(attached, name)[0] = 0
+
+        for env in [gridworld, attached]:
+            env.initialize(method="default")
+        for action in ["U", "R", "R", "D"]:
+            self.assertEqual(attached.take_action(action), gridworld.take_action(action))
+            self.assertEqual(attached.current_cell, gridworld.current_cell)
+        self.assertEqual(attached.get_all_possible_states(), gridworld.get_all_possible_states())
+
+    def test_stochastic_outcomes(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_stochastic_path, dynamics="compiled")
+        with grid_env.SharedLayout(gridworld) as layout:
+            attached = grid_env.Gridworld.from_shared(layout.spec)
+            self.assertTrue(attached.stochastic)
+            for name in ["outcome_next_states", "outcome_probs", "alias_probs", "alias_indices"]:
+                self.assertTrue(np.array_equal(getattr(attached, name), getattr(gridworld, name)))
+                self.assertFalse(getattr(attached, name).flags.writeable)
+
+    def test_dict_dynamics_are_not_kept(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+        with grid_env.SharedLayout(gridworld):
+            pass
+        self.assertIsNone(gridworld.next_state_table)
+
+    def test_workers(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_good_path, dynamics="compiled")
+        gridworld.initialize(method="default")
+        expected = [gridworld.take_action(action) for action in ["U", "R", "R"]]
+        with grid_env.SharedLayout(gridworld) as layout:
+            with multiprocessing.Pool(2) as pool:
+                results = pool.map(_shared_worker_steps, [layout.spec] * 2)
+        self.assertEqual(results, [expected, expected])
+
+
+class TestLayout(unittest.TestCase):
+    def test_spawn_shares_layout(self):
+        for dynamics in ["dict", "compiled", "lazy"]:
+            gridworld = grid_env.Gridworld(grid_customT_path, rules_customT_path, dynamics=dynamics)
+            gridworld.initialize(method="default")
+            with mock.patch.object(grid_env.Gridworld, "_load_grid", side_effect=AssertionError):
+                spawned = gridworld.spawn()
+            self.assertIs(spawned.layout, gridworld.layout)
+            self.assertIs(spawned.grid, gridworld.grid)
+            self.assertIsNone(spawned.current_state)
+
+            spawned.initialize(state=(0, 0))
+            self.assertEqual(gridworld.current_state, gridworld._default_start_state)
+            for env in [gridworld, spawned]:
+                env.initialize(method="default")
+            for action in ["U", "R", "R"]:
+                self.assertEqual(spawned.take_action(action), gridworld.take_action(action))
+
+    def test_clone_copies_episode_state(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_good_path, dynamics="compiled")
+        gridworld.initialize(state=(0, 0))
+        gridworld.take_action("R")
+        clone = gridworld.clone()
+        self.assertEqual(clone.current_state, (0, 1))
+        self.assertEqual(clone.current_cell, gridworld.current_cell)
+        clone.take_action("R")
+        self.assertEqual(gridworld.current_state, (0, 1))
+        self.assertIs(clone.next_state_table, gridworld.next_state_table)
+
+    def test_layout_is_immutable(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_good_path, dynamics="compiled")
+        layout = gridworld.layout
+        self.assertFalse(hasattr(layout, "_current_state"))
+        with self.assertRaises(grid_env.IlegalLayoutChangeError):
+            layout.default_reward = 0
+        with self.assertRaises(grid_env.IlegalLayoutChangeError):
+            del layout.grid
+        with self.assertRaises(ValueError):
+            layout.reward_table[0, 0] = 0
+
+    def test_compiling_builds_new_layout(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+        layout = gridworld.layout
+        gridworld.compile_dynamics()
+        self.assertIsNot(gridworld.layout, layout)
+        self.assertIsNotNone(gridworld.spawn().next_state_table)
+        self.assertIsNone(layout.next_state_table)
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+from src import grid_env
+from src import grid_generator
+from src import solver
+
+
+class TestGridGenerator(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.grid_path = os.path.join(self.tmp_dir.name, "grid.txt")
+        self.rules_path = os.path.join(self.tmp_dir.name, "rules.config")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _assert_goal_reachable(self, grid_info, n_custom_rewards=0, n_teleports=0, seed=0):
+        grid_generator.generate_rules(
+            self.rules_path,
+            grid_info,
+            n_custom_rewards,
+            n_teleports,
+            reward_range=(-1, -1),
+            seed=seed,
+        )
+        gridworld = grid_env.Gridworld(self.grid_path, self.rules_path, dynamics="compiled")
+        self.assertEqual(gridworld.row_num, grid_info["rows"])
+        self.assertEqual(gridworld.column_num, grid_info["columns"])
+        self.assertEqual(gridworld._default_start_state, grid_info["start"])
+        self.assertEqual(gridworld._goal_state, grid_info["goal"])
+        _, policy, _ = solver.value_iteration(
+            gridworld, max_iterations=gridworld.row_num * gridworld.column_num
+        )
+        self.assertGreater(solver.policy_steps(gridworld, policy), 0)
+
+    def test_styles_reachable(self):
+        for style in ["open", "rooms", "maze"]:
+            for rows, columns in [(1, 2), (7, 9), (20, 13), (16, 16)]:
+                if style == "maze" and rows * columns < 4:
+                    continue
+                for seed in range(3):
+                    grid_info = grid_generator.generate_grid(
+                        self.grid_path,
+                        rows,
+                        columns,
+                        style=style,
+                        wall_density=0.4,
+                        room_size=4,
+                        seed=seed,
+                    )
+                    self._assert_goal_reachable(grid_info, seed=seed)
+
+    def test_teleports_keep_goal_reachable(self):
+        for style in ["open", "rooms", "maze"]:
+            for seed in range(3):
+                grid_info = grid_generator.generate_grid(
+                    self.grid_path, 15, 15, style=style, wall_density=0.3, seed=seed
+                )
+                self._assert_goal_reachable(
+                    grid_info, n_custom_rewards=20, n_teleports=20, seed=seed
+                )
+
+    def test_same_seed_same_grid(self):
+        grid_generator.generate_grid(self.grid_path, 10, 10, style="maze", seed=5)
+        with open(self.grid_path) as grid_file:
+            first = grid_file.read()
+        grid_generator.generate_grid(self.grid_path, 10, 10, style="maze", seed=5)
+        with open(self.grid_path) as grid_file:
+            self.assertEqual(first, grid_file.read())
+
+    def test_invalid_config(self):
+        with self.assertRaises(grid_generator.InvalidGeneratorConfigError):
+            grid_generator.generate_grid(self.grid_path, 10, 10, style="spiral")
+        with self.assertRaises(grid_generator.InvalidGeneratorConfigError):
+            grid_generator.generate_grid(self.grid_path, 1, 1)
+        with self.assertRaises(grid_generator.InvalidGeneratorConfigError):
+            grid_generator.generate_grid(self.grid_path, 10, 10, wall_density=1.5)
@@ -0,0 +1,74 @@
+import unittest
+
+from src import profiling
+
+
+class TestProfiler(unittest.TestCase):
+    def test_add_and_snapshot(self):
+        profiler = profiling.Profiler()
+        profiler.add("phase", 0.5)
+        profiler.add("phase", 1.5)
+        profiler.count("updates", 3)
+        profiler.count("updates")
+        profiler.set("seen", 7)
+        snapshot = profiler.snapshot()
+        self.assertEqual(snapshot["phases"], {"phase": {"time": 2.0, "calls": 2, "mean": 1.0}})
+        self.assertEqual(snapshot["counters"], {"updates": 4, "seen": 7})
+
+        # Snapshots are copies
+        profiler.count("updates")
+        self.assertEqual(snapshot["counters"]["updates"], 4)
+
+    def test_lap(self):
+        profiler = profiling.Profiler()
+        start = profiler.lap("first", 0)
+        end = profiler.lap("second", start)
+        self.assertGreaterEqual(end, start)
+        self.assertEqual(profiler.calls, {"first": 1, "second": 1})
+
+    def test_wrap(self):
+        profiler = profiling.Profiler()
+        double = profiler.wrap("double", lambda x: 2 * x)
+        self.assertEqual(double(4), 8)
+
+        def fail():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            profiler.wrap("fail", fail)()
+        self.assertEqual(profiler.calls, {"double": 1, "fail": 1})
+
+    def test_report_and_reset(self):
+        profiler = profiling.Profiler()
+        profiler.add("slow", 2)
+        profiler.add("fast", 1)
+        profiler.count("updates", 5)
+        lines = profiler.report().splitlines()
+        self.assertTrue(lines[1].startswith("slow"))
+        self.assertTrue(lines[2].startswith("fast"))
+        self.assertIn("66.7%", lines[1])
+        self.assertTrue(lines[3].startswith("updates"))
+
+        profiler.reset()
+        self.assertEqual(profiler.snapshot(), {"phases": {}, "counters": {}})
+
+    def test_report_nested_phases(self):
+        profiler = profiling.Profiler()
+        profiler.nest("env.step", "step")
+        profiler.add("step", 3)
+        profiler.add("env.step", 2)
+        profiler.add("update", 1)
+        lines = profiler.report().splitlines()
+        self.assertTrue(lines[1].startswith("step"))
+        self.assertIn("75.0%", lines[1])
+        # Listed under its parent, and not part of the total
+        self.assertTrue(lines[2].startswith("  env.step"))
+        self.assertIn("50.0%", lines[2])
+        self.assertTrue(lines[3].startswith("update"))
+        self.assertIn("25.0%", lines[3])
+
+        # Without its parent, a nested phase is reported on its own
+        profiler = profiling.Profiler()
+        profiler.nest("env.step", "step")
+        profiler.add("env.step", 2)
+        self.assertIn("100.0%", profiler.report().splitlines()[1])
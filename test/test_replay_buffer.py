@@ -0,0 +1,46 @@
+import unittest
+
+import numpy as np
+
+from src import replay_buffer
+
+
+class TestReplayBuffer(unittest.TestCase):
+    def test_preallocated(self):
+        buffer = replay_buffer.ReplayBuffer(100)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(replay_buffer.REPLAY_DTYPE.itemsize, 20)
+        self.assertEqual(buffer.nbytes, 100 * 20)
+
+    def test_overwrites_oldest(self):
+        buffer = replay_buffer.ReplayBuffer(4)
+        for i in range(6):
+            buffer.add(i, i % 2, -1.0, i + 1)
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(buffer.position, 2)
+        self.assertEqual(sorted(buffer.data["state"].tolist()), [2, 3, 4, 5])
+        self.assertEqual(buffer.data[0].tolist(), (4, 0, -1.0, 5))
+
+    def test_uniform_sample(self):
+        buffer = replay_buffer.ReplayBuffer(10)
+        for i in range(5):
+            buffer.add(i, 0, 0.0, i + 1)
+        batch = buffer.sample(1000, np.random.default_rng(0))
+        self.assertEqual(batch.dtype, replay_buffer.REPLAY_DTYPE)
+        self.assertEqual(len(batch), 1000)
+        # Only valid transitions are drawn, all of them about as often
+        counts = np.bincount(batch["state"], minlength=10)
+        self.assertEqual(counts[5:].sum(), 0)
+        self.assertTrue(np.all(counts[:5] > 150))
+        self.assertTrue(np.array_equal(batch["next_state"], batch["state"] + 1))
+
+    def test_recency_sample(self):
+        buffer = replay_buffer.ReplayBuffer(50)
+        for i in range(80):
+            buffer.add(i, 0, 0.0, i + 1)
+        batch = buffer.sample(5000, np.random.default_rng(0), recency_scale=5)
+        states = batch["state"]
+        self.assertTrue(np.all((states >= 30) & (states < 80)))
+        # Ages are exponential with mean about 5, so most draws are among the last 10
+        self.assertGreater(np.mean(states >= 70), 0.8)
+        self.assertGreater(np.mean(states == 79), np.mean(states == 75))
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src import grid_env
+from src import solver
+
+
+grid_good_path = "test/config/input_grid_good.txt"
+rules_good_path = "test/config/grid_rules_good.config"
+grid_customT_path = "test/config/input_grid_customT.txt"
+rules_customT_path = "test/config/grid_rules_customT.config"
+rules_stochastic_path = "test/config/grid_rules_stochastic.config"
+
+
+class TestSolver(unittest.TestCase):
+    def setUp(self):
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def test_value_iteration(self):
+        values, policy, stats = solver.value_iteration(self.gridworld)
+        self.assertTrue(stats["converged"])
+        # 9 steps to the goal, the last one with reward 0
+        self.assertEqual(values[self.gridworld.state_ids[3][0]], -8)
+        self.assertEqual(values[self.gridworld.state_ids[2][4]], 0)
+        self.assertEqual(policy[self.gridworld.state_ids[2][4]], -1)
+        self.assertEqual(solver.policy_steps(self.gridworld, policy), 9)
+
+    def test_policy_iteration_matches_value_iteration(self):
+        vi_values, _, _ = solver.value_iteration(self.gridworld)
+        pi_values, pi_policy, stats = solver.policy_iteration(self.gridworld)
+        self.assertTrue(stats["converged"])
+        self.assertTrue(np.allclose(vi_values, pi_values))
+        self.assertEqual(solver.policy_steps(self.gridworld, pi_policy), 9)
+
+    def test_custom_transitions(self):
+        gridworld = grid_env.Gridworld(grid_customT_path, rules_customT_path)
+        values, policy, _ = solver.value_iteration(gridworld)
+        # Every action from 3,2 teleports to 0,3, which is 3 steps away from the goal
+        self.assertEqual(values[gridworld.state_ids[3][2]], -1 + values[gridworld.state_ids[0][3]])
+        self.assertEqual(solver.policy_steps(gridworld, policy, state=(0, 3)), 3)
+
+    def test_policy_steps_never_reaching_goal(self):
+        # Always going left never reaches the goal
+        self.gridworld.compile_dynamics()
+        policy = np.where(self.gridworld.action_mask.any(axis=1), 0, -1)
+        self.assertEqual(solver.policy_steps(self.gridworld, policy), -1)
+
+    def test_stochastic(self):
+        gridworld = grid_env.Gridworld(grid_good_path, rules_stochastic_path, dynamics="compiled")
+        vi_values, vi_policy, vi_stats = solver.value_iteration(gridworld, gamma=0.95)
+        pi_values, pi_policy, pi_stats = solver.policy_iteration(gridworld, gamma=0.95)
+        self.assertTrue(vi_stats["converged"])
+        self.assertTrue(pi_stats["converged"])
+        self.assertTrue(np.allclose(vi_values, pi_values, atol=1e-4))
+        # Slipping makes every state worse than with deterministic moves
+        deterministic_values, _, _ = solver.value_iteration(self.gridworld, gamma=0.95)
+        self.assertTrue((vi_values <= deterministic_values + 1e-9).all())
+
+    def test_states_not_reaching_goal(self):
+        # 0,2 is walled off from the goal, so it has no finite value without discount
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            grid_path = os.path.join(tmp_dir, "grid.txt")
+            with open(grid_path, "w") as grid_file:
+                grid_file.write("-------\n|.|X|.|\n|S|X|X|\n|.|.|G|\n-------\n")
+            rules_path = os.path.join(tmp_dir, "rules.config")
+            with open(rules_path, "w") as rules_file:
+                rules_file.write("[ACTIONS]\nL\nR\nU\nD\n\n[REWARDS]\nDEFAULT = -1\n")
+            gridworld = grid_env.Gridworld(grid_path, rules_path)
+
+        for solve in [solver.value_iteration, solver.policy_iteration]:
+            values, policy, stats = solve(gridworld)
+            self.assertTrue(stats["converged"])
+            self.assertEqual(stats["unsolved"], 1)
+            self.assertEqual(values[gridworld.state_ids[0][2]], -np.inf)
+            self.assertEqual(values[gridworld.state_ids[1][0]], -3)
+            self.assertEqual(solver.policy_steps(gridworld, policy), 3)
@@ -0,0 +1,153 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src import sweep
+
+
+grid_good_path = "test/config/input_grid_good.txt"
+rules_good_path = "test/config/grid_rules_good.config"
+
+
+class TestSweepConfigs(unittest.TestCase):
+    def test_grid_configs(self):
+        configs = sweep.grid_configs({"epsilon": [0.05, 0.1], "exploration": ["epsilon"]})
+        self.assertEqual(
+            configs,
+            [
+                {"epsilon": 0.05, "exploration": "epsilon"},
+                {"epsilon": 0.1, "exploration": "epsilon"},
+            ],
+        )
+
+    def test_random_configs(self):
+        configs = sweep.random_configs({"alfa": (0.1, 0.5), "n_updates": [0, 5]}, 10, seed=1)
+        self.assertEqual(len(configs), 10)
+        for config in configs:
+            self.assertTrue(0.1 <= config["alfa"] <= 0.5)
+            self.assertIn(config["n_updates"], [0, 5])
+        self.assertEqual(
+            configs, sweep.random_configs({"alfa": (0.1, 0.5), "n_updates": [0, 5]}, 10, seed=1)
+        )
+
+    def test_integer_ranges(self):
+        configs = sweep.random_configs({"n_updates": (5.0, 20.0), "n_layers": (0, 3)}, 50, seed=0)
+        for config in configs:
+            self.assertIsInstance(config["n_updates"], int)
+            self.assertTrue(5 <= config["n_updates"] <= 20)
+            self.assertIn(config["n_layers"], [0, 1, 2, 3])
+
+    def test_parse_params(self):
+        params = sweep._parse_params(["epsilon=0.1,0.2", "exploration=ucb", "alfa=0.1:0.5"])
+        self.assertEqual(
+            params, {"epsilon": [0.1, 0.2], "exploration": ["ucb"], "alfa": (0.1, 0.5)}
+        )
+        params = sweep._parse_params(["n_updates=5:20", "alfa=0:1"])
+        self.assertEqual(params, {"n_updates": (5, 20), "alfa": (0.0, 1.0)})
+        self.assertIsInstance(params["alfa"][0], float)
+
+
+class TestRunSweep(unittest.TestCase):
+    def test_run_and_resume(self):
+        configs = sweep.grid_configs({"exploration": ["epsilon", "ucb"], "n_updates": [5]})
+        with tempfile.TemporaryDirectory() as output_dir:
+            results_path, n_executed = sweep.run_sweep(
+                grid_good_path,
+                rules_good_path,
+                configs,
+                [0, 1],
+                output_dir,
+                n_episodes=3,
+                n_workers=2,
+            )
+            self.assertEqual(n_executed, 4)
+            results = np.load(results_path)
+            self.assertEqual(results["steps"].shape, (4, 3))
+            self.assertTrue((results["steps"] > 0).all())
+            self.assertEqual(list(results["exploration"]), ["epsilon", "epsilon", "ucb", "ucb"])
+            self.assertEqual(list(results["seed"]), [0, 1, 0, 1])
+
+            # Remove one run as if the sweep had been interrupted
+            os.remove(os.path.join(output_dir, "runs", f"{results['job_id'][3]}.npy"))
+            _, n_executed = sweep.run_sweep(
+                grid_good_path,
+                rules_good_path,
+                configs,
+                [0, 1],
+                output_dir,
+                n_episodes=3,
+                n_workers=2,
+            )
+            self.assertEqual(n_executed, 1)
+
+    def test_failed_runs_keep_the_others(self):
+        configs = sweep.random_configs({"n_updates": (2, 5), "exploration": ["epsilon"]}, 1, seed=0)
+        configs.append({"exploration": "random"})
+        with tempfile.TemporaryDirectory() as output_dir:
+            with self.assertRaises(sweep.SweepJobError):
+                sweep.run_sweep(
+                    grid_good_path, rules_good_path, configs, [0], output_dir, n_episodes=2
+                )
+            self.assertEqual(len(os.listdir(os.path.join(output_dir, "runs"))), 1)
+
+            # Only the failed run is retried
+            with self.assertRaises(sweep.SweepJobError) as context:
+                sweep.run_sweep(
+                    grid_good_path, rules_good_path, configs, [0], output_dir, n_episodes=2
+                )
+            self.assertIn("1 of 1 runs failed", str(context.exception))
+
+    def test_shared_env(self):
+        configs = sweep.grid_configs({"epsilon": [0.1, 0.2], "n_updates": [5]})
+        with tempfile.TemporaryDirectory() as output_dir:
+            results_path, n_executed = sweep.run_sweep(
+                grid_good_path,
+                rules_good_path,
+                configs,
+                [0],
+                output_dir,
+                n_episodes=3,
+                n_workers=2,
+                share_env=True,
+            )
+            self.assertEqual(n_executed, 2)
+            shared_steps = np.load(results_path)["steps"]
+            self.assertEqual(shared_steps.shape, (2, 3))
+            self.assertTrue((shared_steps > 0).all())
+
+        # Same runs as with dict dynamics
+        with tempfile.TemporaryDirectory() as output_dir:
+            results_path, _ = sweep.run_sweep(
+                grid_good_path, rules_good_path, configs, [0], output_dir, n_episodes=3
+            )
+            self.assertTrue(np.array_equal(np.load(results_path)["steps"], shared_steps))
+
+    def test_cache_dir(self):
+        configs = sweep.grid_configs({"epsilon": [0.1], "n_updates": [5]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, "cache")
+            results_path, _ = sweep.run_sweep(
+                grid_good_path,
+                rules_good_path,
+                configs,
+                [0, 1],
+                os.path.join(tmp_dir, "cached"),
+                n_episodes=3,
+                n_workers=2,
+                cache_dir=cache_dir,
+            )
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached_steps = np.load(results_path)["steps"]
+
+            # Same runs as without the cache
+            results_path, _ = sweep.run_sweep(
+                grid_good_path,
+                rules_good_path,
+                configs,
+                [0, 1],
+                os.path.join(tmp_dir, "dict"),
+                n_episodes=3,
+            )
+            self.assertTrue(np.array_equal(np.load(results_path)["steps"], cached_steps))
@@ -0,0 +1,156 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from src import dyna_agent
+from src import grid_env
+from src import trajectory_log
+
+
+grid_good_path = "test/config/input_grid_good.txt"
+rules_good_path = "test/config/grid_rules_good.config"
+
+
+class TestTrajectoryLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.tmp_dir.name, "log")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_record_size(self):
+        self.assertEqual(trajectory_log.TRAJECTORY_DTYPE.itemsize, 17)
+
+    def test_write_and_read_chunks(self):
+        with trajectory_log.TrajectoryWriter(
+            self.log_path, ["L", "R"], chunk_records=4, buffer_records=3
+        ) as writer:
+            for i in range(10):
+                writer.append(i // 5, i, i % 2, -0.5 * i, i + 1)
+            self.assertEqual(len(writer), 10)
+
+        reader = trajectory_log.TrajectoryReader(self.log_path)
+        self.assertEqual(len(reader), 10)
+        self.assertEqual(reader.n_chunks, 3)
+        self.assertEqual([len(chunk) for chunk in reader], [4, 4, 2])
+        self.assertIsInstance(reader.chunk(0), np.memmap)
+        self.assertEqual(reader.actions, ["L", "R"])
+
+        records = reader.read()
+        self.assertEqual(records["state"].tolist(), list(range(10)))
+        self.assertEqual(records["next_state"].tolist(), list(range(1, 11)))
+        self.assertEqual(records["action"].tolist(), [i % 2 for i in range(10)])
+        self.assertEqual(records["reward"].tolist(), [-0.5 * i for i in range(10)])
+        self.assertEqual(records["episode"].tolist(), [i // 5 for i in range(10)])
+        self.assertEqual(reader.read(3, 9)["state"].tolist(), list(range(3, 9)))
+        self.assertEqual(len(reader.read(10, 20)), 0)
+
+    def test_buffering(self):
+        writer = trajectory_log.TrajectoryWriter(self.log_path, ["L"], buffer_records=5)
+        for i in range(4):
+            writer.append(1, i, 0, 0, i)
+        self.assertEqual(len(trajectory_log.TrajectoryReader(self.log_path)), 0)
+        writer.append(1, 4, 0, 0, 4)
+        self.assertEqual(len(trajectory_log.TrajectoryReader(self.log_path)), 5)
+        writer.close()
+
+    def test_append_to_existing_log(self):
+        with trajectory_log.TrajectoryWriter(self.log_path, ["L"], chunk_records=4) as writer:
+            for i in range(6):
+                writer.append(1, i, 0, 0, i)
+        # Partial record left by an interrupted write
+        with open(os.path.join(self.log_path, "chunk_000001.bin"), "ab") as chunk_file:
+            chunk_file.write(b"\0" * 5)
+        self.assertEqual(len(trajectory_log.TrajectoryReader(self.log_path)), 6)
+
+        with trajectory_log.TrajectoryWriter(self.log_path, ["L"], chunk_records=100) as writer:
+            self.assertEqual(writer.chunk_records, 4)
+            for i in range(6, 9):
+                writer.append(2, i, 0, 0, i)
+        reader = trajectory_log.TrajectoryReader(self.log_path)
+        self.assertEqual(reader.read()["state"].tolist(), list(range(9)))
+        self.assertEqual([len(chunk) for chunk in reader], [4, 4, 1])
+
+        with self.assertRaises(trajectory_log.InvalidTrajectoryLogError):
+            trajectory_log.TrajectoryWriter(self.log_path, ["L", "R"])
+
+    def test_append_to_full_last_chunk(self):
+        with trajectory_log.TrajectoryWriter(self.log_path, ["L"], chunk_records=4) as writer:
+            for i in range(4):
+                writer.append(1, i, 0, 0, i)
+        with trajectory_log.TrajectoryWriter(self.log_path, ["L"]) as writer:
+            writer.append(2, 4, 0, 0, 4)
+        reader = trajectory_log.TrajectoryReader(self.log_path)
+        self.assertEqual(reader.read()["state"].tolist(), list(range(5)))
+        self.assertEqual([len(chunk) for chunk in reader], [4, 1])
+
+    def test_failed_flush_keeps_records(self):
+        writer = trajectory_log.TrajectoryWriter(self.log_path, ["L"], chunk_records=4)
+        for i in range(3):
+            writer.append(1, i, 0, 0, i)
+        with mock.patch.object(trajectory_log, "open", side_effect=OSError, create=True):
+            with self.assertRaises(OSError):
+                writer.flush()
+        self.assertEqual(len(writer), 3)
+        writer.close()
+        reader = trajectory_log.TrajectoryReader(self.log_path)
+        self.assertEqual(reader.read()["state"].tolist(), list(range(3)))
+
+    def test_missing_log(self):
+        with self.assertRaises(trajectory_log.InvalidTrajectoryLogError):
+            trajectory_log.TrajectoryReader(self.log_path)
+
+
+class TestTrajectoryFeeds(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.tmp_dir.name, "log")
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_agent_feed(self):
+        agent = dyna_agent.DynaAgent(self.gridworld, storage="array", seed=0)
+        with trajectory_log.TrajectoryWriter(self.log_path, self.gridworld.action_list) as writer:
+            agent.enable_trajectory_log(writer)
+            steps = [record for record in agent.iter_steps(3, n_updates=2)]
+        steps = [record for record in steps if isinstance(record, dyna_agent.StepRecord)]
+
+        records = trajectory_log.TrajectoryReader(self.log_path).read()
+        states = self.gridworld.get_all_possible_states()
+        self.assertEqual(len(records), len(steps))
+        self.assertEqual([states[s] for s in records["state"]], [r.state for r in steps])
+        self.assertEqual([states[s] for s in records["next_state"]], [r.next_state for r in steps])
+        self.assertEqual(
+            [self.gridworld.action_list[a] for a in records["action"]], [r.action for r in steps]
+        )
+        self.assertEqual(records["reward"].tolist(), [r.reward for r in steps])
+        self.assertEqual(records["episode"].tolist(), [r.episode for r in steps])
+
+    def test_gridworld_feed(self):
+        writer = trajectory_log.TrajectoryWriter(self.log_path, ["U", "D", "L", "R"])
+        self.gridworld.enable_trajectory_log(writer)
+        profiler = self.gridworld.enable_profiling()
+        for _ in range(2):
+            self.gridworld.initialize(method="default")
+            self.gridworld.take_action("U")
+            self.gridworld.take_action("R")
+        self.gridworld.disable_profiling()
+        self.gridworld.initialize(method="default")
+        self.gridworld.take_action("R")
+        self.gridworld.disable_trajectory_log()
+        self.gridworld.take_action("R")
+        writer.close()
+
+        records = trajectory_log.TrajectoryReader(self.log_path).read()
+        states = self.gridworld.get_all_possible_states()
+        self.assertEqual(records["episode"].tolist(), [1, 1, 2, 2, 3])
+        self.assertEqual([states[s] for s in records["state"][:2]], [(3, 0), (2, 0)])
+        self.assertEqual(records["action"].tolist(), [0, 3, 0, 3, 3])
+        self.assertEqual(profiler.calls["env.take_action"], 4)
+        self.assertNotIn("take_action", vars(self.gridworld))
@@ -0,0 +1,78 @@
+import unittest
+
+import numpy as np
+
+from src import grid_env
+from src import vector_env
+
+
+grid_good_path = "test/config/input_grid_good.txt"
+rules_good_path = "test/config/grid_rules_good.config"
+rules_stochastic_path = "test/config/grid_rules_stochastic.config"
+
+
+class TestVectorGridworld(unittest.TestCase):
+    def setUp(self):
+        self.gridworld = grid_env.Gridworld(grid_good_path, rules_good_path)
+        self.vector_env = vector_env.VectorGridworld(self.gridworld, n_envs=8)
+
+    def test_initialize_default(self):
+        start_id = self.gridworld.state_ids[3][0]
+        self.assertTrue((self.vector_env.states == start_id).all())
+
+    def test_initialize_random(self):
+        states = self.vector_env.initialize(method="random")
+        self.assertTrue(self.gridworld.action_mask[states].all())
+
+    def test_step_matches_gridworld(self):
+        self.vector_env.initialize(method="random")
+        actions = np.random.randint(0, len(self.vector_env.action_list), size=8)
+        start_states = self.vector_env.states.copy()
+        rewards, new_states, _ = self.vector_env.step(actions)
+        for slot in range(8):
+            state = tuple(self.gridworld.state_coords[start_states[slot]].tolist())
+            self.gridworld.initialize(state=state)
+            action = self.vector_env.action_list[actions[slot]]
+            reward, new_state = self.gridworld.take_action(action)
+            self.assertEqual(reward, rewards[slot])
+            self.assertEqual(self.gridworld.state_ids[new_state], new_states[slot])
+
+    def test_done_slots_are_reset(self):
+        # From (3, 4) going 'U' reaches the goal with reward 0
+        self.vector_env.initialize(state=(3, 4))
+        up = self.vector_env.action_list.index("U")
+        rewards, new_states, dones = self.vector_env.step(np.full(8, up))
+        self.assertTrue(dones.all())
+        self.assertTrue((rewards == 0).all())
+        self.assertTrue((new_states == self.gridworld.state_ids[2][4]).all())
+        self.assertTrue((self.vector_env.states == self.gridworld.state_ids[3][0]).all())
+
+    def test_invalid_init_method(self):
+        with self.assertRaises(vector_env.InvalidInitMethodError):
+            vector_env.VectorGridworld(self.gridworld, n_envs=2, init_method="middle")
+
+    def test_invalid_state(self):
+        with self.assertRaises(grid_env.InvalidStateError):
+            self.vector_env.initialize(state=(1, 3))
+
+    def test_invalid_actions(self):
+        n_actions = len(self.vector_env.action_list)
+        for actions in [
+            np.full(8, -1),
+            np.full(8, n_actions),
+            np.zeros(3, dtype=int),
+            np.zeros(8, dtype=float),
+        ]:
+            with self.assertRaises(grid_env.InvalidActionError):
+                self.vector_env.step(actions)
+        # Nothing moved
+        self.assertTrue((self.vector_env.states == self.gridworld.state_ids[3][0]).all())
+
+    def test_stochastic_step(self):
+        np.random.seed(0)
+        gridworld = grid_env.Gridworld(grid_good_path, rules_stochastic_path, dynamics="compiled")
+        env = vector_env.VectorGridworld(gridworld, n_envs=20000)
+        env.initialize(state=(0, 0))
+        rewards, new_states, _ = env.step(np.full(20000, gridworld.action_ids["R"]))
+        self.assertAlmostEqual((new_states == gridworld.state_ids[0, 1]).mean(), 0.4, delta=0.02)
+        self.assertAlmostEqual((rewards == -5).mean(), 0.25, delta=0.02)